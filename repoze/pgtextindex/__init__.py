@@ -1,2 +1,3 @@
 # API
 from repoze.pgtextindex.index import PGTextIndex
+from repoze.pgtextindex.sharded import ShardedPGTextIndex
@@ -0,0 +1,306 @@
+
+"""Non-blocking searches for applications that use an asyncio event loop.
+
+The methods of AsyncPGTextIndex return futures, so applications can
+await them on asyncio or yield From() them on trollius.  The queries
+run over psycopg2 asynchronous connections, which are polled by the
+event loop instead of blocking it.
+"""
+
+from repoze.pgtextindex.db import disconnected_exceptions
+from repoze.pgtextindex.db import set_local_sql
+import psycopg2.extensions
+
+try:  # pragma: no cover
+    import asyncio
+except ImportError:  # pragma: no cover
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+
+class AsyncConnectionPool(object):
+    """A small pool of psycopg2 asynchronous connections.
+
+    Each query uses a connection of its own, so the pool size limits
+    the number of queries running at once.  Other queries wait for a
+    connection to be released.
+    """
+
+    def __init__(self, dsn, size=5, loop=None, module=psycopg2):
+        if asyncio is None:
+            raise ImportError('AsyncConnectionPool requires asyncio '
+                              'or trollius')
+        self.dsn = dsn
+        self.size = size
+        self.loop = loop or asyncio.get_event_loop()
+        self.module = module
+        self._idle = []
+        self._open = 0
+        self._waiters = []  # [Future]
+
+    def acquire(self):
+        """Get a future that produces a connection."""
+        future = asyncio.Future(loop=self.loop)
+        if self._idle:
+            future.set_result(self._idle.pop())
+        elif self._open < self.size:
+            self._connect(future)
+        else:
+            self._waiters.append(future)
+        return future
+
+    def _connect(self, future):
+        self._open += 1
+        try:
+            conn = self.module.connect(self.dsn, async_=True)
+        except Exception as e:
+            self._open -= 1
+            future.set_exception(e)
+            return
+
+        def connected(f):
+            if f.exception() is not None:
+                self.discard(conn)
+                future.set_exception(f.exception())
+            elif future.cancelled():
+                self.release(conn)
+            else:
+                future.set_result(conn)
+
+        wait(conn, self.loop).add_done_callback(connected)
+
+    def release(self, conn):
+        """Return a connection that is no longer needed."""
+        while self._waiters:
+            waiter = self._waiters.pop(0)
+            if not waiter.cancelled():
+                waiter.set_result(conn)
+                return
+        self._idle.append(conn)
+
+    def discard(self, conn):
+        """Close a broken connection instead of releasing it."""
+        try:
+            conn.close()
+        except disconnected_exceptions:
+            pass
+        self._open -= 1
+        while self._waiters:
+            waiter = self._waiters.pop(0)
+            if not waiter.cancelled():
+                self._connect(waiter)
+                return
+
+    def close(self):
+        """Close the idle connections."""
+        idle = self._idle
+        self._idle = []
+        self._open -= len(idle)
+        for conn in idle:
+            conn.close()
+
+
+def wait(conn, loop):
+    """Get a future that completes when an asynchronous operation is done.
+
+    Polls the connection whenever its socket is ready.
+    """
+    future = asyncio.Future(loop=loop)
+    fd = conn.fileno()
+
+    def poll():
+        loop.remove_reader(fd)
+        loop.remove_writer(fd)
+        if future.cancelled():
+            return
+        try:
+            state = conn.poll()
+        except Exception as e:
+            future.set_exception(e)
+            return
+        if state == psycopg2.extensions.POLL_OK:
+            future.set_result(None)
+        elif state == psycopg2.extensions.POLL_READ:
+            loop.add_reader(fd, poll)
+        elif state == psycopg2.extensions.POLL_WRITE:
+            loop.add_writer(fd, poll)
+        else:
+            future.set_exception(psycopg2.OperationalError(
+                'Unexpected poll state: %r' % state))
+
+    poll()
+    return future
+
+
+class AsyncPGTextIndex(object):
+    """Runs the searches of a PGTextIndex without blocking the event loop.
+
+    Uses the table, text search configuration, and query options of
+    the PGTextIndex, and produces the same result types.  dsn defaults
+    to the DSN of the index.  Contextual summaries always use
+    ts_headline, even if the index uses a local Summarizer.
+    """
+
+    def __init__(self, index, dsn=None, pool_size=5, loop=None,
+                 module=psycopg2):
+        self.index = index
+        self.pool = AsyncConnectionPool(
+            dsn or index.dsn, pool_size, loop=loop, module=module)
+        self.loop = self.pool.loop
+
+    def _execute(self, make_sql, convert, settings=()):
+        """Get a future that produces the result of a statement.
+
+        make_sql is called once a connection is available and returns
+        (stmt, params).  The result is convert(rows, connection).
+        settings is a sequence of (name, value) that apply only to the
+        statement, in addition to the read_settings of the index.
+        """
+        res = asyncio.Future(loop=self.loop)
+        pool = self.pool
+
+        def acquired(f):
+            if f.exception() is not None:
+                res.set_exception(f.exception())
+                return
+            conn = f.result()
+            if res.cancelled():
+                pool.release(conn)
+                return
+            index = self.index
+            if index.phrase_search is None and (
+                    index._v_server_version is None):
+                # Let the index convert queries without connecting.
+                index._v_server_version = getattr(conn, 'server_version', 0)
+            try:
+                stmt, params = make_sql()
+                all_settings = index._read_settings(settings)
+                if all_settings:
+                    # Autocommit mode: the statements form one transaction.
+                    stmt = set_local_sql(all_settings) + stmt
+                cursor = conn.cursor()
+                cursor.execute(stmt, params)
+            except Exception as e:
+                pool.release(conn)
+                res.set_exception(e)
+                return
+
+            def executed(f):
+                error = f.exception()
+                if error is None:
+                    try:
+                        result = convert(cursor.fetchall(), conn)
+                    except Exception as e:
+                        error = e
+                if error is not None:
+                    if isinstance(error, disconnected_exceptions) and (
+                            conn.closed):
+                        pool.discard(conn)
+                    else:
+                        pool.release(conn)
+                    if not res.cancelled():
+                        res.set_exception(error)
+                    return
+                cursor.close()
+                pool.release(conn)
+                if not res.cancelled():
+                    res.set_result(result)
+
+            wait(conn, self.loop).add_done_callback(executed)
+
+        pool.acquire().add_done_callback(acquired)
+        return res
+
+    def apply(self, query, docids=None):
+        """Get a future that produces the result of a text query.
+
+        The result is a BTree of docid to rank, as produced by
+        PGTextIndex.applyContains().  As in PGTextIndex, queries that
+        exceed the statement_timeout of the index are run again without
+        ranking, and approximate queries use gin_fuzzy_search_limit.
+        """
+        index = self.index
+        cache, cache_key = index._get_cache(query, docids=docids)
+        if cache is not None:
+            result = cache.get(cache_key)
+            if result is not None:
+                # Cache hit.
+                res = asyncio.Future(loop=self.loop)
+                res.set_result(result)
+                return res
+
+        res = asyncio.Future(loop=self.loop)
+        settings = index._query_settings(query)
+
+        def make_result(rows, conn):
+            result = index.family.IF.BTree()
+            result.update(rows)
+            if index._is_approximate(query):
+                query.approximate_result = True
+            return result
+
+        def done(f, degraded=False):
+            if res.cancelled():
+                return
+            error = f.exception()
+            if error is None:
+                result = f.result()
+                if cache is not None and not degraded:
+                    cache[cache_key] = result
+                res.set_result(result)
+            elif not degraded and isinstance(
+                    error, psycopg2.extensions.QueryCanceledError):
+                index._degrade([query], error)
+                self._execute(
+                    lambda: index._unranked_query_sql(query, docids=docids),
+                    make_result, settings,
+                ).add_done_callback(lambda f: done(f, degraded=True))
+            else:
+                res.set_exception(error)
+
+        self._execute(
+            lambda: index._query_sql(query, docids=docids), make_result,
+            settings,
+        ).add_done_callback(done)
+        return res
+
+    applyContains = apply
+
+    def apply_intersect(self, query, docids):
+        """Get a future that produces query results limited to docids."""
+        if not docids:
+            res = asyncio.Future(loop=self.loop)
+            res.set_result(self.index.family.IF.BTree())
+            return res
+        return self.apply(query, docids=docids)
+
+    def count(self, query):
+        """Get a future that produces the number of matching documents."""
+        def get_count(rows, conn):
+            return rows[0][0]
+
+        return self._execute(lambda: self.index._count_sql(query), get_count)
+
+    def get_contextual_summaries(self, raw_texts, query, **options):
+        """Get a future that produces a summary for each text.
+
+        See PGTextIndex.get_contextual_summaries().
+        """
+        if not raw_texts:
+            res = asyncio.Future(loop=self.loop)
+            res.set_result([])
+            return res
+        index = self.index
+
+        def decode(rows, conn):
+            return [summary.decode(conn.encoding) for (summary,) in rows]
+
+        return self._execute(
+            lambda: index._summaries_sql(raw_texts, query, **options), decode)
+
+    def close(self):
+        """Close the idle connections."""
+        self.pool.close()
+
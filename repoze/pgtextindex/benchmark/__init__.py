@@ -0,0 +1,13 @@
+
+"""Benchmarks of PGTextIndex against a real PostgreSQL server.
+
+Run the benchmark suite with::
+
+    python -m repoze.pgtextindex.benchmark --output results.json
+
+By default the suite starts a temporary PostgreSQL server using the
+initdb and pg_ctl programs.  Use --dsn to target an existing database
+instead.  The corpus is generated from a seed, so runs with the same
+parameters index the same documents and run the same queries, and the
+JSON results of different versions can be compared.
+"""
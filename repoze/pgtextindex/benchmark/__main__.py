@@ -0,0 +1,4 @@
+
+from repoze.pgtextindex.benchmark.run import main
+
+main()
@@ -0,0 +1,134 @@
+
+"""A reproducible synthetic corpus with a Zipfian vocabulary."""
+
+from bisect import bisect
+from repoze.pgtextindex.interfaces import IWeightedQuery
+from repoze.pgtextindex.interfaces import IWeightedText
+from zope.interface import implements
+import random
+import zlib
+
+# Words are made of consonant-vowel syllables, so every word is
+# pronounceable and different ranks produce different words.
+SYLLABLES = [c + v for c in 'bdfgklmnprstvz' for v in 'aeiou']
+
+QUERY_SHAPES = ('term', 'rare_term', 'and', 'phrase', 'glob', 'not',
+                'marker')
+
+
+def make_word(rank):
+    """Make the word of a vocabulary rank."""
+    n = rank + len(SYLLABLES)  # Use at least two syllables.
+    parts = []
+    while n:
+        n, r = divmod(n, len(SYLLABLES))
+        parts.append(SYLLABLES[r])
+    return ''.join(reversed(parts))
+
+
+class Document(object):
+    implements(IWeightedText)
+
+    def __init__(self, docid, title, text, marker):
+        self.docid = docid
+        self.A = title
+        self.text = text
+        self.marker = marker
+
+    def __str__(self):
+        return self.text
+
+
+class Query(unicode):
+    """A text query with optional IWeightedQuery attributes."""
+    implements(IWeightedQuery)
+
+
+class Corpus(object):
+    """Generates documents and queries from a seed.
+
+    The words of the documents are drawn from a vocabulary whose word
+    frequencies follow Zipf's law with exponent zipf, as in natural
+    language.  Each document has a title, indexed with the A weight, a
+    body of about doc_words words, and one of the markers.  A document
+    depends only on the parameters and its docid.
+    """
+
+    def __init__(self, size=10000, vocabulary=50000, zipf=1.0,
+                 doc_words=300, title_words=8,
+                 markers=('article', 'event', 'file', 'page', 'person'),
+                 seed=0):
+        self.size = size
+        self.zipf = zipf
+        self.doc_words = doc_words
+        self.title_words = title_words
+        self.markers = tuple(markers)
+        self.seed = seed
+        self.words = [make_word(rank) for rank in range(vocabulary)]
+        self._cumulative = []
+        total = 0.0
+        for rank in range(vocabulary):
+            total += 1.0 / (rank + 1) ** zipf
+            self._cumulative.append(total)
+
+    def _random(self, key):
+        return random.Random(self.seed * 1000003 + key)
+
+    def word(self, rng):
+        """Choose a word according to the Zipf distribution."""
+        x = rng.random() * self._cumulative[-1]
+        return self.words[min(bisect(self._cumulative, x),
+                              len(self.words) - 1)]
+
+    def _body_words(self, docid, rng=None):
+        if rng is None:
+            rng = self._random(docid)
+        count = rng.randint(self.doc_words // 2 + 2,
+                            self.doc_words * 3 // 2 + 2)
+        return rng, [self.word(rng) for _i in range(count)]
+
+    def document(self, docid, rng=None):
+        """Generate the document with the given docid.
+
+        If rng is given, the document is generated using that random
+        number generator instead of the one determined by the docid.
+        """
+        rng, body = self._body_words(docid, rng)
+        title = ' '.join(self.word(rng) for _i in range(self.title_words))
+        return Document(docid, title, ' '.join(body),
+                        rng.choice(self.markers))
+
+    def documents(self):
+        """Generate all the documents, with docids starting at 1."""
+        for docid in range(1, self.size + 1):
+            yield self.document(docid)
+
+    def queries(self, shape, count):
+        """Generate queries of a shape in QUERY_SHAPES.
+
+        'not' queries are meant for applyDoesNotContain() and 'marker'
+        queries provide IWeightedQuery with a marker.
+        """
+        rng = self._random(-(zlib.crc32(shape) & 0xffffff) - 1)
+        res = []
+        for _i in range(count):
+            if shape in ('term', 'not'):
+                query = Query(self.word(rng))
+            elif shape == 'rare_term':
+                query = Query(rng.choice(self.words))
+            elif shape == 'and':
+                query = Query('%s %s' % (self.word(rng), self.word(rng)))
+            elif shape == 'phrase':
+                # Use adjacent words of a document, so the phrase matches.
+                _rng, body = self._body_words(rng.randint(1, self.size))
+                i = rng.randrange(len(body) - 1)
+                query = Query('"%s %s"' % (body[i], body[i + 1]))
+            elif shape == 'glob':
+                query = Query(self.word(rng)[:4] + '*')
+            elif shape == 'marker':
+                query = Query(self.word(rng))
+                query.marker = rng.choice(self.markers)
+            else:
+                raise ValueError('unknown query shape: %r' % shape)
+            res.append(query)
+        return res
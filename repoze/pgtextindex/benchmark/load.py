@@ -0,0 +1,379 @@
+
+"""Generate a concurrent read/write load on PGTextIndex."""
+
+from repoze.pgtextindex import metrics
+from repoze.pgtextindex.benchmark.corpus import Corpus
+from repoze.pgtextindex.benchmark.run import discriminator
+from repoze.pgtextindex.benchmark.run import get_version
+from repoze.pgtextindex.benchmark.run import percentiles
+from repoze.pgtextindex.benchmark.server import TemporaryPostgreSQL
+from repoze.pgtextindex.index import PGTextIndex
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import perfmetrics
+import platform
+import psycopg2
+import random
+import sys
+import threading
+import time
+import transaction
+
+log = logging.getLogger(__name__)
+
+DISTRIBUTIONS = ('uniform', 'hotkey')
+
+# Outcomes of failed operations, by PostgreSQL error code.
+ERROR_CODES = {
+    '40P01': 'deadlock',
+    '40001': 'serialization_failure',
+}
+
+DEFAULTS = {
+    'table': 'pgtextindex_load',
+    'processes': 1,
+    'threads': 8,
+    'duration': 30.0,
+    'docids': 1000,
+    'distribution': 'uniform',
+    'hot_keys': 10,
+    'hot_fraction': 0.9,
+    'write_ratio': 1.0,
+    'preload': 0,
+    'words': 300,
+    'vocabulary': 50000,
+    'zipf': 1.0,
+    'pool_size': None,
+    'seed': 0,
+}
+
+
+class CountingStatsdClient(object):
+    """A perfmetrics statsd client that counts increments in memory.
+
+    The load generator installs it to learn how often PGTextIndex
+    retried upserts.  Gauges and timers are ignored.
+    """
+
+    def __init__(self):
+        self.counts = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, count=1, *args, **kw):
+        self._lock.acquire()
+        try:
+            self.counts[name] = self.counts.get(name, 0) + count
+        finally:
+            self._lock.release()
+
+    def gauge(self, name, value, *args, **kw):
+        pass
+
+    def timing(self, name, value, *args, **kw):
+        pass
+
+    def set(self, name, value, *args, **kw):
+        pass
+
+    def sendbuf(self, buf):
+        pass
+
+    def get(self, name):
+        return self.counts.get(metrics.prefix + name, 0)
+
+
+def classify_error(error):
+    """Name the outcome of an operation that raised an error."""
+    code = getattr(error, 'pgcode', None)
+    if code in ERROR_CODES:
+        return ERROR_CODES[code]
+    if isinstance(error, psycopg2.IntegrityError):
+        # _upsert ran out of retries.
+        return 'integrity_error'
+    return 'other_error'
+
+
+class DocidChooser(object):
+    """Chooses docids uniformly or with a few hot keys.
+
+    With the 'hotkey' distribution, hot_fraction of the choices fall on
+    the first hot_keys docids and the rest are uniform over all docids.
+    """
+
+    def __init__(self, docids, distribution='uniform', hot_keys=10,
+                 hot_fraction=0.9):
+        if distribution not in DISTRIBUTIONS:
+            raise ValueError('unknown distribution: %r' % distribution)
+        self.docids = docids
+        self.distribution = distribution
+        self.hot_keys = max(1, min(hot_keys, docids))
+        self.hot_fraction = hot_fraction
+
+    def __call__(self, rng):
+        if (self.distribution == 'hotkey'
+                and rng.random() < self.hot_fraction):
+            return rng.randint(1, self.hot_keys)
+        return rng.randint(1, self.docids)
+
+
+def make_corpus(options):
+    return Corpus(size=options['docids'],
+                  vocabulary=options['vocabulary'],
+                  zipf=options['zipf'],
+                  doc_words=options['words'],
+                  seed=options['seed'])
+
+
+def make_index(options, drop_and_create=False):
+    return PGTextIndex(discriminator, options['dsn'],
+                       table=options['table'],
+                       drop_and_create=drop_and_create,
+                       pool_size=options['pool_size'])
+
+
+class Worker(object):
+    """Runs operations in one thread until the deadline."""
+
+    def __init__(self, options, corpus, seed):
+        self.options = options
+        self.corpus = corpus
+        self.rng = random.Random(seed)
+        self.choose_docid = DocidChooser(
+            options['docids'], options['distribution'],
+            options['hot_keys'], options['hot_fraction'])
+        self.index = make_index(options)
+        self.latencies = {'write': [], 'read': []}
+        self.errors = {}
+
+    def write(self):
+        docid = self.choose_docid(self.rng)
+        doc = self.corpus.document(docid, self.rng)
+        self.index.index_doc(docid, doc)
+
+    def read(self):
+        self.index.applyContains(self.corpus.word(self.rng))
+
+    def run(self, start_event, duration):
+        start_event.wait()
+        deadline = time.time() + duration
+        write_ratio = self.options['write_ratio']
+        while time.time() < deadline:
+            if self.rng.random() < write_ratio:
+                kind, func = 'write', self.write
+            else:
+                kind, func = 'read', self.read
+            start = time.time()
+            try:
+                func()
+                transaction.commit()
+            except Exception as e:
+                transaction.abort()
+                outcome = classify_error(e)
+                if outcome == 'other_error':
+                    log.exception("%s failed", kind)
+                key = '%s_%s' % (kind, outcome)
+                self.errors[key] = self.errors.get(key, 0) + 1
+            else:
+                self.latencies[kind].append((time.time() - start) * 1000)
+        self.index.connection_manager.close()
+
+
+def run_process(options, process_num=0):
+    """Run the worker threads of one process and return raw results."""
+    client = CountingStatsdClient()
+    previous = perfmetrics.statsd_client()
+    perfmetrics.set_statsd_client(client)
+    try:
+        corpus = make_corpus(options)
+        threads_per_process = options['threads']
+        start_event = threading.Event()
+        workers = []
+        threads = []
+        for thread_num in range(threads_per_process):
+            seed = (options['seed'] * 1000003 +
+                    process_num * threads_per_process + thread_num)
+            worker = Worker(options, corpus, seed)
+            workers.append(worker)
+            t = threading.Thread(target=worker.run,
+                                 args=(start_event, options['duration']))
+            t.start()
+            threads.append(t)
+        # Start all the threads at once.
+        start_event.set()
+        for t in threads:
+            t.join()
+    finally:
+        perfmetrics.set_statsd_client(previous)
+
+    res = {
+        'latencies': {'write': [], 'read': []},
+        'errors': {},
+        'upsert_retries': client.get('upsert.retry'),
+    }
+    for worker in workers:
+        for kind, values in worker.latencies.items():
+            res['latencies'][kind].extend(values)
+        for key, count in worker.errors.items():
+            res['errors'][key] = res['errors'].get(key, 0) + count
+    return res
+
+
+def _run_process_args(args):
+    return run_process(*args)
+
+
+def preload(options):
+    """Create the table and index preload documents."""
+    index = make_index(options, drop_and_create=True)
+    transaction.commit()
+    if options['preload']:
+        corpus = make_corpus(options)
+        for docid in range(1, options['preload'] + 1):
+            index.index_doc(docid, corpus.document(docid))
+            if docid % 500 == 0:
+                transaction.commit()
+        transaction.commit()
+        log.info("Preloaded %d documents", options['preload'])
+    index.connection_manager.close()
+
+
+def summarize(process_results, seconds):
+    """Combine the raw results of the processes into a report."""
+    latencies = {'write': [], 'read': []}
+    errors = {}
+    upsert_retries = 0
+    for res in process_results:
+        for kind, values in res['latencies'].items():
+            latencies[kind].extend(values)
+        for key, count in res['errors'].items():
+            errors[key] = errors.get(key, 0) + count
+        upsert_retries += res['upsert_retries']
+    total = sum(len(values) for values in latencies.values())
+    report = {
+        'seconds': seconds,
+        'operations': total,
+        'operations_per_second': total / seconds if seconds else None,
+        'errors': errors,
+        'upsert_retries': upsert_retries,
+        'deadlocks': sum(count for key, count in errors.items()
+                         if key.endswith('_deadlock')),
+        'serialization_failures': sum(
+            count for key, count in errors.items()
+            if key.endswith('_serialization_failure')),
+    }
+    for kind, values in latencies.items():
+        report[kind] = percentiles(values)
+        if seconds:
+            report[kind]['per_second'] = len(values) / seconds
+    return report
+
+
+def run(dsn, **options):
+    """Run the load and return the results as a dict.
+
+    Latencies are in milliseconds.  Creates (and replaces) the table in
+    the database.
+    """
+    for name, value in DEFAULTS.items():
+        options.setdefault(name, value)
+    options['dsn'] = dsn
+    for name in options:
+        if name not in DEFAULTS and name != 'dsn':
+            raise TypeError('unknown option: %r' % name)
+    if options['distribution'] not in DISTRIBUTIONS:
+        raise ValueError('unknown distribution: %r'
+                         % options['distribution'])
+
+    preload(options)
+    start = time.time()
+    if options['processes'] > 1:
+        pool = multiprocessing.Pool(options['processes'])
+        try:
+            process_results = pool.map(
+                _run_process_args,
+                [(options, n) for n in range(options['processes'])])
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        process_results = [run_process(options)]
+    return summarize(process_results, time.time() - start)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--dsn', help='Use this database instead of a temporary server. '
+        'The load generator replaces the table given by --table.')
+    parser.add_argument('--pg-bindir',
+                        help='Directory of initdb and pg_ctl')
+    parser.add_argument('--table', default=DEFAULTS['table'])
+    parser.add_argument('--processes', type=int,
+                        default=DEFAULTS['processes'])
+    parser.add_argument('--threads', type=int, default=DEFAULTS['threads'],
+                        help='Threads per process')
+    parser.add_argument('--duration', type=float,
+                        default=DEFAULTS['duration'], help='Seconds')
+    parser.add_argument('--docids', type=int, default=DEFAULTS['docids'],
+                        help='Number of distinct docids')
+    parser.add_argument('--distribution', choices=DISTRIBUTIONS,
+                        default=DEFAULTS['distribution'])
+    parser.add_argument('--hot-keys', type=int,
+                        default=DEFAULTS['hot_keys'],
+                        help='Number of hot docids (hotkey distribution)')
+    parser.add_argument('--hot-fraction', type=float,
+                        default=DEFAULTS['hot_fraction'],
+                        help='Fraction of operations on the hot docids')
+    parser.add_argument('--write-ratio', type=float,
+                        default=DEFAULTS['write_ratio'],
+                        help='Fraction of operations that index a document')
+    parser.add_argument('--preload', type=int, default=DEFAULTS['preload'],
+                        help='Number of documents to index before the run')
+    parser.add_argument('--words', type=int,
+                        default=DEFAULTS['words'],
+                        help='Average number of words per document')
+    parser.add_argument('--vocabulary', type=int,
+                        default=DEFAULTS['vocabulary'])
+    parser.add_argument('--zipf', type=float, default=DEFAULTS['zipf'])
+    parser.add_argument('--pool-size', type=int,
+                        help='Connection pool size per process')
+    parser.add_argument('--seed', type=int, default=DEFAULTS['seed'])
+    parser.add_argument('--output', help='Write JSON results to this file')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    options = dict(vars(args))
+    del options['output']
+    del options['pg_bindir']
+    dsn = options.pop('dsn')
+    report = {
+        'benchmark': 'repoze.pgtextindex load',
+        'version': get_version(),
+        'python': platform.python_version(),
+        'started': datetime.datetime.utcnow().isoformat() + 'Z',
+        'parameters': dict(options),
+    }
+
+    if dsn:
+        report['results'] = run(dsn, **options)
+    else:
+        with TemporaryPostgreSQL(bindir=args.pg_bindir) as server:
+            report['results'] = run(server.dsn, **options)
+
+    if args.output:
+        f = open(args.output, 'w')
+    else:
+        f = sys.stdout
+    try:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+    finally:
+        if f is not sys.stdout:
+            f.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,203 @@
+
+"""Measure indexing, query, and summary performance of PGTextIndex."""
+
+from repoze.pgtextindex.benchmark.corpus import Corpus
+from repoze.pgtextindex.benchmark.corpus import QUERY_SHAPES
+from repoze.pgtextindex.benchmark.server import TemporaryPostgreSQL
+from repoze.pgtextindex.index import PGTextIndex
+import argparse
+import datetime
+import json
+import logging
+import platform
+import random
+import sys
+import time
+import transaction
+
+log = logging.getLogger(__name__)
+
+INTERSECT_SIZES = (10, 100, 1000, 10000)
+
+
+def percentiles(values, points=(50, 90, 95, 99)):
+    """Summarize a list of numbers using nearest-rank percentiles."""
+    values = sorted(values)
+    if not values:
+        return {'count': 0}
+    res = {
+        'count': len(values),
+        'min': values[0],
+        'max': values[-1],
+        'mean': sum(values) / float(len(values)),
+    }
+    for point in points:
+        rank = max(1, int(-(-point * len(values) // 100)))
+        res['p%d' % point] = values[rank - 1]
+    return res
+
+
+def discriminator(obj, default):
+    return obj
+
+
+def timed(func, *args):
+    """Call a function in its own transaction and return the seconds."""
+    start = time.time()
+    func(*args)
+    transaction.commit()
+    return time.time() - start
+
+
+def latencies(func, args_list):
+    """Time calls of a function and summarize the milliseconds."""
+    return percentiles([timed(func, *args) * 1000 for args in args_list])
+
+
+def measure_indexing(index, corpus, batch_size):
+    start = time.time()
+    count = 0
+    for doc in corpus.documents():
+        index.index_doc(doc.docid, doc)
+        count += 1
+        if count % batch_size == 0:
+            transaction.commit()
+            log.info("Indexed %d documents", count)
+    transaction.commit()
+    elapsed = time.time() - start
+    return {
+        'documents': count,
+        'seconds': elapsed,
+        'documents_per_second': count / elapsed,
+    }
+
+
+def measure_queries(index, corpus, count):
+    res = {}
+    for shape in QUERY_SHAPES:
+        if shape == 'not':
+            func = index.applyDoesNotContain
+        else:
+            func = index.applyContains
+        queries = corpus.queries(shape, count)
+        res[shape] = latencies(func, [(query,) for query in queries])
+        log.info("Ran %d %s queries", count, shape)
+    return res
+
+
+def measure_intersect(index, corpus, count, sizes=INTERSECT_SIZES):
+    rng = random.Random(corpus.seed)
+    queries = corpus.queries('term', count)
+    all_docids = range(1, corpus.size + 1)
+    res = {}
+    for size in sizes:
+        size = min(size, corpus.size)
+        args_list = [
+            (query, sorted(rng.sample(all_docids, size)))
+            for query in queries]
+        res[str(size)] = latencies(index.apply_intersect, args_list)
+        log.info("Ran %d intersections with %d docids", count, size)
+    return res
+
+
+def measure_summaries(index, corpus, count, batch_size=10):
+    rng = random.Random(corpus.seed)
+    queries = corpus.queries('term', count)
+    args_list = []
+    for query in queries:
+        texts = [corpus.document(rng.randint(1, corpus.size)).text
+                 for _i in range(batch_size)]
+        args_list.append((texts, query))
+    start = time.time()
+    res = latencies(index.get_contextual_summaries, args_list)
+    elapsed = time.time() - start
+    res['summaries_per_second'] = count * batch_size / elapsed
+    log.info("Produced %d summaries", count * batch_size)
+    return res
+
+
+def run(dsn, corpus, queries=200, batch_size=500, table='pgtextindex_bench',
+        index_options=None):
+    """Run the benchmarks and return the results as a dict.
+
+    Durations are in milliseconds unless the key says otherwise.
+    Creates (and replaces) the table in the database.
+    """
+    index = PGTextIndex(discriminator, dsn, table=table,
+                        drop_and_create=True, **(index_options or {}))
+    transaction.commit()
+    results = {'indexing': measure_indexing(index, corpus, batch_size)}
+    index.cursor.execute('ANALYZE %s' % table)
+    transaction.commit()
+    results['queries'] = measure_queries(index, corpus, queries)
+    results['apply_intersect'] = measure_intersect(index, corpus, queries)
+    results['summaries'] = measure_summaries(index, corpus, queries)
+    results['postgresql'] = index.connection.server_version
+    transaction.commit()
+    return results
+
+
+def get_version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('repoze.pgtextindex').version
+    except Exception:
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        '--dsn', help='Use this database instead of a temporary server. '
+        'The benchmark replaces the table given by --table.')
+    parser.add_argument('--pg-bindir',
+                        help='Directory of initdb and pg_ctl')
+    parser.add_argument('--table', default='pgtextindex_bench')
+    parser.add_argument('--documents', type=int, default=10000)
+    parser.add_argument('--vocabulary', type=int, default=50000)
+    parser.add_argument('--zipf', type=float, default=1.0,
+                        help='Exponent of the word frequency distribution')
+    parser.add_argument('--words', type=int, default=300,
+                        help='Average number of words per document')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--queries', type=int, default=200,
+                        help='Number of queries of each shape')
+    parser.add_argument('--batch-size', type=int, default=500,
+                        help='Documents indexed per transaction')
+    parser.add_argument('--output', help='Write JSON results to this file')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    corpus = Corpus(size=args.documents, vocabulary=args.vocabulary,
+                    zipf=args.zipf, doc_words=args.words, seed=args.seed)
+    parameters = dict(vars(args))
+    del parameters['output']
+    del parameters['dsn']
+    del parameters['pg_bindir']
+    report = {
+        'benchmark': 'repoze.pgtextindex',
+        'version': get_version(),
+        'python': platform.python_version(),
+        'started': datetime.datetime.utcnow().isoformat() + 'Z',
+        'parameters': parameters,
+    }
+
+    if args.dsn:
+        report['results'] = run(
+            args.dsn, corpus, args.queries, args.batch_size, args.table)
+    else:
+        with TemporaryPostgreSQL(bindir=args.pg_bindir) as server:
+            report['results'] = run(
+                server.dsn, corpus, args.queries, args.batch_size,
+                args.table)
+
+    if args.output:
+        f = open(args.output, 'w')
+    else:
+        f = sys.stdout
+    try:
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.write('\n')
+    finally:
+        if f is not sys.stdout:
+            f.close()
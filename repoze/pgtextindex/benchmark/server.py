@@ -0,0 +1,112 @@
+
+"""A throwaway PostgreSQL server for benchmarks."""
+
+import logging
+import os
+import psycopg2
+import psycopg2.extensions
+import shutil
+import socket
+import subprocess
+import tempfile
+
+log = logging.getLogger(__name__)
+
+
+def find_bindir():
+    """Find the directory of the PostgreSQL programs using pg_config.
+
+    Returns None if pg_config is not available, in which case the
+    programs are expected to be on the PATH.
+    """
+    try:
+        out = subprocess.check_output(['pg_config', '--bindir'])
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.strip() or None
+
+
+def find_free_port():
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+    finally:
+        s.close()
+
+
+class TemporaryPostgreSQL(object):
+    """Runs a PostgreSQL server in a temporary directory.
+
+    The server listens only on a Unix socket in the temporary directory,
+    trusts local connections, and is deleted by stop().  Requires the
+    initdb and pg_ctl programs, found in bindir, through pg_config, or
+    on the PATH.
+    """
+
+    dbname = 'benchmark'
+    user = 'postgres'
+
+    def __init__(self, bindir=None, port=None, settings=None):
+        self.bindir = bindir or find_bindir()
+        self.port = port or find_free_port()
+        # Server settings, such as {'shared_buffers': '256MB'}
+        self.settings = dict(settings or {})
+        self.path = None
+
+    def _program(self, name):
+        if self.bindir:
+            return os.path.join(self.bindir, name)
+        return name
+
+    @property
+    def dsn(self):
+        return 'dbname=%s user=%s host=%s port=%d' % (
+            self.dbname, self.user, self.path, self.port)
+
+    def start(self):
+        self.path = tempfile.mkdtemp(prefix='pgtextindex-benchmark-')
+        datadir = os.path.join(self.path, 'data')
+        log.info("Creating a PostgreSQL server in %s", self.path)
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                [self._program('initdb'), '-D', datadir, '-U', self.user,
+                 '-A', 'trust', '-E', 'UTF8'],
+                stdout=devnull)
+        options = ["-p %d" % self.port, "-k %s" % self.path,
+                   "-c listen_addresses=''"]
+        for name, value in sorted(self.settings.items()):
+            options.append('-c %s=%s' % (name, value))
+        subprocess.check_call(
+            [self._program('pg_ctl'), '-D', datadir, '-w',
+             '-l', os.path.join(self.path, 'server.log'),
+             '-o', ' '.join(options), 'start'])
+
+        conn = psycopg2.connect(
+            dbname='postgres', user=self.user, host=self.path,
+            port=self.port)
+        try:
+            conn.set_isolation_level(
+                psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+            conn.cursor().execute('CREATE DATABASE %s' % self.dbname)
+        finally:
+            conn.close()
+
+    def stop(self):
+        if self.path is None:
+            return
+        try:
+            subprocess.call(
+                [self._program('pg_ctl'), '-D',
+                 os.path.join(self.path, 'data'), '-m', 'fast', '-w',
+                 'stop'])
+        finally:
+            shutil.rmtree(self.path, ignore_errors=True)
+            self.path = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
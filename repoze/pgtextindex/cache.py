@@ -0,0 +1,53 @@
+
+from collections import OrderedDict
+import threading
+
+_missing = object()
+
+
+class LRUCache(object):
+    """A thread safe cache that discards the least recently used entries.
+
+    The cache is limited by the number of entries and by the total
+    size of the entries, as reported when the entries are added.
+    """
+
+    def __init__(self, max_entries=1000, max_size=10000000):
+        self.max_entries = max_entries
+        self.max_size = max_size
+        self.size = 0
+        self._data = OrderedDict()  # {key: (value, size)}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Get a value and mark it as recently used."""
+        with self._lock:
+            item = self._data.pop(key, _missing)
+            if item is _missing:
+                return default
+            self._data[key] = item
+            return item[0]
+
+    def set(self, key, value, size):
+        """Add or replace a value."""
+        if size > self.max_size:
+            # Don't let one entry flush the whole cache.
+            return
+        with self._lock:
+            item = self._data.pop(key, _missing)
+            if item is not _missing:
+                self.size -= item[1]
+            self._data[key] = (value, size)
+            self.size += size
+            while (len(self._data) > self.max_entries or
+                    self.size > self.max_size):
+                _, (_, old_size) = self._data.popitem(last=False)
+                self.size -= old_size
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.size = 0
@@ -1,8 +1,15 @@
+from psycopg2.extensions import adapt
 
+from repoze.pgtextindex import metrics
 from transaction.interfaces import IDataManager
+from transaction.interfaces import TransientError
 from zope.interface import implements
+import logging
 import psycopg2.extensions
+import threading
+import time
 import transaction
+import weakref
 
 try:  # pragma: no cover
     from hashlib import md5
@@ -13,45 +20,403 @@ except ImportError:  # pragma: no cover
 # raised when the connection to the database has been broken.
 disconnected_exceptions = (psycopg2.OperationalError, psycopg2.InterfaceError)
 
+log = logging.getLogger(__name__)
+
+_pools = {}  # {dsn: ConnectionPool}
+_pools_lock = threading.Lock()
+
+
+class PoolTimeout(TransientError):
+    """No pooled connection became available in time."""
+
+
+class ConnectionPool(object):
+    """A bounded pool of PostgreSQL connections to one database.
+
+    Connection managers borrow a connection when a transaction first
+    needs one and return it when the transaction ends, so the number of
+    PostgreSQL backends is bounded by the pool size rather than by the
+    number of ZODB connections.  All the connection managers of a
+    transaction share one connection through lend(), so a transaction
+    that uses several indexes does not wait for a second connection
+    while holding the first.  If all connections are in use, get()
+    waits up to timeout seconds for one to be returned and then raises
+    PoolTimeout.
+    """
+
+    def __init__(self, dsn, size=10, timeout=30.0, module=psycopg2,
+                 pooler_safe=False):
+        self.dsn = dsn
+        self.size = size
+        self.timeout = timeout
+        self.module = module
+        self.pooler_safe = pooler_safe
+        self._idle = []  # [(connection, time returned)]
+        self._open = 0  # Number of connections, lent or idle
+        self._leases = {}  # {transaction: Lease}
+        self._cond = threading.Condition()
+
+    def get(self):
+        """Borrow a connection.
+
+        Returns (connection, last_used), where last_used is the time
+        the connection was last known to work.
+        """
+        start = time.time()
+        conn = None
+        self._cond.acquire()
+        try:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._open < self.size:
+                    self._open += 1
+                    break
+                remaining = start + self.timeout - time.time()
+                if remaining <= 0:
+                    metrics.incr('pool.timeout')
+                    raise PoolTimeout(
+                        'No PostgreSQL connection available after %s seconds'
+                        % self.timeout)
+                self._cond.wait(remaining)
+            self._report()
+        finally:
+            self._cond.release()
+
+        if conn is None:
+            try:
+                conn = connect(self.module, self.dsn, self.pooler_safe)
+            except:
+                self._forget()
+                raise
+            last_used = time.time()
+        metrics.timing('pool.wait', time.time() - start)
+        return conn, last_used
+
+    def put(self, conn):
+        """Return a borrowed connection."""
+        self._cond.acquire()
+        try:
+            self._idle.append((conn, time.time()))
+            self._cond.notify()
+            self._report()
+        finally:
+            self._cond.release()
+
+    def lend(self, key):
+        """Get the Lease shared by the connection managers of a transaction.
+
+        key identifies the transaction.  The connection is borrowed by
+        the first connection manager that needs it.  Each call must be
+        matched by a call to give_back().
+        """
+        self._cond.acquire()
+        try:
+            lease = self._leases.get(key)
+            if lease is None:
+                self._leases[key] = lease = Lease(key)
+            lease.borrowers += 1
+        finally:
+            self._cond.release()
+        return lease
+
+    def give_back(self, lease):
+        """Return a Lease, and its connection once all borrowers are done."""
+        self._cond.acquire()
+        try:
+            lease.borrowers -= 1
+            if lease.borrowers > 0:
+                return
+            del self._leases[lease.key]
+        finally:
+            self._cond.release()
+        if lease.connection is not None:
+            self.put(lease.connection)
+
+    def discard(self, conn):
+        """Close a borrowed connection instead of returning it."""
+        safe_close(conn)
+        self._forget()
+
+    def _forget(self):
+        self._cond.acquire()
+        try:
+            self._open -= 1
+            self._cond.notify()
+            self._report()
+        finally:
+            self._cond.release()
+
+    def _report(self):
+        metrics.gauge('pool.size', self._open)
+        metrics.gauge('pool.idle', len(self._idle))
+
+    def close_idle(self, idle_timeout):
+        """Close connections that have been idle for idle_timeout seconds.
+
+        Returns the number of connections closed.
+        """
+        cutoff = time.time() - idle_timeout
+        self._cond.acquire()
+        try:
+            keep = [item for item in self._idle if item[1] >= cutoff]
+            idle = [item for item in self._idle if item[1] < cutoff]
+            self._idle = keep
+            self._open -= len(idle)
+            if idle:
+                self._cond.notify(len(idle))
+                self._report()
+        finally:
+            self._cond.release()
+        for conn, last_used in idle:
+            safe_close(conn)
+        return len(idle)
+
+    def clear(self):
+        """Close the idle connections."""
+        self._cond.acquire()
+        try:
+            idle = self._idle
+            self._idle = []
+            self._open -= len(idle)
+            self._report()
+        finally:
+            self._cond.release()
+        for conn, last_used in idle:
+            safe_close(conn)
+
+
+class Lease(object):
+    """A connection and the state its connection managers share.
+
+    A connection manager without a pool keeps its own Lease for as
+    long as it lives.  Pooled connection managers share the Lease of
+    their transaction; see ConnectionPool.lend().
+    """
+
+    def __init__(self, key=None):
+        self.key = key
+        self.connection = None
+        self.last_used = 0  # Time the connection was last known to work
+        self.verified = False  # True once checked in this transaction
+        self.wrote = False  # True if a cursor may have changed data
+        self.borrowers = 0
+
+
+def get_pool(dsn, size=10, timeout=30.0, pooler_safe=False):
+    """Get the process-wide connection pool for a DSN.
+
+    The pool is created with the given options the first time it is
+    requested.
+    """
+    pool = _pools.get(dsn)
+    if pool is None:
+        _pools_lock.acquire()
+        try:
+            pool = _pools.get(dsn)
+            if pool is None:
+                _pools[dsn] = pool = ConnectionPool(
+                    dsn, size, timeout, pooler_safe=pooler_safe)
+        finally:
+            _pools_lock.release()
+    return pool
+
+
+def connect(module, dsn, pooler_safe=False):
+    """Open a connection.
+
+    In pooler-safe mode, no session state is set, since an external
+    pooler such as PgBouncer in transaction mode may run each
+    transaction on a different server connection.  The server default
+    isolation level, normally READ COMMITTED, applies instead.
+    """
+    conn = module.connect(dsn)
+    if not pooler_safe:
+        conn.set_isolation_level(
+            psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+    return conn
+
+
+class IdleReaper(object):
+    """Closes PostgreSQL connections that have not been used for a while.
+
+    Connection managers and pools register with the reaper, which
+    calls their close_idle() method from a daemon thread.  Closed
+    connections are reopened when they are next needed.
+    """
+
+    def __init__(self, interval=10.0):
+        self.interval = interval
+        self._targets = weakref.WeakKeyDictionary()  # {target: idle_timeout}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, target, idle_timeout):
+        self._lock.acquire()
+        try:
+            self._targets[target] = idle_timeout
+            if self._thread is None:
+                self._thread = t = threading.Thread(
+                    target=self._run, name='pgtextindex-reaper')
+                t.daemon = True
+                t.start()
+        finally:
+            self._lock.release()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reap()
+            except Exception:  # pragma: no cover
+                log.exception("Failed to close idle PostgreSQL connections")
+
+    def reap(self):
+        """Close the idle connections now.
+
+        Returns the number of connections closed.
+        """
+        self._lock.acquire()
+        try:
+            targets = self._targets.items()
+        finally:
+            self._lock.release()
+        closed = 0
+        for target, idle_timeout in targets:
+            closed += target.close_idle(idle_timeout)
+        if closed:
+            metrics.incr('reaper.closed', closed)
+        return closed
+
+
+reaper = IdleReaper()
+
 
 class PostgresConnectionManager(object):
     implements(IDataManager)
 
     def __init__(self, dsn, transaction_manager=transaction.manager,
-                 module=psycopg2):
+                 module=psycopg2, pool=None, ping_interval=0,
+                 idle_timeout=None, pooler_safe=False, write_settings=()):
         self.dsn = dsn
         self.transaction_manager = transaction_manager
         self.module = module
-        self._connection = None
+        self.pool = pool
+        # Skip the liveness check when joining a transaction if the
+        # connection worked within this many seconds.
+        self.ping_interval = ping_interval
+        # Avoid session state and the liveness check, for use behind
+        # PgBouncer in transaction pooling mode.
+        self.pooler_safe = pooler_safe
+        # (name, value) settings made when a transaction starts to write.
+        self.write_settings = tuple(write_settings)
+        # Pooled connection managers get a Lease when they join.
+        self._lease = Lease() if pool is None else None
         self._cursor = None
         self._sort_key = md5(self.dsn).hexdigest()
         self._joined = False
+        self._wrote = False  # True if this manager's cursor was used
+        self._lock = threading.Lock()  # Guards closing by the reaper
+        if idle_timeout:
+            # Connections of pooled connection managers are idle in
+            # the pool between transactions.
+            reaper.add(pool if pool is not None else self, idle_timeout)
 
     @property
     def connection(self):
-        c = self._connection
+        # Join before using the connection, so the reaper leaves it open.
+        # A pooled connection is borrowed until the transaction ends.
+        self._join()
+        lease = self._lease
+        c = lease.connection
         if c is None:
-            c = self.module.connect(self.dsn)
-            c.set_isolation_level(
-                psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
-            self._connection = c
+            if self.pool is not None:
+                c, lease.last_used = self.pool.get()
+            else:
+                c = connect(self.module, self.dsn, self.pooler_safe)
+                lease.last_used = time.time()
+            lease.connection = c
         return c
 
+    @property
+    def _connection(self):
+        lease = self._lease
+        return lease.connection if lease is not None else None
+
+    def _join(self):
+        if not self._joined:
+            self._lock.acquire()
+            try:
+                txn = self.transaction_manager.get()
+                txn.join(self)
+                self._joined = True
+                if self.pool is not None:
+                    self._lease = self.pool.lend(txn)
+            finally:
+                self._lock.release()
+
     @property
     def cursor(self):
+        # The caller might write, so use a real transaction and don't
+        # retry reads in this transaction.
+        wrote = self._wrote
+        self._wrote = True
+        self._set_autocommit(False)
+        self._lease.wrote = True
+        u = self._get_cursor()
+        if not wrote and self.write_settings:
+            u.execute(set_local_sql(self.write_settings))
+        return u
+
+    @property
+    def read_cursor(self):
+        """Get a cursor for statements that only read.
+
+        Unlike cursor, this keeps the connection in autocommit mode
+        until something uses cursor in this transaction, including the
+        cursor of another connection manager sharing the connection
+        through a pool.  It joins the
+        transaction of the calling thread, so execute_read() can then be
+        called from another thread.
+        """
+        self._join()
+        if not self._lease.wrote:
+            self._set_autocommit(True)
+        return self._get_cursor()
+
+    def _set_autocommit(self, autocommit):
+        c = self.connection
+        if getattr(c, 'autocommit', False) != autocommit:
+            c.autocommit = autocommit
+
+    def _get_cursor(self):
+        # Join before using the cursor, so the reaper leaves it open.
+        self._join()
+        lease = self._lease
         u = self._cursor
-        if u is None:
+        if u is None or u.connection is not lease.connection:
+            # Another connection manager may have replaced the
+            # connection it shares with this one.
             u = self.connection.cursor()
             self._cursor = u
 
-        if not self._joined:
-            self.transaction_manager.get().join(self)
-            self._joined = True
+        if not lease.verified:
+            lease.verified = True
+            if self.pooler_safe:
+                # The pooler checks its server connections, and a ping
+                # would not check the server connection used next.
+                return u
+            if time.time() - lease.last_used < self.ping_interval:
+                # The connection worked recently and was left idle by
+                # the commit or rollback of the previous transaction.
+                return u
             # Bring the connection up to date.
             try:
                 self.connection.rollback()
                 u.execute('SELECT 1')
                 u.fetchall()
+                lease.last_used = time.time()
             except disconnected_exceptions:
                 # Try to reopen.
                 self.close()
@@ -60,25 +425,104 @@ class PostgresConnectionManager(object):
 
         return u
 
+    def execute_read(self, stmt, params=None, settings=(), timings=None):
+        """Execute a statement that only reads and return all rows.
+
+        Until something else uses the cursor in this transaction, reads
+        run in autocommit mode, so the connection does not sit idle in
+        a transaction and the end of the transaction needs no COMMIT or
+        ROLLBACK.  If the connection turns out to be broken, it is
+        reopened and the statement is retried once.  Errors such as
+        statement timeouts and deadlocks are not retried.
+
+        settings is a sequence of (name, value) that apply only to the
+        statement, and timings receives the time spent.  See read_rows().
+        """
+        u = self.read_cursor
+        try:
+            return read_rows(u, stmt, params, settings, self._autocommit(),
+                             timings)
+        except disconnected_exceptions as e:
+            if self._lease.wrote or not self._is_broken(e):
+                raise
+            log.warning("Reconnecting to PostgreSQL after a disconnect: %s",
+                        e)
+            metrics.incr('reconnect')
+            self.close()
+            u = self.read_cursor
+            return read_rows(u, stmt, params, settings, self._autocommit(),
+                             timings)
+
+    def _autocommit(self):
+        return bool(getattr(self.connection, 'autocommit', False))
+
+    def _is_broken(self, error):
+        """Return true if an error means the connection is unusable."""
+        if isinstance(error, psycopg2.InterfaceError):
+            return True
+        c = self._connection
+        return c is None or bool(getattr(c, 'closed', 0))
+
     def close(self):
         if self._cursor is not None:
             safe_close(self._cursor)
             self._cursor = None
-        if self._connection is not None:
-            safe_close(self._connection)
-            self._connection = None
+        lease = self._lease
+        if lease is not None and lease.connection is not None:
+            if self.pool is not None:
+                self.pool.discard(lease.connection)
+            else:
+                safe_close(lease.connection)
+            lease.connection = None
+
+    def close_idle(self, idle_timeout):
+        """Close the connection if it has been idle for idle_timeout seconds.
+
+        Returns the number of connections closed.
+        """
+        self._lock.acquire()
+        try:
+            if self._joined or self._connection is None:
+                return 0
+            if time.time() - self._lease.last_used < idle_timeout:
+                return 0
+            self.close()
+            return 1
+        finally:
+            self._lock.release()
+
+    def _end(self):
+        """Reset at the end of a transaction."""
+        lease = self._lease
+        self._joined = False
+        self._wrote = False
+        if lease is None:
+            return
+        if lease.connection is not None:
+            # The commit or rollback worked.
+            lease.last_used = time.time()
+        if self.pool is not None:
+            # Return the connection to the pool once the other
+            # connection managers of the transaction are done with it.
+            safe_close(self._cursor)
+            self._cursor = None
+            self._lease = None
+            self.pool.give_back(lease)
+        else:
+            lease.verified = False
+            lease.wrote = False
 
     def abort(self, transaction):
         try:
             c = self._connection
-            if c is not None:
+            if c is not None and not getattr(c, 'autocommit', False):
                 try:
                     c.rollback()
                 except:
                     self.close()
                     raise
         finally:
-            self._joined = False
+            self._end()
 
     def tpc_begin(self, transaction):
         pass
@@ -93,7 +537,7 @@ class PostgresConnectionManager(object):
     def tpc_finish(self, transaction):
         try:
             c = self._connection
-            if c is not None:
+            if c is not None and not getattr(c, 'autocommit', False):
                 try:
                     c.commit()
                 except:
@@ -106,7 +550,7 @@ class PostgresConnectionManager(object):
                         self.close()
                     raise
         finally:
-            self._joined = False
+            self._end()
 
     def tpc_abort(self, transaction):
         self.abort(transaction)
@@ -134,3 +578,62 @@ def safe_close(obj):
             obj.close()
         except disconnected_exceptions:
             pass
+
+
+def read_rows(cursor, stmt, params=None, settings=(), autocommit=False,
+              timings=None):
+    """Execute a statement that only reads and return all rows.
+
+    settings is a sequence of (name, value) pairs, such as
+    ('statement_timeout', 500), that apply only to the statement.  The
+    settings are made with SET LOCAL, which also works behind a pooler
+    in transaction mode.  In autocommit mode, the statements of a
+    single query string form one implicit transaction.  Otherwise a
+    savepoint confines the settings (and the aborted state after an
+    error such as a statement timeout) to the statement.
+
+    timings, if provided, is a dict that receives the seconds spent
+    executing the statement ('execute') and fetching the rows ('fetch').
+    """
+    if settings:
+        stmt = set_local_sql(settings) + stmt
+    if not settings or autocommit:
+        return _execute_fetch(cursor, stmt, params, timings)
+
+    done = False
+    try:
+        rows = _execute_fetch(
+            cursor, 'SAVEPOINT pgtextindex_read;\n' + stmt, params, timings)
+        done = True
+    finally:
+        # Rolling back to the savepoint is harmless because the statement
+        # only read, and it restores the previous settings.
+        rollback = ('ROLLBACK TO SAVEPOINT pgtextindex_read;\n'
+                    'RELEASE SAVEPOINT pgtextindex_read')
+        if done:
+            cursor.execute(rollback)
+        else:
+            try:
+                cursor.execute(rollback)
+            except psycopg2.Error:
+                # Let the original error propagate.
+                pass
+    return rows
+
+
+def _execute_fetch(cursor, stmt, params, timings):
+    start = time.time()
+    cursor.execute(stmt, params)
+    fetch_start = time.time()
+    rows = cursor.fetchall()
+    if timings is not None:
+        timings['execute'] = fetch_start - start
+        timings['fetch'] = time.time() - fetch_start
+    return rows
+
+
+def set_local_sql(settings):
+    """Generate SET LOCAL statements for a sequence of (name, value)."""
+    return ''.join(
+        'SET LOCAL %s = %s;\n' % (name, adapt(value).getquoted())
+        for (name, value) in settings)
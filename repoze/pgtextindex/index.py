@@ -2,31 +2,90 @@
 from perfmetrics import metricmethod
 from persistent import Persistent
 from repoze.catalog.interfaces import ICatalogIndex
+from repoze.pgtextindex import metrics
+from repoze.pgtextindex.cache import LRUCache
 from repoze.pgtextindex.db import PostgresConnectionManager
+from repoze.pgtextindex.db import disconnected_exceptions
+from repoze.pgtextindex.db import get_pool
+from repoze.pgtextindex.db import read_rows
 from repoze.pgtextindex.interfaces import IWeightedQuery
 from repoze.pgtextindex.interfaces import IWeightedText
 from repoze.pgtextindex.queryconvert import convert_query
+from repoze.pgtextindex.summarizer import Summarizer
 from zope.index.interfaces import IIndexSort
 from zope.interface import implements
 import BTrees
 import logging
 import psycopg2
+import psycopg2.extensions
 import random
+import re
 import thread
+import threading
 import time
+import transaction
+
+try:  # pragma: no cover
+    from hashlib import md5
+except ImportError:  # pragma: no cover
+    from md5 import new as md5
 
 _missing = object()
 log = logging.getLogger(__name__)
 
+_summary_caches = {}  # {(max_entries, max_size): LRUCache}
+_summary_caches_lock = threading.Lock()
+
+_replica_status = {}  # {dsn: (expiration time, usable)}
+
+# Names of PostgreSQL settings, including custom settings such as
+# pg_trgm.similarity_threshold.
+_setting_name_re = re.compile(r'^[A-Za-z_]\w*(\.[A-Za-z_]\w*)?\Z')
+
+# Estimates how many seconds a streaming replica is behind the primary.
+# NULL means the server is not replaying WAL.
+_replica_lag_sql = """
+SELECT extract(epoch FROM now() - pg_last_xact_replay_timestamp())
+"""
+
 
 class PGTextIndex(Persistent):
     implements(ICatalogIndex, IIndexSort)
 
     family = BTrees.family32
     connection_manager_factory = PostgresConnectionManager
+    summarizer_factory = Summarizer
     _v_temp_cm = None  # A PostgresConnectionManager used during initialization
+    _v_summarizer = None  # A Summarizer used when local_summaries is true
+    _v_temp_read_cms = None  # Read connection managers before storage
+    _v_server_version = None  # The PostgreSQL version, once known
+    _v_read_choice = None  # (transaction, read connection manager)
     maxlen = 1048575
     max_ranked = 6000
+    phrase_search = None  # None means use <-> when PostgreSQL supports it
+    fields = None  # Map of query field names to text weight labels
+    partition_by = None  # None, 'docid', or 'marker'
+    partitions = None  # Number of docid partitions or list of marker values
+    rank_maxlen = None  # If set, rank using a rank_vector of bounded size
+    store_text = False  # If true, store the default text in source_text
+    local_summaries = False  # If true, produce summaries using a Summarizer
+    summary_cache_entries = 0  # Max cached summaries; 0 disables the cache
+    summary_cache_size = 10000000  # Max total characters of cached summaries
+    read_dsns = ()  # DSNs of read replicas used for queries
+    max_replica_lag = None  # Max seconds a replica may lag, or None
+    replica_check_interval = 10  # Seconds to remember the state of a replica
+    pool_size = None  # Max connections per DSN per process, or None
+    pool_timeout = 30.0  # Seconds to wait for a pooled connection
+    ping_interval = None  # Skip the join ping if used within this many secs
+    idle_timeout = None  # Close connections idle for this many seconds
+    pooler_safe = False  # If true, avoid session state for PgBouncer
+    statement_timeout = None  # Max milliseconds for a text query, or None
+    degraded_limit = 1000  # Max results of a query retried after a timeout
+    approximate_limit = 5000  # gin_fuzzy_search_limit of approximate queries
+    read_settings = None  # {name: value} set locally for queries
+    write_settings = None  # {name: value} set locally when writing
+    slow_query_threshold = None  # Log queries that take this many seconds
+    explain_rate = 0  # Fraction of slow queries to log an EXPLAIN for
 
     def __init__(self,
                  discriminator,
@@ -36,6 +95,29 @@ class PGTextIndex(Persistent):
                  connection_manager_factory=None,
                  drop_and_create=False,
                  maxlen=1048575,
+                 phrase_search=None,
+                 fields=None,
+                 partition_by=None,
+                 partitions=None,
+                 rank_maxlen=None,
+                 store_text=False,
+                 local_summaries=False,
+                 summary_cache_entries=0,
+                 summary_cache_size=10000000,
+                 read_dsns=(),
+                 max_replica_lag=None,
+                 pool_size=None,
+                 pool_timeout=30.0,
+                 ping_interval=None,
+                 idle_timeout=None,
+                 pooler_safe=False,
+                 statement_timeout=None,
+                 degraded_limit=1000,
+                 approximate_limit=5000,
+                 read_settings=None,
+                 write_settings=None,
+                 slow_query_threshold=None,
+                 explain_rate=0,
                  ):
 
         if not callable(discriminator):
@@ -48,6 +130,47 @@ class PGTextIndex(Persistent):
         self._subs = dict(table=table)  # map of query string substitutions
         self.ts_config = ts_config
         self.maxlen = maxlen
+        self.phrase_search = phrase_search
+        if fields:
+            for weights in fields.values():
+                if not weights or set(weights) - set('ABCD'):
+                    raise ValueError('field weights must be a string '
+                                     'of the weight labels A, B, C, and D')
+            self.fields = dict(fields)
+        if partition_by == 'docid':
+            if not isinstance(partitions, int) or partitions < 1:
+                raise ValueError('partitioning by docid requires a positive '
+                                 'number of partitions')
+        elif partition_by == 'marker':
+            if partitions is None or isinstance(partitions, basestring):
+                raise ValueError('partitioning by marker requires a '
+                                 'sequence of marker values')
+            partitions = list(partitions)
+        elif partition_by is not None:
+            raise ValueError("partition_by must be None, 'docid', or 'marker'")
+        self.partition_by = partition_by
+        self.partitions = partitions
+        self.rank_maxlen = rank_maxlen
+        self.store_text = store_text
+        self.local_summaries = local_summaries
+        self.summary_cache_entries = summary_cache_entries
+        self.summary_cache_size = summary_cache_size
+        if isinstance(read_dsns, basestring):
+            read_dsns = [read_dsns]
+        self.read_dsns = tuple(read_dsns)
+        self.max_replica_lag = max_replica_lag
+        self.pool_size = pool_size
+        self.pool_timeout = pool_timeout
+        self.ping_interval = ping_interval
+        self.idle_timeout = idle_timeout
+        self.pooler_safe = pooler_safe
+        self.statement_timeout = statement_timeout
+        self.degraded_limit = degraded_limit
+        self.approximate_limit = approximate_limit
+        self.read_settings = _check_settings(read_settings)
+        self.write_settings = _check_settings(write_settings)
+        self.slow_query_threshold = slow_query_threshold
+        self.explain_rate = explain_rate
         if connection_manager_factory is not None:
             self.connection_manager_factory = connection_manager_factory
         if drop_and_create:
@@ -62,49 +185,210 @@ class PGTextIndex(Persistent):
             # Not yet stored in ZODB, so use _v_temp_cm
             cm = self._v_temp_cm
             if cm is None or cm.dsn != self.dsn:
-                cm = self.connection_manager_factory(self.dsn)
+                cm = self._make_connection_manager(self.dsn)
                 self._v_temp_cm = cm
 
         else:
-            fc = getattr(jar, 'foreign_connections', None)
-            if fc is None:
-                jar.foreign_connections = fc = {}
-                _mp_release_resources(jar)
-
+            fc = self._get_foreign_connections(jar)
             cm = fc.get(oid)
             if cm is None or cm.dsn != self.dsn:
-                cm = self.connection_manager_factory(self.dsn)
+                cm = self._make_connection_manager(self.dsn)
                 fc[oid] = cm
                 self._v_temp_cm = None
 
         return cm
 
+    def _make_connection_manager(self, dsn):
+        """Create a connection manager for a DSN.
+
+        Only passes the connection options that are configured, so that
+        custom connection manager factories need not accept them.
+        """
+        kw = {}
+        if self.pool_size:
+            kw['pool'] = get_pool(dsn, self.pool_size, self.pool_timeout,
+                                  pooler_safe=self.pooler_safe)
+        if self.ping_interval:
+            kw['ping_interval'] = self.ping_interval
+        if self.idle_timeout:
+            kw['idle_timeout'] = self.idle_timeout
+        if self.pooler_safe:
+            kw['pooler_safe'] = True
+        if self.write_settings:
+            kw['write_settings'] = sorted(self.write_settings.items())
+        return self.connection_manager_factory(dsn, **kw)
+
+    def _get_foreign_connections(self, jar):
+        fc = getattr(jar, 'foreign_connections', None)
+        if fc is None:
+            jar.foreign_connections = fc = {}
+            _mp_release_resources(jar)
+        return fc
+
+    def _get_read_connection_managers(self):
+        """Get a connection manager for each of the read_dsns."""
+        jar = self._p_jar
+        oid = self._p_oid
+
+        if jar is None or oid is None:
+            # Not yet stored in ZODB, so use _v_temp_read_cms
+            cms = self._v_temp_read_cms
+            if cms is None:
+                self._v_temp_read_cms = cms = {}
+        else:
+            cms = self._get_foreign_connections(jar)
+
+        res = []
+        for dsn in self.read_dsns:
+            key = (oid, dsn)
+            cm = cms.get(key)
+            if cm is None:
+                cm = self._make_connection_manager(dsn)
+                cms[key] = cm
+            res.append(cm)
+        return res
+
+    @property
+    def read_connection_manager(self):
+        """Get the connection manager for queries that only read.
+
+        Uses one of the read_dsns when a replica is reachable and, if
+        max_replica_lag is set, not lagging too far behind.  Falls back
+        to the primary otherwise, and also when the current transaction
+        has already used the primary, so that a transaction can read
+        its own changes.
+        """
+        cm = self.connection_manager
+        if not self.read_dsns or getattr(cm, '_joined', False):
+            return cm
+
+        txn = getattr(cm, 'transaction_manager', transaction.manager).get()
+        choice = self._v_read_choice
+        if choice is not None and choice[0] is txn:
+            # Keep using the replica chosen for this transaction.  The
+            # replicas rejected by _replica_usable() may have joined
+            # the transaction too, so don't look for joined replicas.
+            return choice[1]
+
+        # Spread the load over the replicas.
+        read_cms = self._get_read_connection_managers()
+        for read_cm in random.sample(read_cms, len(read_cms)):
+            if self._replica_usable(read_cm):
+                self._v_read_choice = (txn, read_cm)
+                return read_cm
+
+        metrics.incr('replica.fallback')
+        return cm
+
+    def _replica_usable(self, cm):
+        """Return true if queries can be sent to a replica.
+
+        The state of each replica is remembered for
+        replica_check_interval seconds, so an unavailable replica is
+        not contacted for every query and the lag is not checked for
+        every transaction.
+        """
+        now = time.time()
+        status = _replica_status.get(cm.dsn)
+        if status is not None and now < status[0] and not status[1]:
+            return False
+
+        try:
+            cm.connection  # Connect if necessary
+            if status is not None and now < status[0]:
+                return True
+            usable = True
+            if self.max_replica_lag is not None:
+                lag = self._read(_replica_lag_sql, cm=cm)[0][0]
+                if lag is not None and lag > self.max_replica_lag:
+                    log.warning("Read replica is %.1f seconds behind; "
+                                "using the primary", lag)
+                    usable = False
+        except disconnected_exceptions:
+            log.warning("Read replica is unavailable; using the primary",
+                        exc_info=True)
+            cm.close()
+            usable = False
+
+        _replica_status[cm.dsn] = (now + self.replica_check_interval, usable)
+        return usable
+
     def drop_and_create(self):
         cm = self.connection_manager
         conn = cm.connection
         cursor = cm.cursor
         try:
             # Create the table.
-            stmt = """
-            DROP TABLE IF EXISTS %(table)s;
-
-            CREATE TABLE %(table)s (
-                docid INTEGER NOT NULL PRIMARY KEY,
-                coefficient REAL NOT NULL DEFAULT 1.0,
-                marker CHARACTER VARYING ARRAY,
-                text_vector tsvector
-            );
-
-            CREATE INDEX %(table)s_index
-                ON %(table)s
-                USING gin(text_vector)
-            """ % self._subs
-            cursor.execute(stmt)
+            stmt, params = self._create_table_sql()
+            cursor.execute(stmt, params)
 
             conn.commit()
         finally:
             cm.close()
 
+    def _create_table_sql(self):
+        """Generate the statement and parameters that create the table."""
+        kw = dict(self._subs)
+        kw['primary_key'] = ' PRIMARY KEY'
+        kw['partition_by'] = ''
+        kw['columns'] = ''
+        if self.rank_maxlen is not None:
+            kw['columns'] += ',\n            rank_vector tsvector'
+        if self.store_text:
+            # PostgreSQL compresses large text values automatically.
+            kw['columns'] += ',\n            source_text text'
+        params = []
+        partitions = []
+
+        if self.partition_by == 'docid':
+            kw['partition_by'] = ' PARTITION BY HASH (docid)'
+            for i in range(self.partitions):
+                partitions.append(
+                    "CREATE TABLE %s_p%d PARTITION OF %s "
+                    "FOR VALUES WITH (MODULUS %d, REMAINDER %d);"
+                    % (self.table, i, self.table, self.partitions, i))
+
+        elif self.partition_by == 'marker':
+            # Documents are stored in the partition of their first marker.
+            # The primary key of a partitioned table must include the
+            # partition key, so docids get a non-unique index instead.
+            kw['primary_key'] = ''
+            kw['partition_by'] = ' PARTITION BY LIST ((marker[1]))'
+            for i, value in enumerate(self.partitions):
+                partitions.append(
+                    "CREATE TABLE %s_p%d PARTITION OF %s "
+                    "FOR VALUES IN (%%s);" % (self.table, i, self.table))
+                params.append(value)
+            partitions.append(
+                "CREATE TABLE %(table)s_default PARTITION OF %(table)s "
+                "DEFAULT;" % kw)
+            partitions.append(
+                "CREATE INDEX %(table)s_docid_index ON %(table)s (docid);"
+                % kw)
+
+        kw['partitions'] = '\n'.join(partitions)
+        stmt = """
+        DROP TABLE IF EXISTS %(table)s;
+
+        CREATE TABLE %(table)s (
+            docid INTEGER NOT NULL%(primary_key)s,
+            coefficient REAL NOT NULL DEFAULT 1.0,
+            marker CHARACTER VARYING ARRAY,
+            text_vector tsvector%(columns)s
+        )%(partition_by)s;
+
+        %(partitions)s
+
+        CREATE INDEX %(table)s_index
+            ON %(table)s
+            USING gin(text_vector);
+
+        CREATE INDEX %(table)s_marker_index
+            ON %(table)s
+            USING gin(marker)
+        """ % kw
+        return stmt, tuple(params) or None
+
     @property
     def cursor(self):
         return self.connection_manager.cursor
@@ -113,6 +397,57 @@ class PGTextIndex(Persistent):
     def connection(self):
         return self.connection_manager.connection
 
+    @property
+    def read_connection(self):
+        return self.read_connection_manager.connection
+
+    def _scatter_read(self, stmt, params=None, settings=(),
+                      primary=False):
+        """Read rows from every table that holds documents.
+
+        PGTextIndex keeps all documents in one table, so this is the
+        same as _read(), but a sharded index reads from every shard.
+        If primary is true, read replicas are not used.
+        """
+        cm = None
+        if primary:
+            cm = self.connection_manager
+        return self._read(stmt, params, cm=cm, settings=settings)
+
+    def _read(self, stmt, params=None, cm=None, settings=(), timings=None):
+        """Execute a statement that only reads and return all rows.
+
+        Uses the execute_read() method of the connection manager, if
+        available, which retries once if the connection was broken.
+        settings is a sequence of (name, value) that apply only to the
+        statement.  timings, if provided, is a dict that receives the
+        time spent executing and fetching.
+        """
+        if cm is None:
+            cm = self.read_connection_manager
+        settings = self._read_settings(settings)
+        execute_read = getattr(cm, 'execute_read', None)
+        if execute_read is not None:
+            kw = {}
+            if settings:
+                kw['settings'] = settings
+            if timings is not None:
+                kw['timings'] = timings
+            return execute_read(stmt, params, **kw)
+        cursor = cm.cursor
+        autocommit = getattr(cm.connection, 'autocommit', False)
+        return read_rows(
+            cursor, stmt, params, settings, autocommit, timings)
+
+    def _read_settings(self, settings=()):
+        """Add the read_settings to a sequence of (name, value) settings.
+
+        Settings in the sequence take precedence over read_settings.
+        """
+        if not self.read_settings:
+            return settings
+        return sorted(self.read_settings.items()) + list(settings)
+
     @metricmethod
     def index_doc(self, docid, obj):
         """Add a document to the index.
@@ -156,74 +491,144 @@ class PGTextIndex(Persistent):
             kw = {'default': ' '.join(value[len(abc):])}
             value = SimpleWeightedText(*abc, **kw)
 
-        clauses = []
+        texts = []  # [(text, weight)]
+        source_text = ''
         if IWeightedText.providedBy(value):
             coefficient = getattr(value, 'coefficient', 1.0)
             marker = getattr(value, 'marker', [])
             if isinstance(marker, basestring):
                 marker = [marker]
+            if self.partition_by == 'marker' and len(set(marker)) > 1:
+                # Marker filters use the first marker to skip partitions,
+                # which matches only if documents have a single marker.
+                raise ValueError(
+                    "Documents of an index partitioned by marker must "
+                    "not have more than one marker: %r" % (marker,))
             params = [coefficient, marker]
             text = '%s' % value  # Call the __str__() method
             if text:
-                clauses.append('to_tsvector(%s, %s)')
-                params.extend([self.ts_config,
-                               _truncate(text, self.maxlen)])
+                texts.append((text, None))
+                source_text = text
             for weight in ('A', 'B', 'C'):
                 text = getattr(value, weight, None)
                 if text:
-                    clauses.append('setweight(to_tsvector(%s, %s), %s)')
-                    params.extend([self.ts_config,
-                                   _truncate('%s' % text, self.maxlen),
-                                   weight])
+                    texts.append(('%s' % text, weight))
 
         else:
             # The value is a simple string.  Strings can not
             # influence the weighting.
             params = [1.0, []]
             if value:
-                clauses.append('to_tsvector(%s, %s)')
-                params.extend([self.ts_config,
-                               _truncate('%s' % value, self.maxlen)])
-
-        if len(params) > 2:
-            self._upsert(docid, params, ' || '.join(clauses))
+                source_text = '%s' % value
+                texts.append((source_text, None))
+
+        if texts:
+            clause, vector_params = self._vector_sql(texts, self.maxlen)
+            columns = []
+            if self.rank_maxlen is not None:
+                # Keep the weighted texts, but only the start of the
+                # default text, which is usually the long one.
+                rank_texts = [
+                    (_truncate(text, self.rank_maxlen) if not weight
+                     else text, weight)
+                    for (text, weight) in texts]
+                rank_clause, rank_params = self._vector_sql(
+                    rank_texts, self.maxlen)
+                columns.append(('rank_vector', rank_clause, rank_params))
+            if self.store_text:
+                columns.append(('source_text', '%s',
+                                [_truncate(source_text, self.maxlen)]))
+            self._upsert(docid, params + vector_params, clause, columns)
         else:
             self._index_null(docid)
 
     reindex_doc = index_doc
 
-    def _index_null(self, docid):
-        self._upsert(docid, ('0.0', []), 'null')
+    def _vector_sql(self, texts, maxlen):
+        """Generate the SQL clause and parameters for a tsvector.
+
+        texts is a list of (text, weight) pairs, where weight is None
+        for the default weight.  Each text is truncated to maxlen.
+        """
+        clauses = []
+        params = []
+        for text, weight in texts:
+            if weight:
+                clauses.append('setweight(to_tsvector(%s, %s), %s)')
+                params.extend([self.ts_config, _truncate(text, maxlen),
+                               weight])
+            else:
+                clauses.append('to_tsvector(%s, %s)')
+                params.extend([self.ts_config, _truncate(text, maxlen)])
+        return ' || '.join(clauses), params
 
-    def _upsert(self, docid, params, text_vector_clause):
-        """Update or insert a row in the index."""
+    def _index_null(self, docid):
+        columns = []
+        if self.rank_maxlen is not None:
+            columns.append(('rank_vector', 'null', ()))
+        if self.store_text:
+            columns.append(('source_text', 'null', ()))
+        self._upsert(docid, ('0.0', []), 'null', columns)
+
+    def _upsert(self, docid, params, text_vector_clause, columns=()):
+        """Update or insert a row in the index.
+
+        columns is a sequence of (column name, clause, params) for
+        optional columns.
+        """
         cursor = self.cursor
-        kw = {'table': self.table, 'clause': text_vector_clause}
+        kw = {
+            'table': self.table,
+            'clause': text_vector_clause,
+            'set_columns': ''.join(
+                ',\n                %s=%s' % (name, clause)
+                for (name, clause, _) in columns),
+            'names': ', '.join(
+                ['text_vector'] + [name for (name, _, _) in columns]),
+            'values': ', '.join(
+                [text_vector_clause] +
+                [clause for (_, clause, _) in columns]),
+        }
+        params = tuple(params)
+        for (_, _, column_params) in columns:
+            params += tuple(column_params)
         for attempt in (1, 2, 3):
             stmt = """
             UPDATE %(table)s SET
                 coefficient=%%s,
                 marker=%%s,
-                text_vector=%(clause)s
+                text_vector=%(clause)s%(set_columns)s
             WHERE docid=%%s
             """ % kw
-            cursor.execute(stmt, tuple(params) + (docid,))
+            cursor.execute(stmt, params + (docid,))
             if cursor.rowcount:
                 # Success.
                 return
 
+            if self.partition_by == 'marker':
+                # The table can not enforce unique docids, so serialize
+                # the insertion of this docid, then look for it again.
+                cursor.execute(
+                    "SELECT pg_advisory_xact_lock(hashtext(%s), %s)",
+                    (self.table, docid))
+                cursor.execute(stmt, params + (docid,))
+                if cursor.rowcount:
+                    # Success.
+                    return
+
             stmt = """
             SAVEPOINT pgtextindex_upsert;
-            INSERT INTO %(table)s (docid, coefficient, marker, text_vector)
-            VALUES (%%s, %%s, %%s, %(clause)s)
+            INSERT INTO %(table)s (docid, coefficient, marker, %(names)s)
+            VALUES (%%s, %%s, %%s, %(values)s)
             """ % kw
             try:
-                cursor.execute(stmt, (docid,) + tuple(params))
+                cursor.execute(stmt, (docid,) + params)
             except psycopg2.IntegrityError:
                 # Another thread is working in parallel.
                 # Wait a moment and try again.
                 if attempt >= 3:
                     raise
+                metrics.incr('upsert.retry')
                 log.warning("Concurrent upsert on docid %s "
                             "in thread %s; retrying. (attempt %d)",
                             docid, thread.get_ident(), attempt)
@@ -256,8 +661,270 @@ class PGTextIndex(Persistent):
         stmt = "DELETE FROM %(table)s" % self._subs
         self.cursor.execute(stmt)
 
+    def _convert_query(self, query):
+        """Convert a query to the PostgreSQL tsquery syntax."""
+        return convert_query(
+            query, phrase=self._phrase_supported(), fields=self.fields)
+
+    def _phrase_supported(self):
+        """Return true if phrases should use the followed-by operator."""
+        phrase_search = self.phrase_search
+        if phrase_search is None:
+            # The <-> operator was added in PostgreSQL 9.6.
+            version = self._v_server_version
+            if version is None:
+                version = getattr(self.read_connection, 'server_version', 0)
+                self._v_server_version = version
+            phrase_search = version >= 90600
+        return phrase_search
+
     @metricmethod
     def _run_query(self, query, invert=False, docids=None):
+        stats = {}
+        cache, cache_key = self._get_cache(query, invert, docids)
+        if cache is not None:
+            result = cache.get(cache_key)
+            if result is not None:
+                # Cache hit.
+                stats['cache'] = 'hit'
+                stats['rows'] = len(result)
+                self._report_stats(query, stats)
+                return result
+            stats['cache'] = 'miss'
+
+        query_start = start = time.time()
+        tsquery = self._tsquery(query)
+        stats['convert'] = time.time() - start
+        stmt, params = self._query_sql(query, invert, docids, tsquery)
+        settings = self._query_settings(query)
+        try:
+            rows = self._read(stmt, params, settings=settings, timings=stats)
+        except psycopg2.extensions.QueryCanceledError as e:
+            self._degrade([query], e)
+            stmt, params = self._unranked_query_sql(
+                query, invert, docids, tsquery)
+            rows = self._read(stmt, params, settings=settings, timings=stats)
+            stats['degraded'] = True
+            cache = None
+        if self._is_approximate(query):
+            query.approximate_result = True
+        start = time.time()
+        result = self.family.IF.BTree()
+        result.update(rows)
+        stats['btree'] = time.time() - start
+        stats['rows'] = len(rows)
+        stats['ranking_skipped'] = (
+            stats.get('degraded') or self._ranking_skipped(query, rows))
+
+        if cache is not None:
+            cache[cache_key] = result
+
+        self._report_stats(query, stats)
+        if self.slow_query_threshold is not None:
+            self._check_slow(
+                'text query', query_start, query, len(rows),
+                'params %r, docids %s' % (params, _summarize_docids(docids)),
+                stmt, params, settings, explain=not stats.get('degraded'))
+        return result
+
+    def _check_slow(self, kind, start, query, row_count, detail, stmt=None,
+                    params=None, settings=(), explain=True, read=None):
+        """Log a statement that took at least slow_query_threshold seconds.
+
+        start is the time the work began.  If stmt is provided, the
+        fraction of slow statements given by explain_rate are run again
+        with EXPLAIN (ANALYZE, BUFFERS) and the plan is logged.  read is
+        the method that runs the EXPLAIN, defaulting to _read().
+        """
+        threshold = self.slow_query_threshold
+        if threshold is None:
+            return
+        elapsed = time.time() - start
+        if elapsed < threshold:
+            return
+        metrics.incr('slow_query')
+        log.warning("Slow %s took %.3f seconds and produced %d rows: "
+                    "query %r, %s", kind, elapsed, row_count, query, detail)
+        if (stmt is None or not explain or not self.explain_rate or
+                random.random() >= self.explain_rate):
+            return
+        if read is None:
+            read = self._read
+        try:
+            rows = read('EXPLAIN (ANALYZE, BUFFERS)' + stmt, params,
+                        settings=settings)
+        except psycopg2.Error as e:
+            log.warning("Unable to explain the slow %s: %s", kind, e)
+            return
+        log.warning("Plan of the slow %s:\n%s",
+                    kind, '\n'.join(row[0] for row in rows))
+
+    def _ranking_skipped(self, query, rows):
+        """Return true if max_ranked disabled ranking for a query.
+
+        Returns None if the query has a limit or offset that hides
+        the number of matches.
+        """
+        if IWeightedQuery.providedBy(query):
+            limit = getattr(query, 'limit', None)
+            if getattr(query, 'offset', None) or (
+                    limit and len(rows) >= limit):
+                return None
+        return len(rows) > self.max_ranked
+
+    def _report_stats(self, query, stats):
+        """Report the stats of a text query.
+
+        stats is a dict that may contain:
+
+        - cache: 'hit' or 'miss', if the query enables caching
+        - convert: seconds spent converting the query to a tsquery
+        - execute: seconds spent executing the SQL statement
+        - fetch: seconds spent fetching the rows
+        - btree: seconds spent building the result BTree
+        - rows: the number of results
+        - ranking_skipped: true if the results were not ranked because
+          there were more than max_ranked matches, or None if unknown
+        - degraded: true if the query exceeded statement_timeout
+
+        The stats are sent through perfmetrics and to the callback set
+        by metrics.set_stats_callback().
+        """
+        for name in ('convert', 'execute', 'fetch', 'btree'):
+            if name in stats:
+                metrics.timing('query.' + name, stats[name])
+        if 'cache' in stats:
+            metrics.incr('query.cache.' + stats['cache'])
+        metrics.histogram('query.rows', stats['rows'])
+        if stats.get('ranking_skipped'):
+            metrics.incr('query.ranking_skipped')
+        callback = metrics.stats_callback()
+        if callback is not None:
+            callback(query, stats)
+
+    def _is_approximate(self, query):
+        """Return true if a query asks for approximate results."""
+        return bool(IWeightedQuery.providedBy(query) and
+                    getattr(query, 'approximate', False))
+
+    def _query_settings(self, query=None):
+        """Get the (name, value) settings for running text queries.
+
+        Approximate search is enabled only if a query is provided and
+        asks for it.
+        """
+        settings = []
+        if self.statement_timeout:
+            settings.append(
+                ('statement_timeout', int(self.statement_timeout)))
+        if query is not None and self._is_approximate(query):
+            # Let GIN index scans return a random sample of the matches
+            # when there are many more.
+            settings.append(
+                ('gin_fuzzy_search_limit', int(self.approximate_limit)))
+        return settings
+
+    def _degrade(self, queries, error):
+        """Note that queries timed out and will be retried without ranking.
+
+        Sets the degraded attribute of IWeightedQuery objects.
+        """
+        log.warning("Text query exceeded statement_timeout; retrying "
+                    "without ranking: %s", error)
+        metrics.incr('query.timeout')
+        metrics.incr('query.degraded', len(queries))
+        for query in queries:
+            if IWeightedQuery.providedBy(query):
+                query.degraded = True
+
+    def _unranked_query_sql(self, query, invert=False, docids=None,
+                            tsquery=None, limit=None, offset=None):
+        """Generate a cheaper statement for a query that timed out.
+
+        The statement produces (docid, rank) rows like _query_sql(), but
+        the rank is only the coefficient of the document, the rows are
+        in no particular order, and there are at most degraded_limit rows.
+        limit and offset are handled as in _query_sql().
+        """
+        if tsquery is None:
+            tsquery = self._tsquery(query)
+        params = [self.ts_config, tsquery]
+        kw = {
+            'table': self.table,
+            'not': '',
+            'filter': self._marker_filter(query, params),
+            'offset': '',
+        }
+        if invert:
+            kw['not'] = 'NOT'
+        if docids is not None:
+            docidstr = ','.join(str(docid) for docid in docids)
+            kw['filter'] += ' AND docid IN (%s)' % docidstr
+
+        if IWeightedQuery.providedBy(query):
+            if limit is None:
+                limit = getattr(query, 'limit', None)
+            if offset is None:
+                offset = getattr(query, 'offset', None)
+        if limit:
+            limit = min(limit, self.degraded_limit)
+        else:
+            limit = self.degraded_limit
+        params.append(limit)
+        if offset:
+            kw['offset'] = "OFFSET %s"
+            params.append(offset)
+
+        stmt = """
+        SELECT docid, coefficient AS rank
+        FROM %(table)s
+        WHERE %(not)s(text_vector @@ to_tsquery(%%s, %%s)) %(filter)s
+        LIMIT %%s
+        %(offset)s
+        """ % kw
+        return stmt, tuple(params)
+
+    def _get_cache(self, query, invert=False, docids=None):
+        """Get the result cache and cache key for a query.
+
+        Returns (None, None) if the query does not enable caching.
+        """
+        if (IWeightedQuery.providedBy(query) and
+                getattr(query, 'cache_enabled', False)):
+            cache = getattr(query, 'cache', None)
+            if cache is None:
+                query.cache = cache = {}
+            return cache, (invert, docids)
+        return None, None
+
+    def _tsquery(self, query):
+        """Convert a query or IWeightedQuery to the tsquery syntax."""
+        if IWeightedQuery.providedBy(query):
+            text = getattr(query, 'text', None)
+            if text is None:
+                text = '%s' % query  # Use __str__()
+        else:
+            text = query
+        return self._convert_query(text)
+
+    def _query_sql(self, query, invert=False, docids=None, tsquery=None,
+                   limit=None, offset=None, max_ranked=None,
+                   with_count=False):
+        """Generate the SQL statement and parameters for a text query.
+
+        The statement produces (docid, rank) rows.  tsquery, if provided,
+        is the query already converted by _tsquery().  limit and offset,
+        if provided, replace the limit and offset of an IWeightedQuery.
+        max_ranked, if provided, replaces the max_ranked of the index.
+        If with_count is true, the rows also contain the number of
+        matches as a third column.
+        """
+        if max_ranked is None:
+            max_ranked = self.max_ranked
+        if tsquery is None:
+            tsquery = self._tsquery(query)
+        cq = tsquery
+
         kw = {
             'table': self.table,
             'weight': '',
@@ -265,59 +932,44 @@ class PGTextIndex(Persistent):
             'filter': '',
             'limit': '',
             'offset': '',
-            'max_ranked': self.max_ranked,
+            'max_ranked': max_ranked,
+            'rank_vector': 'text_vector',
+            'count': '',
         }
 
+        if self.rank_maxlen is not None:
+            # Rank using the smaller vector when it is available.
+            kw['rank_vector'] = (
+                'COALESCE(rank_vector, text_vector) AS text_vector')
+
         if invert:
             kw['not'] = 'NOT'
 
-        cache = None
+        if with_count:
+            kw['count'] = ', n'
 
+        params = [self.ts_config, cq]
+        kw['filter'] = self._marker_filter(query, params)
         if IWeightedQuery.providedBy(query):
-
-            if getattr(query, 'cache_enabled', False):
-                cache_key = (invert, docids)
-                cache = getattr(query, 'cache', None)
-                if cache is None:
-                    query.cache = cache = {}
-                result = cache.get(cache_key)
-                if result is not None:
-                    # Cache hit.
-                    return result
-
             kw['weight'] = "'{%s, %s, %s, %s}', "
-            text = getattr(query, 'text', None)
-            if text is None:
-                text = '%s' % query  # Use __str__()
-            cq = convert_query(text)
-            params = [
-                self.ts_config,
-                cq,
+            params.extend([
                 getattr(query, 'D', 0.1),
                 getattr(query, 'C', 0.2),
                 getattr(query, 'B', 0.4),
                 getattr(query, 'A', 1.0),
-                self.ts_config,
-                cq,
-            ]
-            marker = getattr(query, 'marker', None)
-            if marker:
-                # Match any marker value.
-                if isinstance(marker, basestring):
-                    marker = [marker]
-                kw['filter'] += " AND marker && %s::character varying[]"
-                params.insert(2, marker)
-            limit = getattr(query, 'limit', None)
-            if limit:
-                kw['limit'] = "LIMIT %s"
-                params.append(limit)
-            offset = getattr(query, 'offset', None)
-            if offset:
-                kw['offset'] = "OFFSET %s"
-                params.append(offset)
-        else:
-            cq = convert_query(query)
-            params = (self.ts_config, cq, self.ts_config, cq)
+            ])
+            if limit is None:
+                limit = getattr(query, 'limit', None)
+            if offset is None:
+                offset = getattr(query, 'offset', None)
+        params.extend([self.ts_config, cq])
+
+        if limit:
+            kw['limit'] = "LIMIT %s"
+            params.append(limit)
+        if offset:
+            kw['offset'] = "OFFSET %s"
+            params.append(offset)
 
         if docids is not None:
             docidstr = ','.join(str(docid) for docid in docids)
@@ -325,7 +977,7 @@ class PGTextIndex(Persistent):
 
         stmt = """
         WITH _filtered AS (
-            SELECT docid, coefficient, text_vector
+            SELECT docid, coefficient, %(rank_vector)s
             FROM %(table)s
             WHERE %(not)s(text_vector @@ to_tsquery(%%s, %%s)) %(filter)s),
         _counter AS (SELECT count(1) AS n FROM _filtered),
@@ -333,24 +985,16 @@ class PGTextIndex(Persistent):
             SELECT docid, coefficient * (
                 CASE WHEN n <= %(max_ranked)s THEN
                     ts_rank_cd(%(weight)stext_vector, to_tsquery(%%s, %%s))
-                ELSE 1 END) AS rank
+                ELSE 1 END) AS rank%(count)s
             FROM _filtered, _counter)
-        SELECT docid, rank
+        SELECT docid, rank%(count)s
         FROM _ranked
         ORDER BY rank DESC
         %(limit)s
         %(offset)s
         """ % kw
 
-        cursor = self.cursor
-        cursor.execute(stmt, tuple(params))
-        result = self.family.IF.BTree()
-        result.update(cursor.fetchall())
-
-        if cache is not None:
-            cache[cache_key] = result
-
-        return result
+        return stmt, tuple(params)
 
     def applyContains(self, query):
         return self._run_query(query)
@@ -361,13 +1005,142 @@ class PGTextIndex(Persistent):
     apply = applyEq = applyContains  # @ReservedAssignment
     applyNotEq = applyDoesNotContain
 
-    def docids(self):
-        """Return all docids in the index."""
+    @metricmethod
+    def apply_many(self, queries):
+        """Run several text queries in a single round trip.
+
+        Returns a list containing one result per query, in the same
+        order as the queries.  Each result is the same as the result
+        of applyContains(query), including any limit, offset, marker,
+        and caching specified by IWeightedQuery objects.
+        """
+        results = [None] * len(queries)
+        caches = {}
+        pending = []  # [(query_num, query)]
+        for i, query in enumerate(queries):
+            if self._is_approximate(query):
+                # gin_fuzzy_search_limit would apply to all the queries
+                # of the statement, so run this one separately.
+                results[i] = self._run_query(query)
+                continue
+            cache, cache_key = self._get_cache(query)
+            if cache is not None:
+                result = cache.get(cache_key)
+                if result is not None:
+                    # Cache hit.
+                    results[i] = result
+                    continue
+                caches[i] = (cache, cache_key)
+            results[i] = self.family.IF.BTree()
+            pending.append((i, query))
+
+        if pending:
+            try:
+                rows = self._read_many(pending, self._query_sql)
+            except psycopg2.extensions.QueryCanceledError as e:
+                self._degrade([query for (i, query) in pending], e)
+                rows = self._read_many(pending, self._unranked_query_sql)
+                caches = {}
+            for query_num, docid, rank in rows:
+                results[query_num][docid] = rank
+
+            for i, (cache, cache_key) in caches.items():
+                cache[cache_key] = results[i]
+
+        return results
+
+    def _read_many(self, pending, make_sql):
+        """Run several text queries in one statement.
+
+        pending is a list of (query_num, query).  make_sql generates the
+        statement of each query.  Returns (query_num, docid, rank) rows.
+        """
+        selects = []
+        params = []
+        for i, query in pending:
+            stmt, query_params = make_sql(query)
+            selects.append(
+                'SELECT %d AS query_num, docid, rank FROM (%s) AS _q%d'
+                % (i, stmt, i))
+            params.extend(query_params)
+        return self._read('\nUNION ALL\n'.join(selects), tuple(params),
+                          settings=self._query_settings())
+
+    @metricmethod
+    def get_marker_counts(self, query, markers=None):
+        """Count the documents matching a query for each marker value.
+
+        Returns a dict that maps marker values to the number of matching
+        documents with that marker.  If the query provides IWeightedQuery
+        and has a marker, only documents with that marker are counted.
+        If markers is provided, only the given marker values are counted.
+        """
+        params = [self.ts_config, self._tsquery(query)]
+        marker_filter = self._marker_filter(query, params)
+        kw = {'table': self.table, 'filter': marker_filter}
+        if markers is not None:
+            if isinstance(markers, basestring):
+                markers = [markers]
+            if not markers:
+                return {}
+            kw['filter'] += " AND m = ANY(%s::character varying[])"
+            params.append(list(markers))
+
+        stmt = """
+        SELECT m, count(DISTINCT docid)
+        FROM %(table)s, unnest(marker) AS m
+        WHERE text_vector @@ to_tsquery(%%s, %%s) %(filter)s
+        GROUP BY m
+        """ % kw
+        counts = {}
+        for m, count in self._scatter_read(stmt, tuple(params)):
+            counts[m] = counts.get(m, 0) + count
+        return counts
+
+    def _marker_filter(self, query, params):
+        """Get the SQL that restricts matches to the marker of a query.
+
+        Appends the parameters of the SQL to params.
+        """
+        marker = None
+        if IWeightedQuery.providedBy(query):
+            marker = getattr(query, 'marker', None)
+        if not marker:
+            return ''
+        if isinstance(marker, basestring):
+            marker = [marker]
+        sql = " AND marker && %s::character varying[]"
+        params.append(list(marker))
+        if self.partition_by == 'marker':
+            # Let PostgreSQL skip the partitions of other markers.
+            # Documents have at most one marker in this layout, so this
+            # matches the same documents as the && filter.
+            sql += " AND marker[1] = ANY(%s::character varying[])"
+            params.append(list(marker))
+        return sql
+
+    def _count_sql(self, query):
+        """Generate the SQL statement and parameters that count matches."""
+        params = [self.ts_config, self._tsquery(query)]
+        marker_filter = self._marker_filter(query, params)
+        kw = {'table': self.table, 'filter': marker_filter}
+        stmt = """
+        SELECT count(1)
+        FROM %(table)s
+        WHERE text_vector @@ to_tsquery(%%s, %%s) %(filter)s
+        """ % kw
+        return stmt, tuple(params)
+
+    def docids(self, primary=False):
+        """Return all docids in the index.
+
+        If primary is true, read from the primary database even if read
+        replicas are configured.  Use it when the docids decide what to
+        write, since a replica can lag behind.
+        """
         stmt = "SELECT docid FROM %s" % self.table
-        cursor = self.cursor
-        cursor.execute(stmt)
         res = self.family.IF.Set()
-        for row in cursor.fetchall():
+        for row in self._scatter_read(stmt, primary=primary):
             res.add(row[0])
         return res
 
@@ -385,10 +1158,81 @@ class PGTextIndex(Persistent):
         options string passed to 'ts_headline'. See the documentation
         for PostgreSQL for more information on the options that can be
         passed to 'ts_headline'.
+
+        If the local_summaries option is enabled, the summaries are
+        produced in Python by a Summarizer instead, which only asks
+        PostgreSQL for the lexemes of the words involved.
+
+        If the summary_cache_entries option is set, summaries are cached
+        in a process-wide LRU cache and only the texts that are not
+        cached are sent to PostgreSQL.
         """
         if not raw_texts:
             return []
-        s = convert_query(query)
+        if not self.summary_cache_entries:
+            return self._get_summaries(raw_texts, query, **options)
+
+        cache = _get_summary_cache(
+            self.summary_cache_entries, self.summary_cache_size)
+        common = (
+            self._convert_query(query),
+            self.ts_config,
+            ','.join(sorted('%s=%s' % (k, v) for k, v in options.items())),
+            bool(self.local_summaries),
+        )
+        keys = []
+        res = []
+        missing = []
+        for raw_text in raw_texts:
+            if isinstance(raw_text, unicode):
+                digest = md5(raw_text.encode('utf-8')).hexdigest()
+            else:
+                digest = md5(raw_text).hexdigest()
+            key = (digest,) + common
+            keys.append(key)
+            summary = cache.get(key)
+            if summary is None:
+                missing.append(len(res))
+            res.append(summary)
+
+        metrics.incr('summary_cache.hit', len(res) - len(missing))
+        if missing:
+            metrics.incr('summary_cache.miss', len(missing))
+            summaries = self._get_summaries(
+                [raw_texts[i] for i in missing], query, **options)
+            for i, summary in zip(missing, summaries):
+                res[i] = summary
+                cache.set(keys[i], summary, len(summary))
+        return res
+
+    def _get_summaries(self, raw_texts, query, **options):
+        """Get contextual summaries without using the summary cache."""
+        start = time.time()
+        detail = '%d texts' % len(raw_texts)
+        if self.local_summaries:
+            summarizer = self._v_summarizer
+            if summarizer is None:
+                self._v_summarizer = summarizer = self.summarizer_factory()
+            res = summarizer.get_summaries(
+                self._read, self.ts_config, query, raw_texts,
+                encoding=self.read_connection.encoding, fields=self.fields,
+                **options)
+            self._check_slow('contextual summary', start, query, len(res),
+                             detail)
+            return res
+        stmt, params = self._summaries_sql(raw_texts, query, **options)
+        rows = self._read(stmt, params)
+        encoding = self.read_connection.encoding
+        res = [summary.decode(encoding) for (summary,) in rows]
+        # Leave the texts out of the log message.
+        detail = 'params %r, %s' % (params[:4], detail)
+        self._check_slow('contextual summary', start, query, len(res),
+                         detail, stmt, params)
+        return res
+
+    def _summaries_sql(self, raw_texts, query, **options):
+        """Generate the ts_headline statement and parameters for texts."""
+        s = self._convert_query(query)
         options = ','.join(['%s=%s' % (k, v) for k, v in options.items()])
 
         value_clauses = ', '.join(('(%s)',) * len(raw_texts))
@@ -396,12 +1240,91 @@ class PGTextIndex(Persistent):
         SELECT ts_headline(%%s, doc.text, to_tsquery(%%s, %%s), %%s)
         FROM (VALUES %s) AS doc (text)
         """ % value_clauses
-        cursor = self.cursor
         params = (self.ts_config, self.ts_config, s, options)
-        cursor.execute(stmt, params + tuple(raw_texts))
+        return stmt, params + tuple(raw_texts)
+
+    @metricmethod
+    def get_contextual_summaries_by_docid(self, docids, query, **options):
+        """Get a contextual summary for each docid using the stored text.
+
+        This works like get_contextual_summaries(), but the text is
+        read from the source_text column, so the store_text option must
+        be enabled; otherwise ValueError is raised.  Produces a list of
+        the same length as the docids sequence.  The summary is empty
+        for documents that are not in the index or have no stored text.
+        """
+        self._check_store_text('get_contextual_summaries_by_docid')
+        if not docids:
+            return []
+        s = self._convert_query(query)
+        options = ','.join(['%s=%s' % (k, v) for k, v in options.items()])
+        docidstr = ','.join(str(int(docid)) for docid in docids)
+
+        stmt = """
+        SELECT docid, ts_headline(%%s, source_text, to_tsquery(%%s, %%s), %%s)
+        FROM %s
+        WHERE docid IN (%s) AND source_text IS NOT NULL
+        """ % (self.table, docidstr)
+        rows = self._scatter_read(
+            stmt, (self.ts_config, self.ts_config, s, options))
+        encoding = self.read_connection.encoding
+        summaries = dict(
+            (docid, summary.decode(encoding)) for (docid, summary) in rows)
+        return [summaries.get(docid, u'') for docid in docids]
+
+    @metricmethod
+    def search_with_summaries(self, query, limit=None, offset=None,
+                              **options):
+        """Search and get contextual summaries in a single round trip.
+
+        Returns a list of (docid, rank, summary) for the top matching
+        documents, in rank order.  limit and offset, if provided, select
+        the page of results and replace the limit and offset of an
+        IWeightedQuery.  Summaries are produced only for the returned
+        documents, from the text stored by the store_text option;
+        ValueError is raised if the option is not enabled.  Options are
+        passed to 'ts_headline' as in get_contextual_summaries().
+        """
+        stmt, params = self._search_with_summaries_sql(
+            query, limit, offset, options)
+        rows = self._read(stmt, params)
+        encoding = self.read_connection.encoding
         return [
-            summary.decode(self.connection.encoding)
-            for (summary,) in cursor.fetchall()]
+            (docid, rank, summary.decode(encoding))
+            for (docid, rank, summary) in rows]
+
+    def _search_with_summaries_sql(self, query, limit, offset, options,
+                                   max_ranked=None, with_count=False):
+        """Generate the statement and parameters for search_with_summaries.
+
+        max_ranked and with_count are passed to _query_sql().  With
+        with_count, the number of matches is the third column.
+        """
+        self._check_store_text('search_with_summaries')
+        cq = self._tsquery(query)
+        page_stmt, page_params = self._query_sql(
+            query, tsquery=cq, limit=limit, offset=offset,
+            max_ranked=max_ranked, with_count=with_count)
+        options = ','.join(['%s=%s' % (k, v) for k, v in options.items()])
+        count = ''
+        if with_count:
+            count = ' _page.n,'
+
+        stmt = """
+        WITH _page AS (%s)
+        SELECT _page.docid, _page.rank,%s ts_headline(
+            %%s, COALESCE(t.source_text, ''), to_tsquery(%%s, %%s), %%s)
+        FROM _page
+            JOIN %s t ON (t.docid = _page.docid)
+        ORDER BY _page.rank DESC
+        """ % (page_stmt, count, self.table)
+        params = page_params + (self.ts_config, self.ts_config, cq, options)
+        return stmt, params
+
+    def _check_store_text(self, method):
+        """Raise ValueError if the text of documents is not stored."""
+        if not self.store_text:
+            raise ValueError('%s requires the store_text option' % method)
 
     def apply_intersect(self, query, docids):
         """ Run the query implied by query, and return query results
@@ -490,7 +1413,8 @@ class PGTextIndex(Persistent):
         Insert null value rows for docs that are in catalog but don't have
         values for this index.
         """
-        for docid in self.family.IF.difference(docids, self.docids()):
+        for docid in self.family.IF.difference(
+                docids, self.docids(primary=True)):
             self._index_null(docid)
 
     def upgrade(self):
@@ -527,6 +1451,81 @@ class PGTextIndex(Persistent):
                 self.table)
             cursor.execute(stmt)
 
+        # Index the marker column
+        query = """
+        SELECT 1 FROM pg_indexes
+        WHERE schemaname='public' AND
+              tablename=%s AND
+              indexname=%s
+        """
+        cursor.execute(query, (self.table, '%s_marker_index' % self.table))
+        if cursor.fetchone() is None:
+            stmt = (
+                "CREATE INDEX %(table)s_marker_index "
+                "ON %(table)s USING gin(marker)" % self._subs)
+            cursor.execute(stmt)
+
+        if self.rank_maxlen is not None:
+            # Rows indexed earlier are ranked using text_vector until
+            # they are reindexed.
+            self._add_column(cursor, 'rank_vector', 'tsvector')
+
+        if self.store_text:
+            # Rows indexed earlier have no summaries until they are
+            # reindexed.
+            self._add_column(cursor, 'source_text', 'text')
+
+    def _add_column(self, cursor, name, column_type):
+        """Add a column to the table if it does not exist."""
+        query = """
+        SELECT 1 FROM information_schema.columns
+        WHERE table_catalog=current_catalog AND
+              table_schema='public' AND
+              table_name=%s AND
+              column_name=%s
+        """
+        cursor.execute(query, (self.table, name))
+        if cursor.fetchone() is None:
+            stmt = "ALTER TABLE %s ADD %s %s" % (self.table, name, column_type)
+            cursor.execute(stmt)
+
+
+def _summarize_docids(docids):
+    """Describe a docid filter briefly for a log message."""
+    if docids is None:
+        return 'unrestricted'
+    docids = list(docids)
+    if len(docids) <= 5:
+        return repr(docids)
+    return '%d docids starting with %r' % (len(docids), docids[:5])
+
+
+def _check_settings(settings):
+    """Validate a dict of PostgreSQL settings and return a copy.
+
+    Returns None if there are no settings.
+    """
+    if not settings:
+        return None
+    for name in settings:
+        if not isinstance(name, basestring) or not _setting_name_re.match(
+                name):
+            raise ValueError('invalid PostgreSQL setting name: %r' % name)
+    return dict(settings)
+
+
+def _get_summary_cache(max_entries, max_size):
+    """Get the process-wide summary cache with the given limits."""
+    key = (max_entries, max_size)
+    cache = _summary_caches.get(key)
+    if cache is None:
+        with _summary_caches_lock:
+            cache = _summary_caches.get(key)
+            if cache is None:
+                cache = LRUCache(max_entries, max_size)
+                _summary_caches[key] = cache
+    return cache
+
 
 def _mp_release_resources(jar):
     """
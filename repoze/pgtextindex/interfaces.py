@@ -117,3 +117,19 @@ class IWeightedQuery(Interface):
 
     cache = Attribute(
         """Optional: a dict of cached query results.""")
+
+    approximate = Attribute(
+        """Optional boolean: if true, a broad query may omit matches.
+
+        PostgreSQL returns a random sample of roughly the index's
+        approximate_limit matches of each word that matches more
+        documents, which is much faster for very common words.  Useful
+        for exploratory and autocomplete searches.
+        """)
+
+    approximate_result = Attribute(
+        """Set to True by pgtextindex when an approximate search ran.""")
+
+    degraded = Attribute(
+        """Set to True by pgtextindex when the query exceeded the index's
+        statement_timeout and was retried without ranking.""")
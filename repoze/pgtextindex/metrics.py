@@ -0,0 +1,54 @@
+"""Counters, gauges, and timers reported through perfmetrics.
+
+The stats are sent only when a perfmetrics statsd client is configured.
+"""
+
+from perfmetrics import statsd_client
+
+prefix = 'repoze.pgtextindex.'
+
+_stats_callback = None
+
+
+def set_stats_callback(callback):
+    """Set the function called as callback(query, stats) after text queries.
+
+    Like the perfmetrics statsd client, the callback applies to all the
+    indexes of the process.  It is not stored with the indexes, so it
+    need not be picklable.  Pass None to remove it.
+    """
+    global _stats_callback
+    _stats_callback = callback
+
+
+def stats_callback():
+    """Get the function set by set_stats_callback(), or None."""
+    return _stats_callback
+
+
+def incr(name, count=1):
+    """Increment a counter."""
+    client = statsd_client()
+    if client is not None:
+        client.incr(prefix + name, count)
+
+
+def gauge(name, value):
+    """Set a gauge."""
+    client = statsd_client()
+    if client is not None:
+        client.gauge(prefix + name, value)
+
+
+def histogram(name, value):
+    """Record a value, such as a number of rows, as a distribution."""
+    client = statsd_client()
+    if client is not None:
+        client.timing(prefix + name, int(value))
+
+
+def timing(name, seconds):
+    """Record a duration, given in seconds."""
+    client = statsd_client()
+    if client is not None:
+        client.timing(prefix + name, int(seconds * 1000))
@@ -3,18 +3,29 @@ from repoze.pgtextindex.queryparser import QueryParser
 from repoze.pgtextindex.queryparser import remove_special_chars
 
 
-def convert_query(query):
-    """Convert a Zope text index query to PostgreSQL tsearch format"""
+def convert_query(query, phrase=False, fields=None):
+    """Convert a Zope text index query to PostgreSQL tsearch format
+
+    If phrase is true, phrases are encoded using the followed-by
+    operator (<->), which requires PostgreSQL 9.6 or above.
+
+    fields, if provided, maps field names that may prefix query terms
+    (as in 'title:foo') to strings of text weight labels.
+    """
     if isinstance(query, dict):
         text = query['query']
     else:
         text = query
-    tree = QueryParser().parseQuery(text)
-    return ParseTreeEncoder().encode(tree)
+    tree = QueryParser(fields).parseQuery(text)
+    return ParseTreeEncoder(phrase=phrase).encode(tree)
 
 
 class ParseTreeEncoder:
 
+    def __init__(self, phrase=False):
+        self.phrase = phrase
+        self.weights = ''
+
     def encode(self, node):
         m = getattr(self, 'encode_%s' % node.nodeType())
         return m(node)
@@ -34,15 +45,37 @@ class ParseTreeEncoder:
         value = node.getValue()
         if not isinstance(value, basestring):
             value = ' '.join(value)
+        return self.quote(value)
+
+    def quote(self, value):
         res = remove_special_chars(value)
         res = res.replace('\\', '\\\\').replace("'", "''")
         return res
 
+    def encode_FIELD(self, node):
+        weights = self.weights
+        self.weights = node.weights
+        try:
+            return self.encode(node.getValue())
+        finally:
+            self.weights = weights
+
+    def weight_suffix(self):
+        if self.weights:
+            return ':%s' % self.weights
+        return ''
+
     def encode_ATOM(self, node):
-        return "'%s'" % self.get_string(node)
+        return "'%s'%s" % (self.get_string(node), self.weight_suffix())
 
     def encode_PHRASE(self, node):
-        return "'%s'" % self.get_string(node)
+        suffix = self.weight_suffix()
+        if self.phrase:
+            # Require the words to appear next to each other, in order.
+            words = node.getValue()
+            return ' <-> '.join(
+                "'%s'%s" % (self.quote(word), suffix) for word in words)
+        return "'%s'%s" % (self.get_string(node), suffix)
 
     def encode_GLOB(self, node):
-        return "'%s':*" % self.get_string(node)
+        return "'%s':*%s" % (self.get_string(node), self.weights)
@@ -39,6 +39,10 @@ An ATOM is either:
 An unquoted ATOM may also contain globbing characters; for example
 "foo*" means any word starting with "foo".
 
+If the parser is configured with field names, an ATOM may be prefixed
+with a field name and a colon, e.g. 'title:foo', 'title:"foo bar"' or
+'title:foo*', meaning the ATOM must be found in that field.
+
 When multiple consecutive ATOMs are found at the leaf level, they are
 connected by an implied AND operator, and an unquoted leading hyphen
 is interpreted as a NOT operator.
@@ -79,12 +83,15 @@ _keywords = {
     _RPAREN:    _RPAREN,
 }
 
-# Regular expression to tokenize.
-_tokenizer_regex = re.compile(r"""
+# Regular expression to tokenize.  The %s is replaced with an optional
+# field name prefix.
+_tokenizer_template = r"""
     # a paren
     [()]
     # or an optional hyphen
 |   -?
+    # and an optional field name prefix
+    %s
     # followed by
     (?:
         # a string inside double quotes (and not containing these)
@@ -92,21 +99,61 @@ _tokenizer_regex = re.compile(r"""
         # or a non-empty stretch w/o whitespace, parens or double quotes
     |    [^()\s"]+
     )
-""", re.VERBOSE)
+"""
+
+_tokenizer_regex = re.compile(_tokenizer_template % '', re.VERBOSE)
+
+
+def _make_tokenizer(fields):
+    """Make a tokenizer that allows field prefixes before quoted strings."""
+    names = '|'.join(re.escape(name) for name in sorted(fields))
+    prefix = '(?: (?:%s) : )?' % names
+    return re.compile(_tokenizer_template % prefix, re.VERBOSE)
 
 _quote_re = re.compile(r'^"([^"]*)"$')
 
 
+class FieldNode(parsetree.ParseTreeNode):
+    """A parse tree node restricted to the given text weight labels.
+
+    The value is the restricted node.  The weights attribute is a string
+    containing weight labels, such as 'A' or 'AB'.
+    """
+
+    _nodeType = "FIELD"
+
+    def __init__(self, value, weights):
+        parsetree.ParseTreeNode.__init__(self, value)
+        self.weights = weights
+
+    def __repr__(self):
+        return "%s(%r, %r)" % (
+            self.__class__.__name__, self.getValue(), self.weights)
+
+    def terms(self):
+        return self.getValue().terms()
+
+
 class QueryParser(object):
 
     implements(IQueryParser)
 
-    def __init__(self):
+    def __init__(self, fields=None):
+        """Create a parser.
+
+        fields, if provided, maps field names recognized in queries to
+        strings of text weight labels.
+        """
         self._ignored = []
+        self._fields = fields or {}
+        if self._fields:
+            self._tokenizer = _make_tokenizer(self._fields)
+        else:
+            self._tokenizer = _tokenizer_regex
 
     def parseQuery(self, query):
         # Lexical analysis.
-        tokens = _tokenizer_regex.findall(query)
+        tokens = self._tokenizer.findall(query)
         self._tokens = tokens
         # classify tokens
         self._tokentypes = [_keywords.get(token.upper(), _ATOM)
@@ -240,6 +287,13 @@ class QueryParser(object):
             term = term[1:]
             invert = True
 
+        weights = None
+        if self._fields:
+            name, sep, rest = term.partition(':')
+            if sep and rest and name in self._fields:
+                weights = self._fields[name]
+                term = rest
+
         mo = _quote_re.match(term)
         if mo is not None:
             words = mo.group(1).split()
@@ -260,6 +314,8 @@ class QueryParser(object):
             tree = parsetree.GlobNode(words[0])
         else:
             tree = parsetree.AtomNode(words[0])
+        if weights:
+            tree = FieldNode(tree, weights)
         if invert:
             tree = parsetree.NotNode(tree)
         return tree
@@ -0,0 +1,322 @@
+
+from multiprocessing.pool import ThreadPool
+from perfmetrics import metricmethod
+from repoze.pgtextindex.db import read_rows
+from repoze.pgtextindex.index import PGTextIndex
+from repoze.pgtextindex.index import _summarize_docids
+from repoze.pgtextindex.interfaces import IWeightedQuery
+import psycopg2.extensions
+import threading
+import time
+
+_thread_pools = {}  # {size: ThreadPool}
+_thread_pools_lock = threading.Lock()
+
+
+def _get_thread_pool(size):
+    """Get a process-wide pool of threads for querying shards."""
+    pool = _thread_pools.get(size)
+    if pool is None:
+        _thread_pools_lock.acquire()
+        try:
+            pool = _thread_pools.get(size)
+            if pool is None:
+                _thread_pools[size] = pool = ThreadPool(size)
+        finally:
+            _thread_pools_lock.release()
+    return pool
+
+
+def _call(func):
+    return func()
+
+
+class ShardedPGTextIndex(PGTextIndex):
+    """A PGTextIndex that spreads documents over several databases.
+
+    Each document is stored in the shard chosen by its docid modulo the
+    number of DSNs.  Searches run on all shards concurrently and the
+    results are merged, so limits and offsets apply to the combined
+    results.  Every shard needs a table created by drop_and_create().
+    Read replicas are not supported.
+    """
+
+    _v_shard = None  # The shard used by connection_manager
+    _v_temp_shard_cms = None  # Shard connection managers before storage
+
+    def __init__(self, discriminator, dsns, **kw):
+        if isinstance(dsns, basestring) or not dsns:
+            raise ValueError('dsns must be a non-empty sequence of DSNs')
+        if kw.get('read_dsns'):
+            raise ValueError('ShardedPGTextIndex does not support read_dsns')
+        self.dsns = tuple(dsns)
+        super(ShardedPGTextIndex, self).__init__(
+            discriminator, self.dsns[0], **kw)
+
+    def _shard(self, docid):
+        return int(docid) % len(self.dsns)
+
+    def _get_shard_connection_managers(self):
+        """Get a connection manager for each shard."""
+        jar = self._p_jar
+        oid = self._p_oid
+
+        if jar is None or oid is None:
+            # Not yet stored in ZODB, so use _v_temp_shard_cms
+            cms = self._v_temp_shard_cms
+            if cms is None:
+                self._v_temp_shard_cms = cms = {}
+        else:
+            cms = self._get_foreign_connections(jar)
+
+        res = []
+        for dsn in self.dsns:
+            key = (oid, 'shard', dsn)
+            cm = cms.get(key)
+            if cm is None:
+                cm = self._make_connection_manager(dsn)
+                cms[key] = cm
+            res.append(cm)
+        return res
+
+    @property
+    def connection_manager(self):
+        return self._get_shard_connection_managers()[self._v_shard or 0]
+
+    def _each_shard(self, func, *args):
+        """Call a PGTextIndex method once for each shard."""
+        try:
+            for shard in range(len(self.dsns)):
+                self._v_shard = shard
+                func(self, *args)
+        finally:
+            self._v_shard = None
+
+    def _on_shard(self, docid, func, *args):
+        """Call a PGTextIndex method on the shard of a docid."""
+        previous = self._v_shard
+        self._v_shard = self._shard(docid)
+        try:
+            return func(self, docid, *args)
+        finally:
+            self._v_shard = previous
+
+    def drop_and_create(self):
+        self._each_shard(PGTextIndex.drop_and_create)
+
+    def upgrade(self):
+        self._each_shard(PGTextIndex.upgrade)
+
+    def clear(self):
+        self._each_shard(PGTextIndex.clear)
+
+    def index_doc(self, docid, obj):
+        self._on_shard(docid, PGTextIndex.index_doc, obj)
+
+    reindex_doc = index_doc
+
+    def unindex_doc(self, docid):
+        self._on_shard(docid, PGTextIndex.unindex_doc)
+
+    def _index_null(self, docid):
+        self._on_shard(docid, PGTextIndex._index_null)
+
+    def _scatter_read(self, stmt, params=None, settings=(), timings=None,
+                      primary=False):
+        """Run a statement on every shard concurrently.
+
+        Returns the rows from all shards.  timings, if provided, is a
+        dict that receives the time spent reading from all shards as
+        'execute'.  Shards have no read replicas, so primary makes no
+        difference.
+        """
+        rows = []
+        for shard_rows in self._read_shards(stmt, params, settings, timings):
+            rows.extend(shard_rows)
+        return rows
+
+    def _read_shards(self, stmt, params=None, settings=(), timings=None,
+                     shards=None):
+        """Run a statement on several shards concurrently.
+
+        shards is a list of shard numbers, defaulting to all shards.
+        Returns a list containing the rows of each shard.  The time
+        spent is added to the 'execute' entry of timings.
+        """
+        start = time.time()
+        settings = self._read_settings(settings)
+        cms = self._get_shard_connection_managers()
+        if shards is None:
+            shards = range(len(cms))
+        # Transactions are thread-local, so join the transaction in this
+        # thread before reading in the pool threads.
+        targets = [self._shard_reader(cms[shard], stmt, params, settings)
+                   for shard in shards]
+
+        if len(targets) == 1:
+            res = [targets[0]()]
+        else:
+            pool = _get_thread_pool(len(cms))
+            res = pool.map(_call, targets)
+        if timings is not None:
+            timings['execute'] = (
+                timings.get('execute', 0) + time.time() - start)
+        return res
+
+    def _shard_reader(self, cm, stmt, params, settings):
+        """Prepare to read from a shard and return a reading function.
+
+        Uses execute_read() of the connection manager, if available, so
+        reads stay in autocommit mode and are retried after a
+        disconnect, like PGTextIndex._read().
+        """
+        if getattr(cm, 'execute_read', None) is not None:
+            cm.read_cursor
+            kw = {}
+            if settings:
+                kw['settings'] = settings
+            return lambda: cm.execute_read(stmt, params, **kw)
+        cursor = cm.cursor
+        autocommit = getattr(cm.connection, 'autocommit', False)
+        return lambda: read_rows(cursor, stmt, params, settings, autocommit)
+
+    def _page(self, query, limit, offset):
+        """Get the limit and offset for the combined results of shards.
+
+        Returns (limit, offset, shard_limit).  Each shard has to produce
+        the rows up to the end of the page.
+        """
+        if IWeightedQuery.providedBy(query):
+            if limit is None:
+                limit = getattr(query, 'limit', None)
+            if offset is None:
+                offset = getattr(query, 'offset', None)
+        offset = offset or 0
+        shard_limit = None
+        if limit:
+            shard_limit = limit + offset
+        return limit, offset, shard_limit
+
+    def _merge(self, rows, limit, offset):
+        """Sort rows of (docid, rank, ...) by rank and select a page."""
+        rows = sorted(rows, key=lambda row: (-row[1], row[0]))
+        if limit:
+            return rows[offset:offset + limit]
+        return rows[offset:]
+
+    def _read_ranked(self, make_sql, settings=(), timings=None):
+        """Read ranked rows from all shards, ranking them consistently.
+
+        make_sql(max_ranked=None) generates the statement and
+        parameters.  Without max_ranked, the third column of the rows
+        must be the number of matches on the shard.  Like PGTextIndex,
+        rank only if the total number of matches is at most max_ranked.
+        A shard with fewer matches has ranked them anyway, so its
+        matches are read again with max_ranked=0.
+
+        Returns (shard_rows, ranking_skipped), where shard_rows
+        contains the rows of each shard.
+        """
+        stmt, params = make_sql()
+        shard_rows = self._read_shards(stmt, params, settings, timings)
+        counts = [rows[0][2] if rows else 0 for rows in shard_rows]
+        ranking_skipped = sum(counts) > self.max_ranked
+        if ranking_skipped:
+            ranked = [shard for (shard, n) in enumerate(counts)
+                      if 0 < n <= self.max_ranked]
+            if ranked:
+                stmt, params = make_sql(max_ranked=0)
+                reread = self._read_shards(
+                    stmt, params, settings, timings, shards=ranked)
+                for shard, rows in zip(ranked, reread):
+                    shard_rows[shard] = rows
+        return shard_rows, ranking_skipped
+
+    @metricmethod
+    def _run_query(self, query, invert=False, docids=None):
+        stats = {}
+        cache, cache_key = self._get_cache(query, invert, docids)
+        if cache is not None:
+            result = cache.get(cache_key)
+            if result is not None:
+                # Cache hit.
+                stats['cache'] = 'hit'
+                stats['rows'] = len(result)
+                self._report_stats(query, stats)
+                return result
+            stats['cache'] = 'miss'
+
+        query_start = start = time.time()
+        tsquery = self._tsquery(query)
+        stats['convert'] = time.time() - start
+        limit, offset, shard_limit = self._page(query, None, None)
+
+        def make_sql(max_ranked=None):
+            return self._query_sql(
+                query, invert, docids, tsquery, limit=shard_limit, offset=0,
+                max_ranked=max_ranked, with_count=max_ranked is None)
+
+        stmt, params = make_sql()
+        settings = self._query_settings(query)
+        try:
+            shard_rows, stats['ranking_skipped'] = self._read_ranked(
+                make_sql, settings, timings=stats)
+            rows = [row[:2] for rows in shard_rows for row in rows]
+        except psycopg2.extensions.QueryCanceledError as e:
+            self._degrade([query], e)
+            stmt, params = self._unranked_query_sql(
+                query, invert, docids, tsquery, limit=shard_limit, offset=0)
+            rows = self._scatter_read(
+                stmt, params, settings=settings, timings=stats)
+            rows = self._merge(rows, limit, offset)[:self.degraded_limit]
+            stats['degraded'] = stats['ranking_skipped'] = True
+            cache = None
+        else:
+            if limit or offset:
+                rows = self._merge(rows, limit, offset)
+        if self._is_approximate(query):
+            query.approximate_result = True
+        start = time.time()
+        result = self.family.IF.BTree()
+        result.update(rows)
+        stats['btree'] = time.time() - start
+        stats['rows'] = len(rows)
+
+        if cache is not None:
+            cache[cache_key] = result
+
+        self._report_stats(query, stats)
+        if self.slow_query_threshold is not None:
+            self._check_slow(
+                'text query', query_start, query, len(rows),
+                'params %r, docids %s' % (params, _summarize_docids(docids)),
+                stmt, params, settings, explain=not stats.get('degraded'),
+                read=self._scatter_read)
+        return result
+
+    def apply_many(self, queries):
+        """Run several text queries.
+
+        Each query runs on all shards concurrently, but unlike
+        PGTextIndex.apply_many(), the queries are not combined into a
+        single statement.
+        """
+        return [self._run_query(query) for query in queries]
+
+    @metricmethod
+    def search_with_summaries(self, query, limit=None, offset=None,
+                              **options):
+        limit, offset, shard_limit = self._page(query, limit, offset)
+
+        def make_sql(max_ranked=None):
+            return self._search_with_summaries_sql(
+                query, shard_limit, 0, options, max_ranked=max_ranked,
+                with_count=True)
+
+        shard_rows, ranking_skipped = self._read_ranked(make_sql)
+        rows = self._merge(
+            [row for rows in shard_rows for row in rows], limit, offset)
+        encoding = self.read_connection.encoding
+        return [
+            (docid, rank, summary.decode(encoding))
+            for (docid, rank, n, summary) in rows]
@@ -0,0 +1,220 @@
+
+from repoze.pgtextindex.queryparser import QueryParser
+from repoze.pgtextindex.queryparser import remove_special_chars
+import re
+
+_word_re = re.compile(r'\w+', re.UNICODE)
+
+# The length of the prefix a document word must share with a query
+# lexeme before PostgreSQL is asked for the lexemes of the word.
+_candidate_prefix = 3
+
+
+class Summarizer(object):
+    """Produces contextual summaries in Python instead of using ts_headline.
+
+    PostgreSQL provides the lexemes of the query terms and of the
+    document words that might match them, so highlighting follows the
+    text search configuration, but the scanning, highlighting, and
+    fragmenting of the texts happens in the application.  Lexemes are
+    cached, so repeated queries and common words do not need to be
+    sent to PostgreSQL again.
+
+    Supports these ts_headline options: StartSel, StopSel, MaxWords,
+    MinWords, MaxFragments, FragmentDelimiter, and HighlightAll.
+    The window is the default for MaxWords.
+    """
+
+    def __init__(self, window=35, cache_size=10000):
+        self.window = window
+        self.cache_size = cache_size
+        self._lexemes = {}  # {(ts_config, word): frozenset([lexeme])}
+
+    def get_summaries(self, read, ts_config, query, raw_texts,
+                      encoding='UTF8', fields=None, **options):
+        """Get a contextual summary for each text.
+
+        read is a function that executes a read-only statement with
+        parameters and returns all rows.  Produces a list of the same
+        length as the raw_texts sequence.
+        """
+        options = dict((k.lower(), v) for (k, v) in options.items())
+        words, globs = get_query_terms(query, fields)
+        words = [_decode(w, encoding) for w in words]
+        globs = [_decode(w, encoding) for w in globs]
+        texts = []
+        for raw_text in raw_texts:
+            texts.append(_decode(raw_text, encoding))
+
+        # Look up the lexemes of the query terms, then the lexemes of
+        # the document words that start like those lexemes.
+        self._lexize(read, ts_config, words + globs, encoding)
+        stems = set()
+        for word in words:
+            stems.update(self._lexemes[(ts_config, word)])
+        prefixes = set()
+        for word in globs:
+            prefixes.update(self._lexemes[(ts_config, word)])
+        starts = set(s[:_candidate_prefix] for s in stems | prefixes)
+
+        candidates = set()
+        for text in texts:
+            for word in _word_re.findall(text):
+                word = word.lower()
+                if word[:_candidate_prefix] in starts:
+                    candidates.add(word)
+        self._lexize(read, ts_config, sorted(candidates), encoding)
+
+        matches = set()
+        for word in candidates:
+            for lexeme in self._lexemes[(ts_config, word)]:
+                if lexeme in stems or any(
+                        lexeme.startswith(p) for p in prefixes):
+                    matches.add(word)
+                    break
+
+        return [self.summarize(text, matches, **options) for text in texts]
+
+    def _lexize(self, read, ts_config, words, encoding):
+        """Add the lexemes of the given words to the cache."""
+        missing = [w for w in words if (ts_config, w) not in self._lexemes]
+        if not missing:
+            return
+        if len(self._lexemes) + len(missing) > self.cache_size:
+            self._lexemes.clear()
+
+        stmt = """
+        SELECT word, token, lexemes
+        FROM unnest(%s::text[]) AS word, ts_debug(%s, word)
+        """
+        found = dict((word, set()) for word in missing)
+        for word, token, lexemes in read(stmt, (missing, ts_config)):
+            word = _decode(word, encoding)
+            for lexeme in lexemes or ():
+                found[word].add(_decode(lexeme, encoding))
+        for word, lexemes in found.items():
+            self._lexemes[(ts_config, word)] = frozenset(lexemes)
+
+    def summarize(self, text, matches, **options):
+        """Highlight and fragment a text.
+
+        matches is the set of lowercase words to highlight.
+        """
+        start_sel = options.get('startsel', '<b>')
+        stop_sel = options.get('stopsel', '</b>')
+        max_words = int(options.get('maxwords', self.window))
+        min_words = int(options.get('minwords', min(15, max_words)))
+        max_fragments = int(options.get('maxfragments', 0))
+        delimiter = options.get('fragmentdelimiter', ' ... ')
+        highlight_all = '%s' % options.get('highlightall', 'false')
+
+        tokens = [(m.start(), m.end(), m.group().lower() in matches)
+                  for m in _word_re.finditer(text)]
+        if not tokens:
+            return text[:0]
+
+        def render(first, last):
+            # Render tokens[first:last] with the matches highlighted.
+            parts = []
+            pos = tokens[first][0]
+            for start, end, matched in tokens[first:last]:
+                parts.append(text[pos:start])
+                if matched:
+                    parts.extend([start_sel, text[start:end], stop_sel])
+                else:
+                    parts.append(text[start:end])
+                pos = end
+            return u''.join(parts)
+
+        if highlight_all.lower() in ('1', 'true', 'on', 'yes', 't', 'y'):
+            return text[:tokens[0][0]] + render(0, len(tokens)) + (
+                text[tokens[-1][1]:])
+
+        positions = [i for (i, token) in enumerate(tokens) if token[2]]
+        if not positions:
+            return render(0, min(min_words, len(tokens)))
+
+        if max_fragments <= 0:
+            first = _best_window(positions, max_words, len(tokens))
+            return render(first, min(first + max_words, len(tokens)))
+
+        # Choose up to max_fragments non-overlapping windows, each
+        # containing as many matches as possible.
+        fragments = []
+        remaining = list(positions)
+        while remaining and len(fragments) < max_fragments:
+            first = _best_window(remaining, max_words, len(tokens))
+            last = min(first + max_words, len(tokens))
+            for other_first, other_last in fragments:
+                if first < other_last and other_first < last:
+                    # Trim the overlap with a chosen fragment.
+                    if first < other_first:
+                        last = other_first
+                    else:
+                        first = other_last
+            if first < last:
+                fragments.append((first, last))
+            remaining = [i for i in remaining if not first <= i < last]
+            if first >= last:
+                break
+        fragments.sort()
+        return delimiter.join(render(f, l) for (f, l) in fragments)
+
+
+def _decode(s, encoding):
+    if isinstance(s, str):
+        return s.decode(encoding)
+    return s
+
+
+def _best_window(positions, size, count):
+    """Find the start of the window of tokens with the most matches.
+
+    positions is the sorted list of matching token positions.
+    The window begins at a match.
+    """
+    best_start = positions[0]
+    best_matches = 0
+    j = 0
+    for i, start in enumerate(positions):
+        while j < len(positions) and positions[j] < start + size:
+            j += 1
+        if j - i > best_matches:
+            best_start = start
+            best_matches = j - i
+    # Include some words before the first match when the window can
+    # extend past the end of the text.
+    return max(0, min(best_start, count - size))
+
+
+def get_query_terms(query, fields=None):
+    """Get the lowercase words and glob prefixes a query searches for.
+
+    Words that the query excludes are not included.
+    Returns (words, globs).
+    """
+    if isinstance(query, dict):
+        query = query['query']
+    words = []
+    globs = []
+
+    def collect(node):
+        node_type = node.nodeType()
+        if node_type == 'NOT':
+            return
+        elif node_type in ('AND', 'OR'):
+            for child in node.getValue():
+                collect(child)
+        elif node_type == 'FIELD':
+            collect(node.getValue())
+        elif node_type == 'PHRASE':
+            words.extend(remove_special_chars(w) for w in node.getValue())
+        elif node_type == 'GLOB':
+            globs.append(remove_special_chars(node.getValue()))
+        else:
+            words.append(remove_special_chars(node.getValue()))
+
+    collect(QueryParser(fields).parseQuery(query))
+    words = [w.lower() for w in words if w]
+    globs = [w.lower() for w in globs if w]
+    return words, globs
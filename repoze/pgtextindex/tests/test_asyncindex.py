@@ -0,0 +1,272 @@
+
+import unittest
+
+
+class DummyAsyncModule:
+
+    def __init__(self):
+        self.connections = []
+        self.results = []  # One list of rows per query
+        self.errors = []  # One exception or None per poll
+
+    def connect(self, dsn, async_=False):
+        assert async_
+        conn = DummyAsyncConnection(self, dsn)
+        self.connections.append(conn)
+        return conn
+
+
+class DummyAsyncConnection:
+    encoding = 'UTF8'
+    server_version = 90600
+    closed = 0
+
+    def __init__(self, module, dsn):
+        self.module = module
+        self.dsn = dsn
+        self.executed = []
+
+    def fileno(self):
+        return 99
+
+    def poll(self):
+        import psycopg2.extensions
+        if self.module.errors:
+            error = self.module.errors.pop(0)
+            if error is not None:
+                raise error
+        return psycopg2.extensions.POLL_OK
+
+    def cursor(self):
+        return DummyAsyncCursor(self)
+
+    def close(self):
+        self.closed = 1
+
+
+class DummyAsyncCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, stmt, params):
+        self.connection.executed.append((stmt, params))
+        self.rows = self.connection.module.results.pop(0)
+
+    def fetchall(self):
+        return self.rows
+
+    def close(self):
+        pass
+
+
+class TestAsyncPGTextIndex(unittest.TestCase):
+
+    def setUp(self):
+        from repoze.pgtextindex.asyncindex import asyncio
+        if asyncio is None:  # pragma: no cover
+            self.skipTest('asyncio is not available')
+        self.asyncio = asyncio
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def _make_one(self, pool_size=5):
+        from repoze.pgtextindex.asyncindex import AsyncPGTextIndex
+        from repoze.pgtextindex.index import PGTextIndex
+
+        def connection_manager_factory(dsn):
+            raise AssertionError('The async index must not block')
+
+        def discriminator(obj, default):
+            return obj
+
+        index = PGTextIndex(
+            discriminator, 'dbname=dummy',
+            connection_manager_factory=connection_manager_factory)
+        self.module = DummyAsyncModule()
+        return AsyncPGTextIndex(index, pool_size=pool_size, loop=self.loop,
+                                module=self.module)
+
+    def _run(self, future):
+        return self.loop.run_until_complete(future)
+
+    def test_apply(self):
+        async_index = self._make_one()
+        self.module.results.append([(5, 1.5), (6, 0.75)])
+        res = self._run(async_index.apply('Waldo'))
+        self.assertEqual(dict(res), {5: 1.5, 6: 0.75})
+        self.assertTrue(isinstance(res, async_index.index.family.IF.BTree))
+        conn = self.module.connections[0]
+        self.assertEqual(conn.dsn, 'dbname=dummy')
+        stmt, params = conn.executed[0]
+        expected = async_index.index._query_sql('Waldo')
+        self.assertEqual((stmt, params), expected)
+
+    def test_apply_with_read_settings(self):
+        async_index = self._make_one()
+        async_index.index.read_settings = {'jit': False}
+        self.module.results.append([(5, 1.5)])
+        self._run(async_index.apply('Waldo'))
+        stmt, params = self.module.connections[0].executed[0]
+        self.assertTrue(stmt.startswith('SET LOCAL jit = false;\n'))
+
+    def test_apply_with_statement_timeout(self):
+        async_index = self._make_one()
+        async_index.index.statement_timeout = 500
+        self.module.results.append([(5, 1.5)])
+        self._run(async_index.apply('Waldo'))
+        stmt, params = self.module.connections[0].executed[0]
+        self.assertTrue(
+            stmt.startswith('SET LOCAL statement_timeout = 500;\n'))
+
+    def test_apply_timeout_falls_back_to_unranked(self):
+        from psycopg2.extensions import QueryCanceledError
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+            cache_enabled = True
+
+        async_index = self._make_one()
+        async_index.index.statement_timeout = 500
+        self.module.results.extend([[], [(5, 1.0)]])
+        self.module.errors.extend(
+            [None, QueryCanceledError('canceling statement'), None])
+        query = DummyWeightedQuery('Waldo')
+        res = self._run(async_index.apply(query))
+        self.assertEqual(dict(res), {5: 1.0})
+        self.assertTrue(query.degraded)
+        self.assertEqual(query.cache, {})
+        executed = self.module.connections[0].executed
+        self.assertEqual(len(executed), 2)
+        self.assertTrue('ts_rank_cd' in executed[0][0])
+        self.assertFalse('ts_rank_cd' in executed[1][0])
+        self.assertTrue(
+            executed[1][0].startswith('SET LOCAL statement_timeout = 500;'))
+
+    def test_apply_approximate(self):
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+            approximate = True
+
+        async_index = self._make_one()
+        self.module.results.append([(5, 1.5)])
+        query = DummyWeightedQuery('Waldo')
+        self._run(async_index.apply(query))
+        self.assertTrue(query.approximate_result)
+        stmt, params = self.module.connections[0].executed[0]
+        self.assertTrue(
+            stmt.startswith('SET LOCAL gin_fuzzy_search_limit = 5000;\n'))
+
+    def test_connection_reused(self):
+        async_index = self._make_one()
+        self.module.results.extend([[(5, 1.5)], [(6, 1.5)]])
+        self._run(async_index.apply('Waldo'))
+        res = self._run(async_index.applyContains('Carmen'))
+        self.assertEqual(list(res.keys()), [6])
+        self.assertEqual(len(self.module.connections), 1)
+
+    def test_pool_limits_concurrent_queries(self):
+        async_index = self._make_one(pool_size=1)
+        self.module.results.extend([[(5, 1.5)], [(6, 1.5)]])
+        futures = [async_index.apply('Waldo'), async_index.apply('Carmen')]
+        self.assertEqual(len(async_index.pool._waiters), 1)
+        res = self._run(self.asyncio.gather(*futures, loop=self.loop))
+        self.assertEqual([list(r.keys()) for r in res], [[5], [6]])
+        self.assertEqual(len(self.module.connections), 1)
+
+    def test_apply_intersect(self):
+        async_index = self._make_one()
+        self.module.results.append([(5, 1.5)])
+        res = self._run(async_index.apply_intersect('Waldo', [5, 7]))
+        self.assertEqual(dict(res), {5: 1.5})
+        stmt, params = self.module.connections[0].executed[0]
+        self.assertTrue('docid IN (5,7)' in stmt)
+
+    def test_apply_intersect_without_docids(self):
+        async_index = self._make_one()
+        res = self._run(async_index.apply_intersect('Waldo', []))
+        self.assertEqual(dict(res), {})
+        self.assertEqual(self.module.connections, [])
+
+    def test_apply_with_cache(self):
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+            cache_enabled = True
+
+        async_index = self._make_one()
+        self.module.results.append([(5, 1.5)])
+        query = DummyWeightedQuery('Waldo')
+        res1 = self._run(async_index.apply(query))
+        res2 = self._run(async_index.apply(query))
+        self.assertTrue(res1 is res2)
+
+    def test_count(self):
+        async_index = self._make_one()
+        self.module.results.append([(42,)])
+        self.assertEqual(self._run(async_index.count('Waldo')), 42)
+        stmt, params = self.module.connections[0].executed[0]
+        self.assertTrue('SELECT count(1)' in stmt)
+        self.assertEqual(params, ('english', "'Waldo'"))
+
+    def test_get_contextual_summaries(self):
+        async_index = self._make_one()
+        self.module.results.append([('<b>caf\xc3\xa9</b>',)])
+        res = self._run(async_index.get_contextual_summaries(
+            ['caf\xc3\xa9'], 'cafe'))
+        self.assertEqual(res, [u'<b>caf\xe9</b>'])
+
+    def test_get_zero_contextual_summaries(self):
+        async_index = self._make_one()
+        res = self._run(async_index.get_contextual_summaries([], 'cafe'))
+        self.assertEqual(res, [])
+
+    def test_disconnect_discards_connection(self):
+        import psycopg2
+        async_index = self._make_one()
+        self.module.results.append([])
+        self.module.errors.extend([None, psycopg2.OperationalError('gone')])
+
+        def poll():
+            conn.closed = 2
+            return original_poll()
+
+        future = async_index.apply('Waldo')
+        conn = self.module.connections[0]
+        original_poll = conn.poll
+        conn.poll = poll
+        self.assertRaises(psycopg2.OperationalError, self._run, future)
+        self.assertEqual(async_index.pool._open, 0)
+        self.assertEqual(async_index.pool._idle, [])
+
+    def test_query_error_releases_connection(self):
+        import psycopg2
+        async_index = self._make_one()
+        self.module.results.append([])
+        self.module.errors.extend([None, psycopg2.ProgrammingError('bad')])
+        future = async_index.apply('Waldo')
+        self.assertRaises(psycopg2.ProgrammingError, self._run, future)
+        self.assertEqual(async_index.pool._idle, self.module.connections)
+
+    def test_close(self):
+        async_index = self._make_one()
+        self.module.results.append([])
+        self._run(async_index.apply('Waldo'))
+        async_index.close()
+        self.assertTrue(self.module.connections[0].closed)
+        self.assertEqual(async_index.pool._open, 0)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestAsyncPGTextIndex),
+    ))
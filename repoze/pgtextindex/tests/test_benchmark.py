@@ -0,0 +1,198 @@
+
+import unittest
+
+
+class TestCorpus(unittest.TestCase):
+
+    def _make_one(self, **kw):
+        from repoze.pgtextindex.benchmark.corpus import Corpus
+        kw.setdefault('size', 20)
+        kw.setdefault('vocabulary', 1000)
+        kw.setdefault('doc_words', 50)
+        return Corpus(**kw)
+
+    def test_words_are_distinct(self):
+        corpus = self._make_one(vocabulary=6000)
+        self.assertEqual(len(set(corpus.words)), 6000)
+
+    def test_documents_are_reproducible(self):
+        doc1 = self._make_one().document(7)
+        doc2 = self._make_one().document(7)
+        self.assertEqual((doc1.A, str(doc1), doc1.marker),
+                         (doc2.A, str(doc2), doc2.marker))
+        doc3 = self._make_one(seed=1).document(7)
+        self.assertNotEqual(str(doc1), str(doc3))
+
+    def test_document_provides_IWeightedText(self):
+        from repoze.pgtextindex.interfaces import IWeightedText
+        corpus = self._make_one()
+        doc = corpus.document(3)
+        self.assertTrue(IWeightedText.providedBy(doc))
+        self.assertEqual(doc.docid, 3)
+        self.assertEqual(len(doc.A.split()), 8)
+        self.assertTrue(26 <= len(str(doc).split()) <= 77)
+        self.assertTrue(doc.marker in corpus.markers)
+
+    def test_document_with_rng(self):
+        import random
+        corpus = self._make_one()
+        doc1 = corpus.document(7, random.Random(1))
+        doc2 = corpus.document(7, random.Random(2))
+        self.assertEqual((doc1.docid, doc2.docid), (7, 7))
+        self.assertNotEqual(str(doc1), str(doc2))
+        self.assertEqual(str(doc1), str(corpus.document(7, random.Random(1))))
+
+    def test_documents(self):
+        docs = list(self._make_one().documents())
+        self.assertEqual([doc.docid for doc in docs], range(1, 21))
+
+    def test_zipf_distribution(self):
+        import random
+        corpus = self._make_one()
+        rng = random.Random(0)
+        counts = {}
+        for _i in range(10000):
+            word = corpus.word(rng)
+            counts[word] = counts.get(word, 0) + 1
+        # The most common word is about twice as common as the second.
+        first = counts[corpus.words[0]]
+        second = counts[corpus.words[1]]
+        self.assertTrue(1.5 < float(first) / second < 2.5)
+        self.assertTrue(first > 10 * counts.get(corpus.words[100], 0))
+
+    def test_queries(self):
+        from repoze.pgtextindex.benchmark.corpus import QUERY_SHAPES
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+        corpus = self._make_one()
+        for shape in QUERY_SHAPES:
+            queries = corpus.queries(shape, 5)
+            self.assertEqual(len(queries), 5)
+            self.assertEqual(queries, corpus.queries(shape, 5))
+            for query in queries:
+                self.assertTrue(IWeightedQuery.providedBy(query))
+        self.assertTrue(corpus.queries('glob', 1)[0].endswith('*'))
+        self.assertTrue(corpus.queries('marker', 1)[0].marker
+                        in corpus.markers)
+
+    def test_phrase_queries_match_a_document(self):
+        corpus = self._make_one()
+        texts = ' | '.join(str(doc) for doc in corpus.documents())
+        for query in corpus.queries('phrase', 10):
+            self.assertTrue(query.strip('"') in texts)
+
+    def test_unknown_shape(self):
+        self.assertRaises(ValueError, self._make_one().queries, 'fuzzy', 1)
+
+
+class TestPercentiles(unittest.TestCase):
+
+    def _call(self, values):
+        from repoze.pgtextindex.benchmark.run import percentiles
+        return percentiles(values)
+
+    def test_empty(self):
+        self.assertEqual(self._call([]), {'count': 0})
+
+    def test_values(self):
+        res = self._call(range(100, 0, -1))
+        self.assertEqual(res['count'], 100)
+        self.assertEqual(res['min'], 1)
+        self.assertEqual(res['max'], 100)
+        self.assertEqual(res['mean'], 50.5)
+        self.assertEqual(res['p50'], 50)
+        self.assertEqual(res['p99'], 99)
+
+    def test_one_value(self):
+        res = self._call([3])
+        self.assertEqual((res['p50'], res['p99']), (3, 3))
+
+
+
+class TestLoad(unittest.TestCase):
+
+    def test_counting_statsd_client(self):
+        from perfmetrics import set_statsd_client
+        from repoze.pgtextindex import metrics
+        from repoze.pgtextindex.benchmark.load import CountingStatsdClient
+        client = CountingStatsdClient()
+        set_statsd_client(client)
+        self.addCleanup(set_statsd_client, None)
+        metrics.incr('upsert.retry')
+        metrics.incr('upsert.retry', 2)
+        metrics.timing('query.execute', 0.5)
+        self.assertEqual(client.get('upsert.retry'), 3)
+        self.assertEqual(client.get('slow_query'), 0)
+
+    def test_classify_error(self):
+        import psycopg2
+        from repoze.pgtextindex.benchmark.load import classify_error
+
+        class DummyError(psycopg2.OperationalError):
+            pgcode = None
+
+        error = DummyError()
+        self.assertEqual(classify_error(error), 'other_error')
+        error.pgcode = '40P01'
+        self.assertEqual(classify_error(error), 'deadlock')
+        error.pgcode = '40001'
+        self.assertEqual(classify_error(error), 'serialization_failure')
+        self.assertEqual(classify_error(psycopg2.IntegrityError()),
+                         'integrity_error')
+        self.assertEqual(classify_error(ValueError()), 'other_error')
+
+    def test_uniform_docids(self):
+        import random
+        from repoze.pgtextindex.benchmark.load import DocidChooser
+        choose = DocidChooser(50)
+        rng = random.Random(0)
+        docids = set(choose(rng) for _i in range(2000))
+        self.assertEqual(docids, set(range(1, 51)))
+
+    def test_hotkey_docids(self):
+        import random
+        from repoze.pgtextindex.benchmark.load import DocidChooser
+        choose = DocidChooser(1000, 'hotkey', hot_keys=2, hot_fraction=0.9)
+        rng = random.Random(0)
+        docids = [choose(rng) for _i in range(2000)]
+        hot = len([docid for docid in docids if docid <= 2])
+        self.assertTrue(1700 < hot < 1900)
+        self.assertTrue(max(docids) > 2)
+
+    def test_unknown_distribution(self):
+        from repoze.pgtextindex.benchmark.load import DocidChooser
+        self.assertRaises(ValueError, DocidChooser, 10, 'zipf')
+
+    def test_run_rejects_unknown_options(self):
+        from repoze.pgtextindex.benchmark.load import run
+        self.assertRaises(TypeError, run, 'dbname=x', thread=4)
+        self.assertRaises(ValueError, run, 'dbname=x', distribution='zipf')
+
+    def test_summarize(self):
+        from repoze.pgtextindex.benchmark.load import summarize
+        results = [
+            {'latencies': {'write': [1.0, 3.0], 'read': [2.0]},
+             'errors': {'write_deadlock': 1},
+             'upsert_retries': 2},
+            {'latencies': {'write': [5.0], 'read': []},
+             'errors': {'write_deadlock': 1,
+                        'write_serialization_failure': 3},
+             'upsert_retries': 1},
+        ]
+        report = summarize(results, 2.0)
+        self.assertEqual(report['operations'], 4)
+        self.assertEqual(report['operations_per_second'], 2.0)
+        self.assertEqual(report['upsert_retries'], 3)
+        self.assertEqual(report['deadlocks'], 2)
+        self.assertEqual(report['serialization_failures'], 3)
+        self.assertEqual(report['write']['count'], 3)
+        self.assertEqual(report['write']['p50'], 3.0)
+        self.assertEqual(report['write']['per_second'], 1.5)
+        self.assertEqual(report['read']['max'], 2.0)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestCorpus),
+        unittest.makeSuite(TestPercentiles),
+        unittest.makeSuite(TestLoad),
+    ))
@@ -0,0 +1,69 @@
+
+import unittest
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def _make_one(self, max_entries=3, max_size=100):
+        from repoze.pgtextindex.cache import LRUCache
+        return LRUCache(max_entries, max_size)
+
+    def test_get_missing(self):
+        cache = self._make_one()
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 5), 5)
+
+    def test_set_and_get(self):
+        cache = self._make_one()
+        cache.set('a', 'x', 1)
+        self.assertEqual(cache.get('a'), 'x')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 1)
+
+    def test_replace(self):
+        cache = self._make_one()
+        cache.set('a', 'x', 1)
+        cache.set('a', 'yy', 2)
+        self.assertEqual(cache.get('a'), 'yy')
+        self.assertEqual(len(cache), 1)
+        self.assertEqual(cache.size, 2)
+
+    def test_entry_limit_evicts_least_recently_used(self):
+        cache = self._make_one()
+        cache.set('a', 1, 1)
+        cache.set('b', 2, 1)
+        cache.set('c', 3, 1)
+        cache.get('a')
+        cache.set('d', 4, 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.get('d'), 4)
+
+    def test_size_limit(self):
+        cache = self._make_one(max_size=10)
+        cache.set('a', 1, 6)
+        cache.set('b', 2, 6)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('b'), 2)
+        self.assertEqual(cache.size, 6)
+
+    def test_oversized_entry_not_stored(self):
+        cache = self._make_one(max_size=10)
+        cache.set('a', 1, 6)
+        cache.set('b', 2, 11)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+
+    def test_clear(self):
+        cache = self._make_one()
+        cache.set('a', 1, 6)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.size, 0)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestLRUCache),
+    ))
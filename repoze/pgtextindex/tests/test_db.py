@@ -1,60 +1,77 @@
 
 import unittest
 
-class TestPostgresConnectionManager(unittest.TestCase):
 
-    def setUp(self):
-        import transaction
-        transaction.abort()
+class DummyPsycopg2Module:
+    def __init__(self):
+        self.connections = []
 
-    tearDown = setUp
+    def connect(self, dsn):
+        conn = DummyPsycopg2Connection(dsn)
+        self.connections.append(conn)
+        return conn
 
-    def _get_class(self):
-        from repoze.pgtextindex.db import PostgresConnectionManager
-        return PostgresConnectionManager
 
-    def _make_one(self, dsn="dbname=dummy"):
+class DummyPsycopg2Connection:
+    closed = 0
 
-        class DummyPsycopg2Module:
-            def connect(self, dsn):
-                return DummyPsycopg2Connection(dsn)
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.commits = 0
+        self.rollbacks = 0
 
-        class DummyPsycopg2Connection:
-            def __init__(self, dsn):
-                self.dsn = dsn
-                self.commits = 0
-                self.rollbacks = 0
+    def set_isolation_level(self, level):
+        self.isolation_level = level
 
-            def set_isolation_level(self, level):
-                self.isolation_level = level
+    def cursor(self):
+        return DummyPsycopg2Cursor(self)
 
-            def cursor(self):
-                return DummyPsycopg2Cursor(self)
+    def close(self):
+        self._closed = True
 
-            def close(self):
-                self._closed = True
+    def commit(self):
+        self.commits += 1
 
-            def commit(self):
-                self.commits += 1
+    def rollback(self):
+        self.rollbacks += 1
 
-            def rollback(self):
-                self.rollbacks += 1
 
-        class DummyPsycopg2Cursor:
-            def __init__(self, connection):
-                self.connection = connection
-                self.executed = []
+class DummyPsycopg2Cursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.executed = []
+        self.rows = []
 
-            def execute(self, stmt):
-                self.executed.append(stmt)
+    def execute(self, stmt, params=None):
+        self.executed.append(stmt)
 
-            def fetchall(self):
-                return []
+    def fetchall(self):
+        return self.rows
 
-            def close(self):
-                self._closed = True
+    def close(self):
+        self._closed = True
+
+
+class TestPostgresConnectionManager(unittest.TestCase):
+
+    def setUp(self):
+        import transaction
+        transaction.abort()
+
+    tearDown = setUp
+
+    def _get_class(self):
+        from repoze.pgtextindex.db import PostgresConnectionManager
+        return PostgresConnectionManager
 
-        return self._get_class()(dsn, module=DummyPsycopg2Module())
+    def _make_one(self, dsn="dbname=dummy", **kw):
+        return self._get_class()(dsn, module=DummyPsycopg2Module(), **kw)
+
+    def _make_pooled(self, size=1):
+        from repoze.pgtextindex.db import ConnectionPool
+        pool = ConnectionPool(
+            "dbname=dummy", size=size, timeout=0, module=DummyPsycopg2Module())
+        return self._make_one(pool=pool)
 
     def test_class_conforms_to_IDataManager(self):
         from zope.interface.verify import verifyClass
@@ -85,6 +102,18 @@ class TestPostgresConnectionManager(unittest.TestCase):
         self.assertTrue(cm._joined)
         self.assertEqual(cm.cursor.connection.dsn, "dbname=dummy")
 
+    def test_cursor_with_write_settings(self):
+        import transaction
+        cm = self._make_one(write_settings=[('synchronous_commit', 'off')])
+        cursor = cm.cursor
+        cm.cursor
+        self.assertEqual(cursor.executed, [
+            'SELECT 1', "SET LOCAL synchronous_commit = 'off';\n"])
+        transaction.commit()
+        cursor = cm.cursor
+        self.assertEqual(cursor.executed[-1],
+                         "SET LOCAL synchronous_commit = 'off';\n")
+
     def test_join_when_getting_cursor(self):
         cm = self._make_one()
         self.assertFalse(cm._joined)
@@ -198,6 +227,477 @@ class TestPostgresConnectionManager(unittest.TestCase):
         self.assertEqual(sp.rollback(), None)
         self.assertTrue(sp.datamanager is cm)
 
+    def test_pooled_connection_returned_at_commit(self):
+        import transaction
+        cm = self._make_pooled()
+        cursor = cm.cursor
+        conn = cursor.connection
+        self.assertTrue(cm._joined)
+        self.assertEqual(cm.pool._idle, [])
+        transaction.commit()
+        self.assertEqual(conn.commits, 1)
+        self.assertEqual(cm._connection, None)
+        self.assertTrue(cursor._closed)
+        self.assertEqual([c for (c, t) in cm.pool._idle], [conn])
+        # The next transaction borrows the same connection.
+        self.assertTrue(cm.cursor.connection is conn)
+
+    def test_pooled_connection_returned_at_abort(self):
+        import transaction
+        cm = self._make_pooled()
+        conn = cm.connection
+        self.assertTrue(cm._joined)
+        transaction.abort()
+        self.assertEqual(conn.rollbacks, 1)
+        self.assertEqual([c for (c, t) in cm.pool._idle], [conn])
+        self.assertFalse(cm._joined)
+
+    def test_pooled_connection_shared_in_transaction(self):
+        import transaction
+        cm1 = self._make_pooled(size=1)
+        cm2 = self._make_one(pool=cm1.pool)
+        cm1.execute_read('SELECT x', ())
+        cursor = cm1.cursor
+        conn = cursor.connection
+        # The second manager does not wait for another connection.
+        self.assertTrue(cm2.read_cursor.connection is conn)
+        self.assertFalse(conn.autocommit)
+        self.assertEqual(len(cm1.pool.module.connections), 1)
+        self.assertEqual(conn.rollbacks, 1)  # Checked once
+        self.assertTrue(cm1._lease is cm2._lease)
+        transaction.commit()
+        self.assertEqual(cm1.pool._leases, {})
+        self.assertEqual([c for (c, t) in cm1.pool._idle], [conn])
+        # Each transaction gets a Lease of its own.
+        self.assertTrue(cm2.cursor.connection is conn)
+        self.assertFalse(cm1._joined)
+        transaction.abort()
+
+    def test_pooled_connection_returned_after_last_manager(self):
+        cm1 = self._make_pooled(size=1)
+        cm2 = self._make_one(pool=cm1.pool)
+        conn = cm1.connection
+        cm2.connection
+        cm1.tpc_finish(None)
+        self.assertEqual(cm1.pool._idle, [])
+        cm2.tpc_finish(None)
+        self.assertEqual([c for (c, t) in cm1.pool._idle], [conn])
+
+    def test_pooled_connection_reopened_for_other_manager(self):
+        cm1 = self._make_pooled(size=1)
+        cm2 = self._make_one(pool=cm1.pool)
+        old = cm1.cursor.connection
+        cm2.connection
+        cm2.close()
+        self.assertTrue(old._closed)
+        cursor = cm1.cursor
+        self.assertFalse(cursor.connection is old)
+        self.assertTrue(cm2.cursor.connection is cursor.connection)
+        self.assertEqual(cm1.pool._open, 1)
+
+    def test_pooled_connection_discarded_on_close(self):
+        cm = self._make_pooled()
+        conn = cm.connection
+        cm.close()
+        self.assertTrue(conn._closed)
+        self.assertEqual(cm.pool._open, 0)
+        self.assertEqual(cm.pool._idle, [])
+
+    def test_pooled_reopen_after_postgres_goes_away(self):
+        import transaction
+        cm = self._make_pooled()
+        cursor = cm.cursor
+        transaction.commit()
+
+        def simulate_disconnected(stmt):
+            from psycopg2 import OperationalError
+            raise OperationalError("synthetic disconnect")
+
+        cursor.connection.cursor = lambda: cursor
+        cursor.execute = simulate_disconnected
+        cursor2 = cm.cursor
+        self.assertNotEqual(cursor2, cursor)
+        self.assertEqual(cm.pool._open, 1)
+        self.assertEqual(len(cm.pool.module.connections), 2)
+
+    def test_ping_when_joining(self):
+        cm = self._make_one()
+        cursor = cm.cursor
+        self.assertEqual(cursor.executed, ['SELECT 1'])
+        self.assertEqual(cursor.connection.rollbacks, 1)
+
+    def test_skip_ping_when_used_recently(self):
+        import transaction
+        cm = self._make_one(ping_interval=60)
+        cursor = cm.cursor
+        transaction.commit()
+        self.assertTrue(cm.cursor is cursor)
+        self.assertEqual(cursor.executed, [])
+        self.assertEqual(cursor.connection.rollbacks, 0)
+
+    def test_ping_after_interval(self):
+        import transaction
+        cm = self._make_one(ping_interval=60)
+        cursor = cm.cursor
+        transaction.commit()
+        cm._lease.last_used -= 61
+        cm.cursor
+        self.assertEqual(cursor.executed, ['SELECT 1'])
+
+    def test_skip_ping_for_recently_returned_pooled_connection(self):
+        import transaction
+        cm = self._make_pooled()
+        cm.ping_interval = 60
+        cursor = cm.cursor
+        transaction.commit()
+        cursor = cm.cursor
+        self.assertEqual(cursor.executed, [])
+
+    def _make_broken_cursor(self, cm, error):
+        cursor = cm._get_cursor()
+
+        def execute(stmt, params=None):
+            cursor.connection.closed = 2
+            raise error
+
+        cursor.execute = execute
+        return cursor
+
+    def test_execute_read(self):
+        cm = self._make_one()
+        cursor = cm._get_cursor()
+        cursor.rows = [(1,)]
+        self.assertEqual(cm.execute_read('SELECT x', ()), [(1,)])
+        self.assertEqual(cursor.executed, ['SELECT 1', 'SELECT x'])
+        self.assertTrue(cm._joined)
+        self.assertFalse(cm._wrote)
+
+    def test_execute_read_with_statement_timeout(self):
+        cm = self._make_one()
+        cursor = cm._get_cursor()
+        cm.execute_read('SELECT x', (), [('statement_timeout', 250)])
+        self.assertEqual(cursor.executed, [
+            'SELECT 1', 'SET LOCAL statement_timeout = 250;\nSELECT x'])
+
+    def test_execute_read_retries_after_disconnect(self):
+        import psycopg2
+        cm = self._make_one()
+        cursor = self._make_broken_cursor(
+            cm, psycopg2.OperationalError('server closed the connection'))
+        self.assertEqual(cm.execute_read('SELECT x', ()), [])
+        self.assertTrue(cursor._closed)
+        self.assertEqual(cm._cursor.executed, ['SELECT x'])
+
+    def test_execute_read_no_retry_after_cursor_used(self):
+        import psycopg2
+        cm = self._make_one()
+        cm.cursor
+        self._make_broken_cursor(cm, psycopg2.OperationalError('closed'))
+        self.assertRaises(psycopg2.OperationalError,
+                          cm.execute_read, 'SELECT x', ())
+
+    def test_execute_read_no_retry_when_connection_open(self):
+        import psycopg2
+        from psycopg2.extensions import QueryCanceledError
+        cm = self._make_one()
+        cursor = cm._get_cursor()
+
+        def execute(stmt, params=None):
+            raise QueryCanceledError('statement timeout')
+
+        cursor.execute = execute
+        self.assertRaises(psycopg2.OperationalError,
+                          cm.execute_read, 'SELECT x', ())
+        self.assertTrue(cm._cursor is cursor)
+
+    def test_read_only_transaction_uses_autocommit(self):
+        import transaction
+        cm = self._make_one()
+        cm.execute_read('SELECT x', ())
+        conn = cm._connection
+        self.assertTrue(conn.autocommit)
+        self.assertEqual(conn.rollbacks, 1)
+        transaction.commit()
+        self.assertEqual(conn.commits, 0)
+        self.assertEqual(conn.rollbacks, 1)
+        cm.execute_read('SELECT x', ())
+        transaction.abort()
+        self.assertEqual(conn.commits, 0)
+        self.assertEqual(conn.rollbacks, 2)
+
+    def test_read_cursor(self):
+        import transaction
+        cm = self._make_one(write_settings=[('synchronous_commit', 'off')])
+        cursor = cm.read_cursor
+        self.assertTrue(cm._joined)
+        self.assertFalse(cm._wrote)
+        self.assertTrue(cm._connection.autocommit)
+        self.assertEqual(cursor.executed, ['SELECT 1'])
+        transaction.commit()
+        self.assertEqual(cm._connection.commits, 0)
+
+    def test_write_after_read_uses_transaction(self):
+        import transaction
+        cm = self._make_one()
+        cm.execute_read('SELECT x', ())
+        conn = cm._connection
+        cm.cursor.execute('UPDATE x')
+        self.assertFalse(conn.autocommit)
+        cm.execute_read('SELECT x', ())
+        self.assertFalse(conn.autocommit)
+        transaction.commit()
+        self.assertEqual(conn.commits, 1)
+
+    def test_pooler_safe(self):
+        cm = self._make_one(pooler_safe=True)
+        cursor = cm.cursor
+        self.assertFalse(hasattr(cursor.connection, 'isolation_level'))
+        self.assertEqual(cursor.executed, [])
+        self.assertEqual(cursor.connection.rollbacks, 0)
+
+    def test_close_idle(self):
+        import transaction
+        cm = self._make_one()
+        self.assertEqual(cm.close_idle(60), 0)
+        conn = cm.cursor.connection
+        self.assertEqual(cm.close_idle(0), 0)  # Joined
+        transaction.commit()
+        self.assertEqual(cm.close_idle(60), 0)
+        cm._lease.last_used -= 61
+        self.assertEqual(cm.close_idle(60), 1)
+        self.assertTrue(conn._closed)
+        self.assertEqual(cm._connection, None)
+        # Reopen on the next use.
+        self.assertFalse(cm.cursor.connection is conn)
+
+    def test_connection_joins_before_use(self):
+        import transaction
+        cm = self._make_one()
+        conn = cm.cursor.connection
+        transaction.commit()
+        cm._lease.last_used -= 61
+        self.assertTrue(cm.connection is conn)
+        self.assertTrue(cm._joined)
+        # The reaper leaves the connection alone while it is in use.
+        self.assertEqual(cm.close_idle(60), 0)
+        self.assertFalse(hasattr(conn, '_closed'))
+
+    def test_register_with_reaper(self):
+        from repoze.pgtextindex.db import reaper
+        cm = self._make_one(idle_timeout=60)
+        self.assertEqual(reaper._targets[cm], 60)
+        pooled = self._make_pooled()
+        cm = self._make_one(pool=pooled.pool, idle_timeout=30)
+        self.assertEqual(reaper._targets[cm.pool], 30)
+        self.assertFalse(cm in reaper._targets)
+
+
+class TestIdleReaper(unittest.TestCase):
+
+    def _make_one(self):
+        from repoze.pgtextindex.db import IdleReaper
+        return IdleReaper(interval=3600)
+
+    def test_reap(self):
+        class DummyTarget:
+            def __init__(self, closed):
+                self.closed = closed
+                self.timeouts = []
+
+            def close_idle(self, idle_timeout):
+                self.timeouts.append(idle_timeout)
+                return self.closed
+
+        reaper = self._make_one()
+        a = DummyTarget(1)
+        b = DummyTarget(0)
+        reaper.add(a, 60)
+        reaper.add(b, 30)
+        self.assertTrue(reaper._thread.daemon)
+        self.assertEqual(reaper.reap(), 1)
+        self.assertEqual(a.timeouts, [60])
+        self.assertEqual(b.timeouts, [30])
+
+    def test_targets_are_weak(self):
+        class DummyTarget:
+            def close_idle(self, idle_timeout):
+                return 0
+
+        reaper = self._make_one()
+        reaper.add(DummyTarget(), 60)
+        self.assertEqual(len(reaper._targets), 0)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def _make_one(self, size=2, timeout=0):
+        from repoze.pgtextindex.db import ConnectionPool
+        return ConnectionPool(
+            "dbname=dummy", size=size, timeout=timeout,
+            module=DummyPsycopg2Module())
+
+    def test_get_opens_connection(self):
+        import psycopg2
+        pool = self._make_one()
+        conn, last_used = pool.get()
+        self.assertTrue(last_used)
+        self.assertEqual(conn.dsn, "dbname=dummy")
+        self.assertEqual(conn.isolation_level,
+            psycopg2.extensions.ISOLATION_LEVEL_READ_COMMITTED)
+        self.assertEqual(pool._open, 1)
+
+    def test_pooler_safe(self):
+        from repoze.pgtextindex.db import ConnectionPool
+        pool = ConnectionPool("dbname=dummy", module=DummyPsycopg2Module(),
+                              pooler_safe=True)
+        conn, last_used = pool.get()
+        self.assertFalse(hasattr(conn, 'isolation_level'))
+
+    def test_put_and_reuse(self):
+        pool = self._make_one()
+        conn, last_used = pool.get()
+        pool.put(conn)
+        self.assertTrue(pool.get()[0] is conn)
+        self.assertEqual(len(pool.module.connections), 1)
+
+    def test_timeout_when_exhausted(self):
+        from repoze.pgtextindex.db import PoolTimeout
+        from transaction.interfaces import TransientError
+        pool = self._make_one(size=2)
+        pool.get()
+        pool.get()
+        self.assertRaises(PoolTimeout, pool.get)
+        self.assertTrue(issubclass(PoolTimeout, TransientError))
+
+    def test_wait_for_returned_connection(self):
+        import threading
+        pool = self._make_one(size=1, timeout=5)
+        conn, last_used = pool.get()
+        timer = threading.Timer(0.01, pool.put, (conn,))
+        timer.start()
+        try:
+            self.assertTrue(pool.get()[0] is conn)
+        finally:
+            timer.join()
+
+    def test_discard_frees_slot(self):
+        pool = self._make_one(size=1)
+        conn, last_used = pool.get()
+        pool.discard(conn)
+        self.assertTrue(conn._closed)
+        self.assertFalse(pool.get()[0] is conn)
+
+    def test_connect_failure_frees_slot(self):
+        import psycopg2
+        pool = self._make_one(size=1)
+
+        def connect(dsn):
+            raise psycopg2.OperationalError('refused')
+
+        pool.module.connect = connect
+        self.assertRaises(psycopg2.OperationalError, pool.get)
+        self.assertEqual(pool._open, 0)
+
+    def test_close_idle(self):
+        pool = self._make_one()
+        old, last_used = pool.get()
+        new, last_used = pool.get()
+        pool.put(old)
+        pool.put(new)
+        pool._idle[0] = (old, pool._idle[0][1] - 61)
+        self.assertEqual(pool.close_idle(60), 1)
+        self.assertTrue(old._closed)
+        self.assertEqual([c for (c, t) in pool._idle], [new])
+        self.assertEqual(pool._open, 1)
+
+    def test_clear(self):
+        pool = self._make_one()
+        conn, last_used = pool.get()
+        pool.put(conn)
+        pool.clear()
+        self.assertTrue(conn._closed)
+        self.assertEqual(pool._open, 0)
+        self.assertEqual(pool._idle, [])
+
+
+class TestGetPool(unittest.TestCase):
+
+    def tearDown(self):
+        from repoze.pgtextindex import db
+        db._pools.pop('dbname=pooltest', None)
+
+    def test_one_pool_per_dsn(self):
+        from repoze.pgtextindex.db import get_pool
+        pool = get_pool('dbname=pooltest', 3, 5.0)
+        self.assertEqual(pool.size, 3)
+        self.assertEqual(pool.timeout, 5.0)
+        self.assertTrue(get_pool('dbname=pooltest', 4, 1.0) is pool)
+
+
+class TestReadRows(unittest.TestCase):
+
+    def _call(self, cursor, *args):
+        from repoze.pgtextindex.db import read_rows
+        return read_rows(cursor, 'SELECT x', (), *args)
+
+    def _make_cursor(self, error=None):
+        cursor = DummyPsycopg2Cursor(DummyPsycopg2Connection('dbname=dummy'))
+        cursor.rows = [(1,)]
+        if error is not None:
+            def execute(stmt, params=None):
+                cursor.executed.append(stmt)
+                if stmt.startswith('SAVEPOINT'):
+                    raise error
+
+            cursor.execute = execute
+        return cursor
+
+    def test_without_timeout(self):
+        cursor = self._make_cursor()
+        self.assertEqual(self._call(cursor), [(1,)])
+        self.assertEqual(cursor.executed, ['SELECT x'])
+
+    def test_autocommit(self):
+        cursor = self._make_cursor()
+        rows = self._call(cursor, [('statement_timeout', 100)], True)
+        self.assertEqual(rows, [(1,)])
+        self.assertEqual(cursor.executed, [
+            'SET LOCAL statement_timeout = 100;\nSELECT x'])
+
+    def test_timings(self):
+        cursor = self._make_cursor()
+        timings = {}
+        read_rows_args = ([('statement_timeout', 100)], False, timings)
+        self._call(cursor, *read_rows_args)
+        self.assertEqual(sorted(timings), ['execute', 'fetch'])
+        self.assertTrue(timings['execute'] >= 0)
+
+    def test_quoted_values(self):
+        cursor = self._make_cursor()
+        self._call(cursor, [('work_mem', '64MB'), ('jit', False)], True)
+        self.assertEqual(cursor.executed, [
+            "SET LOCAL work_mem = '64MB';\n"
+            "SET LOCAL jit = false;\nSELECT x"])
+
+    def test_in_transaction(self):
+        cursor = self._make_cursor()
+        rows = self._call(cursor, [('statement_timeout', 100)], False)
+        self.assertEqual(rows, [(1,)])
+        self.assertEqual(cursor.executed, [
+            'SAVEPOINT pgtextindex_read;\n'
+            'SET LOCAL statement_timeout = 100;\nSELECT x',
+            'ROLLBACK TO SAVEPOINT pgtextindex_read;\n'
+            'RELEASE SAVEPOINT pgtextindex_read',
+        ])
+
+    def test_timeout_in_transaction(self):
+        from psycopg2.extensions import QueryCanceledError
+        cursor = self._make_cursor(QueryCanceledError('statement timeout'))
+        self.assertRaises(QueryCanceledError, self._call, cursor,
+                          [('statement_timeout', 100)])
+        self.assertEqual(len(cursor.executed), 2)
+        self.assertTrue(cursor.executed[1].startswith('ROLLBACK TO'))
+
 
 class TestSafeClose(unittest.TestCase):
 
@@ -249,4 +749,8 @@ class TestSafeClose(unittest.TestCase):
 def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(TestPostgresConnectionManager),
+        unittest.makeSuite(TestIdleReaper),
+        unittest.makeSuite(TestConnectionPool),
+        unittest.makeSuite(TestGetPool),
+        unittest.makeSuite(TestReadRows),
     ))
@@ -11,7 +11,7 @@ class TestPGTextIndex(unittest.TestCase):
 
     def _make_one(self, discriminator=None, dsn="dbname=dummy",
                   results=((5, 1.3), (6, 0.7)), execute_errors=None,
-                  rowcounts=(1,), **kw):
+                  rowcounts=(1,), fetchone_results=None, **kw):
         if discriminator is None:
             def discriminator(obj, default):
                 return obj
@@ -59,6 +59,8 @@ class TestPGTextIndex(unittest.TestCase):
                 return iter(results)
 
             def fetchone(self):
+                if fetchone_results is not None:
+                    return fetchone_results.pop(0)
                 return results[0]
 
             def fetchall(self):
@@ -95,6 +97,106 @@ class TestPGTextIndex(unittest.TestCase):
         index = self._make_one(drop_and_create=True)
         self.assertNotEqual(None, index._v_temp_cm)
 
+    def test_ctor_invalid_field_weights(self):
+        self.assertRaises(ValueError, self._make_one,
+            fields={'title': 'X'})
+        self.assertRaises(ValueError, self._make_one,
+            fields={'title': ''})
+
+    def test_ctor_invalid_partitioning(self):
+        self.assertRaises(ValueError, self._make_one, partition_by='docid')
+        self.assertRaises(ValueError, self._make_one, partition_by='docid',
+                          partitions=0)
+        self.assertRaises(ValueError, self._make_one, partition_by='marker')
+        self.assertRaises(ValueError, self._make_one, partition_by='marker',
+                          partitions='book')
+        self.assertRaises(ValueError, self._make_one, partition_by='title',
+                          partitions=4)
+
+    def _format_stmt(self, stmt):
+        return [line.strip() for line in stmt.splitlines() if line.strip()]
+
+    def test_create_table_sql(self):
+        index = self._make_one()
+        stmt, params = index._create_table_sql()
+        self.assertEqual(self._format_stmt(stmt), [
+            'DROP TABLE IF EXISTS pgtextindex;',
+            'CREATE TABLE pgtextindex (',
+            'docid INTEGER NOT NULL PRIMARY KEY,',
+            'coefficient REAL NOT NULL DEFAULT 1.0,',
+            'marker CHARACTER VARYING ARRAY,',
+            'text_vector tsvector',
+            ');',
+            'CREATE INDEX pgtextindex_index',
+            'ON pgtextindex',
+            'USING gin(text_vector);',
+            'CREATE INDEX pgtextindex_marker_index',
+            'ON pgtextindex',
+            'USING gin(marker)',
+        ])
+        self.assertEqual(params, None)
+
+    def test_create_table_sql_partitioned_by_docid(self):
+        index = self._make_one(partition_by='docid', partitions=2)
+        stmt, params = index._create_table_sql()
+        lines = self._format_stmt(stmt)
+        self.assertEqual(lines[1:8], [
+            'CREATE TABLE pgtextindex (',
+            'docid INTEGER NOT NULL PRIMARY KEY,',
+            'coefficient REAL NOT NULL DEFAULT 1.0,',
+            'marker CHARACTER VARYING ARRAY,',
+            'text_vector tsvector',
+            ') PARTITION BY HASH (docid);',
+            'CREATE TABLE pgtextindex_p0 PARTITION OF pgtextindex '
+            'FOR VALUES WITH (MODULUS 2, REMAINDER 0);',
+        ])
+        self.assertEqual(lines[8],
+            'CREATE TABLE pgtextindex_p1 PARTITION OF pgtextindex '
+            'FOR VALUES WITH (MODULUS 2, REMAINDER 1);')
+        self.assertEqual(params, None)
+
+    def test_create_table_sql_partitioned_by_marker(self):
+        index = self._make_one(partition_by='marker',
+                               partitions=('book', 'film'))
+        stmt, params = index._create_table_sql()
+        lines = self._format_stmt(stmt)
+        self.assertEqual(lines[1:11], [
+            'CREATE TABLE pgtextindex (',
+            'docid INTEGER NOT NULL,',
+            'coefficient REAL NOT NULL DEFAULT 1.0,',
+            'marker CHARACTER VARYING ARRAY,',
+            'text_vector tsvector',
+            ') PARTITION BY LIST ((marker[1]));',
+            'CREATE TABLE pgtextindex_p0 PARTITION OF pgtextindex '
+            'FOR VALUES IN (%s);',
+            'CREATE TABLE pgtextindex_p1 PARTITION OF pgtextindex '
+            'FOR VALUES IN (%s);',
+            'CREATE TABLE pgtextindex_default PARTITION OF pgtextindex '
+            'DEFAULT;',
+            'CREATE INDEX pgtextindex_docid_index ON pgtextindex (docid);',
+        ])
+        self.assertEqual(params, ('book', 'film'))
+
+    def test_create_table_sql_with_rank_vector(self):
+        index = self._make_one(rank_maxlen=1000)
+        stmt, params = index._create_table_sql()
+        lines = self._format_stmt(stmt)
+        self.assertEqual(lines[5:8], [
+            'text_vector tsvector,',
+            'rank_vector tsvector',
+            ');',
+        ])
+
+    def test_create_table_sql_with_source_text(self):
+        index = self._make_one(store_text=True)
+        stmt, params = index._create_table_sql()
+        lines = self._format_stmt(stmt)
+        self.assertEqual(lines[5:8], [
+            'text_vector tsvector,',
+            'source_text text',
+            ');',
+        ])
+
     def test_connection_manager_from_volatile_attr(self):
         index = self._make_one()
         self.assertEqual(None, index._v_temp_cm)
@@ -133,6 +235,307 @@ class TestPGTextIndex(unittest.TestCase):
         cursor = index.cursor
         self.assertTrue(hasattr(cursor, 'execute'))
 
+    def test_connection_manager_with_pool(self):
+        from repoze.pgtextindex import db
+        from repoze.pgtextindex.db import PostgresConnectionManager
+        self.addCleanup(db._pools.pop, 'dbname=pooled', None)
+        index = self._make_one(dsn='dbname=pooled', pool_size=3,
+                               pool_timeout=2.0)
+        index.connection_manager_factory = PostgresConnectionManager
+        cm = index.connection_manager
+        self.assertEqual(cm.pool.dsn, 'dbname=pooled')
+        self.assertEqual(cm.pool.size, 3)
+        self.assertEqual(cm.pool.timeout, 2.0)
+        self.assertTrue(cm.pool is db.get_pool('dbname=pooled'))
+
+    def test_indexes_share_pooled_connection_in_transaction(self):
+        import transaction
+        from repoze.pgtextindex import db
+        from repoze.pgtextindex.db import ConnectionPool
+        from repoze.pgtextindex.db import PostgresConnectionManager
+        from repoze.pgtextindex.tests.test_db import DummyPsycopg2Module
+        pool = ConnectionPool('dbname=pooled', size=1, timeout=0,
+                              module=DummyPsycopg2Module())
+        db._pools['dbname=pooled'] = pool
+        self.addCleanup(db._pools.pop, 'dbname=pooled', None)
+        self.addCleanup(transaction.abort)
+        index1 = self._make_one(dsn='dbname=pooled', pool_size=1)
+        index2 = self._make_one(dsn='dbname=pooled', pool_size=1,
+                                table='other')
+        for index in (index1, index2):
+            index.connection_manager_factory = PostgresConnectionManager
+        conn = index1.cursor.connection
+        # Without sharing, this would raise PoolTimeout.
+        self.assertTrue(index2.cursor.connection is conn)
+        transaction.commit()
+        self.assertTrue(conn.commits)
+        self.assertEqual([c for (c, t) in pool._idle], [conn])
+
+    def test_connection_manager_with_ping_interval(self):
+        from repoze.pgtextindex.db import PostgresConnectionManager
+        index = self._make_one(ping_interval=5)
+        index.connection_manager_factory = PostgresConnectionManager
+        self.assertEqual(index.connection_manager.ping_interval, 5)
+
+    def test_connection_manager_pooler_safe(self):
+        from repoze.pgtextindex import db
+        from repoze.pgtextindex.db import PostgresConnectionManager
+        self.addCleanup(db._pools.pop, 'dbname=bouncer', None)
+        index = self._make_one(dsn='dbname=bouncer', pooler_safe=True,
+                               pool_size=2)
+        index.connection_manager_factory = PostgresConnectionManager
+        cm = index.connection_manager
+        self.assertTrue(cm.pooler_safe)
+        self.assertTrue(cm.pool.pooler_safe)
+
+    def test_connection_manager_with_write_settings(self):
+        from repoze.pgtextindex.db import PostgresConnectionManager
+        index = self._make_one(write_settings={'synchronous_commit': 'off'})
+        index.connection_manager_factory = PostgresConnectionManager
+        self.assertEqual(index.connection_manager.write_settings,
+                         (('synchronous_commit', 'off'),))
+
+    def test_read_settings(self):
+        index = self._make_one(
+            read_settings={'jit': False, 'work_mem': '64MB'},
+            statement_timeout=500)
+        index.applyContains('Waldo')
+        stmt, params = self.executed[0]
+        self.assertTrue(stmt.startswith(
+            'SAVEPOINT pgtextindex_read;\n'
+            'SET LOCAL jit = false;\n'
+            "SET LOCAL work_mem = '64MB';\n"
+            'SET LOCAL statement_timeout = 500;\n'))
+
+    def test_invalid_setting_names(self):
+        self.assertRaises(ValueError, self._make_one,
+                          read_settings={'jit = off; DROP TABLE x': 1})
+        self.assertRaises(ValueError, self._make_one,
+                          write_settings={'jit\n': False})
+        self.assertRaises(ValueError, self._make_one,
+                          read_settings={1: False})
+        index = self._make_one(read_settings={'pg_trgm.word_limit': 1})
+        self.assertEqual(index.read_settings, {'pg_trgm.word_limit': 1})
+
+    def test_queries_use_execute_read(self):
+        index = self._make_one()
+        cm = index.connection_manager
+        reads = []
+
+        def execute_read(stmt, params=None, timings=None):
+            reads.append((stmt, params))
+            return [(5, 1.5)]
+
+        cm.execute_read = execute_read
+        res = index.applyContains('Waldo')
+        self.assertEqual(dict(res), {5: 1.5})
+        self.assertEqual(len(reads), 1)
+        self.assertEqual(self.executed, [])
+
+    def _make_replicated(self, **kw):
+        from repoze.pgtextindex import index as index_module
+        index_module._replica_status.clear()
+        self.addCleanup(index_module._replica_status.clear)
+        return self._make_one(read_dsns='dbname=replica', **kw)
+
+    def test_read_connection_manager_without_replicas(self):
+        index = self._make_one()
+        self.assertTrue(
+            index.read_connection_manager is index.connection_manager)
+
+    def test_read_connection_manager_uses_replica(self):
+        index = self._make_replicated()
+        self.assertEqual(index.read_dsns, ('dbname=replica',))
+        cm = index.read_connection_manager
+        self.assertEqual(cm.dsn, 'dbname=replica')
+        self.assertTrue(cm is index.read_connection_manager)
+        self.assertEqual(self.executed, [])
+
+    def test_read_connection_manager_from_jar(self):
+        class DummyZODBConnection:
+            pass
+
+        index = self._make_replicated()
+        index._p_jar = jar = DummyZODBConnection()
+        index._p_oid = '1' * 8
+        cm = index.read_connection_manager
+        self.assertEqual(cm.dsn, 'dbname=replica')
+        self.assertTrue(jar.foreign_connections[('1' * 8, 'dbname=replica')]
+                        is cm)
+
+    def test_queries_use_replica(self):
+        index = self._make_replicated()
+        primary = index.connection_manager
+
+        class DummyCursor:
+            def __init__(self):
+                self.executed = []
+
+            def execute(self, stmt, params=None):
+                self.executed.append((stmt, params))
+
+            def fetchall(self):
+                return [(5, 1.5)]
+
+        replica_cursor = index.read_connection_manager.cursor = DummyCursor()
+        res = index.applyContains('Waldo')
+        self.assertEqual(dict(res), {5: 1.5})
+        self.assertEqual(len(replica_cursor.executed), 1)
+        self.assertEqual(self.executed, [])
+        index.unindex_doc(5)
+        self.assertEqual(len(self.executed), 1)
+        self.assertEqual(len(replica_cursor.executed), 1)
+        self.assertTrue(index.connection_manager is primary)
+
+    def test_docids_from_primary(self):
+        index = self._make_replicated(results=[(5,)])
+
+        class DummyCursor:
+            def execute(self, stmt, params=None):
+                raise AssertionError('read from the replica')
+
+        index.read_connection_manager.cursor = DummyCursor()
+        self.assertEqual(list(index.docids(primary=True)), [5])
+        self.assertEqual(len(self.executed), 1)
+
+    def test_migrate_to_0_8_0_reads_primary(self):
+        index = self._make_replicated(results=[(5,)])
+
+        class DummyCursor:
+            def execute(self, stmt, params=None):
+                raise AssertionError('read from the replica')
+
+        index.read_connection_manager.cursor = DummyCursor()
+        index._migrate_to_0_8_0(index.family.IF.Set([5]))
+        self.assertEqual(len(self.executed), 1)
+
+    def test_read_connection_manager_after_write(self):
+        index = self._make_replicated()
+        index.connection_manager._joined = True
+        self.assertTrue(
+            index.read_connection_manager is index.connection_manager)
+
+    def test_read_connection_manager_replica_unavailable(self):
+        import psycopg2
+        index = self._make_replicated()
+
+        class BrokenConnectionManager:
+            dsn = 'dbname=replica'
+            attempts = 0
+            closed = False
+
+            @property
+            def connection(self):
+                self.attempts += 1
+                raise psycopg2.OperationalError('down')
+
+            def close(self):
+                self.closed = True
+
+        broken = BrokenConnectionManager()
+        index._v_temp_read_cms = {(None, 'dbname=replica'): broken}
+        self.assertTrue(
+            index.read_connection_manager is index.connection_manager)
+        self.assertTrue(broken.closed)
+        # The failure is remembered.
+        self.assertTrue(
+            index.read_connection_manager is index.connection_manager)
+        self.assertEqual(broken.attempts, 1)
+
+    def test_read_connection_manager_replica_lagging(self):
+        index = self._make_replicated(
+            max_replica_lag=5, results=[(30.0,)])
+        self.assertTrue(
+            index.read_connection_manager is index.connection_manager)
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(lines, [
+            'SELECT extract(epoch FROM now() - '
+            'pg_last_xact_replay_timestamp())'])
+        # The lag is remembered.
+        self.assertTrue(
+            index.read_connection_manager is index.connection_manager)
+        self.assertEqual(len(self.executed), 1)
+
+    def test_read_connection_manager_replica_not_lagging(self):
+        index = self._make_replicated(
+            max_replica_lag=5, results=[(1.0,)])
+        cm = index.read_connection_manager
+        self.assertEqual(cm.dsn, 'dbname=replica')
+        self.assertEqual(len(self.executed), 1)
+
+    def _make_two_replicas(self, first, **kw):
+        import transaction
+        from repoze.pgtextindex import index as index_module
+        self.addCleanup(transaction.abort)
+        index = self._make_replicated(**kw)
+        index.read_dsns = ('dbname=r1', 'dbname=r2')
+
+        class DummyRandom:
+            def sample(self, seq, k):
+                return list(seq)
+
+        self.addCleanup(setattr, index_module, 'random', index_module.random)
+        index_module.random = DummyRandom()
+
+        class DummyReplicaManager:
+            _joined = False
+
+            def __init__(self, dsn, lag=0.0, down=False):
+                self.dsn = dsn
+                self.lag = lag
+                self.down = down
+                self.reads = 0
+
+            @property
+            def connection(self):
+                # Like PostgresConnectionManager, join before connecting.
+                self._joined = True
+                if self.down:
+                    raise psycopg2.OperationalError('down')
+
+            def execute_read(self, stmt, params=None, **kw):
+                self.connection
+                self.reads += 1
+                if 'pg_last_xact_replay_timestamp' in stmt:
+                    return [(self.lag,)]
+                return [(5, 1.5)]
+
+            def close(self):
+                pass
+
+        import psycopg2
+        r1 = DummyReplicaManager('dbname=r1', **first)
+        r2 = DummyReplicaManager('dbname=r2')
+        index._v_temp_read_cms = {(None, 'dbname=r1'): r1,
+                                  (None, 'dbname=r2'): r2}
+        return index, r1, r2
+
+    def test_read_connection_manager_skips_lagging_replica(self):
+        index, r1, r2 = self._make_two_replicas(
+            {'lag': 100.0}, max_replica_lag=5)
+        self.assertEqual(dict(index.applyContains('Waldo')), {5: 1.5})
+        self.assertEqual(dict(index.applyContains('Waldo')), {5: 1.5})
+        self.assertTrue(r1._joined)
+        self.assertEqual(r1.reads, 1)  # Only the lag check
+        self.assertEqual(r2.reads, 3)
+        self.assertEqual(self.executed, [])
+
+    def test_read_connection_manager_skips_unavailable_replica(self):
+        index, r1, r2 = self._make_two_replicas({'down': True})
+        self.assertTrue(index.read_connection_manager is r2)
+        self.assertTrue(r1._joined)
+        self.assertTrue(index.read_connection_manager is r2)
+
+    def test_read_connection_manager_new_transaction(self):
+        import transaction
+        index, r1, r2 = self._make_two_replicas({})
+        self.assertTrue(index.read_connection_manager is r1)
+        transaction.abort()
+        r1.down = True
+        from repoze.pgtextindex import index as index_module
+        index_module._replica_status.clear()
+        self.assertTrue(index.read_connection_manager is r2)
+
     def _format_executed(self, executed):
         self.assertEqual(len(executed), 1)
         stmt, params = executed[0]
@@ -469,6 +872,142 @@ class TestPGTextIndex(unittest.TestCase):
         self.assertEqual(len(sleeps), 2)
         self.assertEqual(len(self.executed), 8)
 
+    def test_index_doc_counts_upsert_retries(self):
+        import psycopg2
+        from perfmetrics import set_statsd_client
+        from repoze.pgtextindex.tests.test_metrics import DummyStatsdClient
+        client = DummyStatsdClient()
+        set_statsd_client(client)
+        self.addCleanup(set_statsd_client, None)
+        execute_errors = [None, psycopg2.IntegrityError, None] * 3
+        index = self._make_one(execute_errors=execute_errors, rowcounts=())
+        index.sleep = lambda seconds: None
+        self.assertRaises(psycopg2.IntegrityError, index.index_doc, 5, 'Waldo')
+        retries = [value for (kind, name, value) in client.sent
+                   if name == 'repoze.pgtextindex.upsert.retry']
+        self.assertEqual(retries, [1, 1])
+
+    def test_index_doc_partitioned_by_marker_uses_lock(self):
+        index = self._make_one(partition_by='marker', partitions=['book'],
+                               rowcounts=())
+        index.index_doc(5, 'Waldo')
+        self.assertEqual(len(self.executed), 5)
+        lines, params = self._format_executed(self.executed[1:2])
+        self.assertEqual(lines,
+                         ['SELECT pg_advisory_xact_lock(hashtext(%s), %s)'])
+        self.assertEqual(params, ('pgtextindex', 5))
+        lines, params = self._format_executed(self.executed[2:3])
+        self.assertEqual(lines[0], 'UPDATE pgtextindex SET')
+        lines, params = self._format_executed(self.executed[3:4])
+        self.assertEqual(lines[0], 'SAVEPOINT pgtextindex_upsert;')
+
+    def test_index_doc_partitioned_by_marker_rejects_markers(self):
+        index = self._make_one(partition_by='marker', partitions=['book'])
+
+        from repoze.pgtextindex.interfaces import IWeightedText
+        from zope.interface import implements
+
+        class DummyText(unicode):
+            implements(IWeightedText)
+            marker = ['book', 'club']
+
+        self.assertRaises(ValueError, index.index_doc, 5,
+                          DummyText('Where is Waldo'))
+        self.assertEqual(self.executed, [])
+        DummyText.marker = ['book', 'book']
+        index.index_doc(5, DummyText('Where is Waldo'))
+        self.assertEqual(len(self.executed), 1)
+
+    def test_index_doc_partitioned_by_marker_updated_after_lock(self):
+        index = self._make_one(partition_by='marker', partitions=['book'],
+                               rowcounts=(0, 1, 1))
+        index.index_doc(5, 'Waldo')
+        self.assertEqual(len(self.executed), 3)
+
+    def test_index_doc_with_rank_vector(self):
+        index = self._make_one(rank_maxlen=6)
+        index.index_doc(5, ['Title', 'Waldo Wally'])
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(lines,
+                         ['UPDATE pgtextindex SET',
+                          'coefficient=%s,',
+                          'marker=%s,',
+                          'text_vector=to_tsvector(%s, %s) || '
+                          'setweight(to_tsvector(%s, %s), %s),',
+                          'rank_vector=to_tsvector(%s, %s) || '
+                          'setweight(to_tsvector(%s, %s), %s)',
+                          'WHERE docid=%s'])
+        self.assertEqual(params, (
+            1.0, [],
+            'english', 'Waldo Wally', 'english', 'Title', 'A',
+            'english', 'Waldo', 'english', 'Title', 'A',
+            5))
+
+    def test_index_doc_with_rank_vector_keeps_weighted_texts(self):
+        index = self._make_one(rank_maxlen=6)
+        index.index_doc(5, ['Title of the book', 'Waldo Wally'])
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(params[-4:-1], ('english', 'Title of the book', 'A'))
+        self.assertEqual(params[-6:-4], ('english', 'Waldo'))
+
+    def test_index_doc_with_rank_vector_using_insert(self):
+        index = self._make_one(rank_maxlen=100, rowcounts=())
+        index.index_doc(5, 'Waldo')
+        lines, params = self._format_executed(self.executed[1:2])
+        self.assertEqual(lines,
+                         ['SAVEPOINT pgtextindex_upsert;',
+                          'INSERT INTO pgtextindex '
+                              '(docid, coefficient, marker, text_vector, '
+                              'rank_vector)',
+                          'VALUES (%s, %s, %s, to_tsvector(%s, %s), '
+                              'to_tsvector(%s, %s))'])
+        self.assertEqual(params, (5, 1.0, [], 'english', 'Waldo',
+                                  'english', 'Waldo'))
+
+    def test_index_null_with_rank_vector(self):
+        index = self._make_one(rank_maxlen=100)
+        index.index_doc(6, None)
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(lines,
+                         ['UPDATE pgtextindex SET',
+                          'coefficient=%s,',
+                          'marker=%s,',
+                          'text_vector=null,',
+                          'rank_vector=null',
+                          'WHERE docid=%s'])
+        self.assertEqual(params, ('0.0', [], 6))
+
+    def test_index_doc_with_source_text(self):
+        index = self._make_one(store_text=True)
+        index.index_doc(5, ['Title', 'Waldo Wally'])
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(lines,
+                         ['UPDATE pgtextindex SET',
+                          'coefficient=%s,',
+                          'marker=%s,',
+                          'text_vector=to_tsvector(%s, %s) || '
+                          'setweight(to_tsvector(%s, %s), %s),',
+                          'source_text=%s',
+                          'WHERE docid=%s'])
+        self.assertEqual(params, (
+            1.0, [],
+            'english', 'Waldo Wally', 'english', 'Title', 'A',
+            'Waldo Wally',
+            5))
+
+    def test_index_doc_string_with_source_text(self):
+        index = self._make_one(store_text=True)
+        index.index_doc(5, 'Waldo')
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(params, (1.0, [], 'english', 'Waldo', 'Waldo', 5))
+
+    def test_index_null_with_source_text(self):
+        index = self._make_one(store_text=True)
+        index.index_doc(6, None)
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(lines[3:5], ['text_vector=null,', 'source_text=null'])
+        self.assertEqual(params, ('0.0', [], 6))
+
     def test_unindex_doc(self):
         index = self._make_one()
         index.unindex_doc(7)
@@ -612,6 +1151,37 @@ class TestPGTextIndex(unittest.TestCase):
         self.assertTrue(isinstance(res, index.family.IF.BTree))
         self.assertEqual(len(res), 2)
 
+    def test_apply_phrase_with_old_server(self):
+        index = self._make_one()
+        index.connection.server_version = 90500
+        index.apply('"Waldo Wally"')
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(params, ('english', "'Waldo Wally'",
+                                  'english', "'Waldo Wally'"))
+
+    def test_apply_phrase_with_followed_by_operator(self):
+        index = self._make_one()
+        index.connection.server_version = 90600
+        index.apply('"Waldo Wally"')
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(params, ('english', "'Waldo' <-> 'Wally'",
+                                  'english', "'Waldo' <-> 'Wally'"))
+
+    def test_apply_phrase_search_disabled(self):
+        index = self._make_one(phrase_search=False)
+        index.connection.server_version = 90600
+        index.apply('"Waldo Wally"')
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(params, ('english', "'Waldo Wally'",
+                                  'english', "'Waldo Wally'"))
+
+    def test_apply_with_field(self):
+        index = self._make_one(fields={'title': 'A', 'summary': 'AB'})
+        index.apply('title:Waldo summary:Wal*')
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(params, ('english', "( 'Waldo':A ) & ( 'Wal':*AB )",
+                                  'english', "( 'Waldo':A ) & ( 'Wal':*AB )"))
+
     def test_apply_weighted_query_normal(self):
         index = self._make_one()
 
@@ -774,6 +1344,39 @@ class TestPGTextIndex(unittest.TestCase):
         self.assertTrue(isinstance(res, index.family.IF.BTree))
         self.assertEqual(len(res), 2)
 
+    def test_apply_with_marker_partitions(self):
+        index = self._make_one(partition_by='marker', partitions=['book'])
+
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+            marker = 'book'
+
+        index.apply(DummyWeightedQuery('Waldo'))
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(lines[3],
+            'WHERE (text_vector @@ to_tsquery(%s, %s)) '
+            ' AND marker && %s::character varying[]'
+            ' AND marker[1] = ANY(%s::character varying[])),')
+        self.assertEqual(params, (
+            'english', "'Waldo'", ['book'], ['book'],
+            0.1, 0.2, 0.4, 1.0,
+            'english', "'Waldo'"))
+
+    def test_apply_with_rank_vector(self):
+        index = self._make_one(rank_maxlen=100)
+        index.apply('Waldo')
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(lines[:4], [
+            'WITH _filtered AS (',
+            'SELECT docid, coefficient, '
+            'COALESCE(rank_vector, text_vector) AS text_vector',
+            'FROM pgtextindex',
+            'WHERE (text_vector @@ to_tsquery(%s, %s)) ),',
+        ])
+
     def test_apply_with_limit_and_offset(self):
         index = self._make_one()
 
@@ -863,6 +1466,366 @@ class TestPGTextIndex(unittest.TestCase):
         self.assertTrue(isinstance(res, index.family.IF.BTree))
         self.assertEqual(len(res), 2)
 
+    def test_apply_many(self):
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+            limit = 5
+
+        index = self._make_one(results=((0, 5, 1.5), (1, 6, 0.75),
+                                        (1, 7, 0.25)))
+        res = index.apply_many(['Waldo', DummyWeightedQuery('Wally')])
+        self.assertEqual(len(self.executed), 1)
+        stmt, params = self.executed[0]
+        selects = stmt.split('\nUNION ALL\n')
+        self.assertEqual(len(selects), 2)
+        self.assertTrue(selects[0].startswith(
+            'SELECT 0 AS query_num, docid, rank FROM ('))
+        self.assertTrue(selects[0].endswith(') AS _q0'))
+        self.assertTrue(selects[1].startswith(
+            'SELECT 1 AS query_num, docid, rank FROM ('))
+        self.assertTrue('LIMIT %s' in selects[1])
+        self.assertEqual(params, (
+            'english', "'Waldo'", 'english', "'Waldo'",
+            'english', "'Wally'", 0.1, 0.2, 0.4, 1.0, 'english', "'Wally'",
+            5))
+        self.assertEqual(len(res), 2)
+        self.assertTrue(isinstance(res[0], index.family.IF.BTree))
+        self.assertEqual(list(res[0].items()), [(5, 1.5)])
+        self.assertEqual(list(res[1].items()), [(6, 0.75), (7, 0.25)])
+
+    def test_apply_many_with_cache(self):
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+            cache_enabled = True
+
+        index = self._make_one(results=((0, 5, 1.3),))
+        q = DummyWeightedQuery('Waldo')
+        res1 = index.apply_many([q])
+        self.assertEqual({(False, None): res1[0]}, q.cache)
+        res2 = index.apply_many([q])
+        self.assertEqual(len(self.executed), 1)
+        self.assertIs(res1[0], res2[0])
+
+    def test_apply_many_empty(self):
+        index = self._make_one()
+        self.assertEqual(index.apply_many([]), [])
+        self.assertEqual(len(self.executed), 0)
+
+    def test_statement_timeout(self):
+        index = self._make_one(statement_timeout=500)
+        res = index.applyContains('Waldo')
+        self.assertEqual(list(res.keys()), [5, 6])
+        self.assertEqual(len(self.executed), 2)
+        stmt, params = self.executed[0]
+        self.assertTrue(stmt.startswith(
+            'SAVEPOINT pgtextindex_read;\n'
+            'SET LOCAL statement_timeout = 500;\n'))
+        self.assertTrue('ts_rank_cd' in stmt)
+        self.assertEqual(self.executed[1], (
+            'ROLLBACK TO SAVEPOINT pgtextindex_read;\n'
+            'RELEASE SAVEPOINT pgtextindex_read', None))
+
+    def test_statement_timeout_retries_unranked(self):
+        from psycopg2.extensions import QueryCanceledError
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+            cache_enabled = True
+            limit = 5000
+
+        index = self._make_one(
+            statement_timeout=500, degraded_limit=100,
+            execute_errors=[QueryCanceledError('canceled')])
+        query = DummyWeightedQuery('Waldo')
+        res = index.applyContains(query)
+        self.assertEqual(list(res.keys()), [5, 6])
+        self.assertTrue(query.degraded)
+        self.assertEqual(query.cache, {})
+        self.assertEqual(len(self.executed), 4)
+        self.assertTrue(self.executed[1][0].startswith('ROLLBACK TO'))
+        stmt, params = self.executed[2]
+        self.assertTrue(stmt.startswith('SAVEPOINT pgtextindex_read;'))
+        self.assertFalse('ts_rank_cd' in stmt)
+        self.assertEqual(params, ('english', "'Waldo'", 100))
+
+    def test_statement_timeout_exceeded_twice(self):
+        from psycopg2.extensions import QueryCanceledError
+        index = self._make_one(
+            statement_timeout=500,
+            execute_errors=[QueryCanceledError('canceled'), None,
+                            QueryCanceledError('canceled')])
+        self.assertRaises(QueryCanceledError, index.applyContains, 'Waldo')
+
+    def test_apply_many_statement_timeout(self):
+        from psycopg2.extensions import QueryCanceledError
+        index = self._make_one(
+            results=((0, 5, 1.5), (1, 6, 0.75)), statement_timeout=500,
+            execute_errors=[QueryCanceledError('canceled')])
+        res = index.apply_many(['Waldo', 'Wally'])
+        self.assertEqual([dict(r) for r in res], [{5: 1.5}, {6: 0.75}])
+        stmt, params = self.executed[2]
+        self.assertEqual(len(stmt.split('\nUNION ALL\n')), 2)
+        self.assertFalse('ts_rank_cd' in stmt)
+        self.assertEqual(params, ('english', "'Waldo'", 1000,
+                                  'english', "'Wally'", 1000))
+
+    def _make_with_stats(self, **kw):
+        from repoze.pgtextindex.metrics import set_stats_callback
+        self.stats = stats = []
+
+        def stats_callback(query, query_stats):
+            stats.append((query, query_stats))
+
+        set_stats_callback(stats_callback)
+        self.addCleanup(set_stats_callback, None)
+        return self._make_one(**kw)
+
+    def test_stats_callback(self):
+        index = self._make_with_stats()
+        index.applyContains('Waldo')
+        [(query, stats)] = self.stats
+        self.assertEqual(query, 'Waldo')
+        self.assertEqual(sorted(stats), [
+            'btree', 'convert', 'execute', 'fetch', 'ranking_skipped',
+            'rows'])
+        self.assertEqual(stats['rows'], 2)
+        self.assertEqual(stats['ranking_skipped'], False)
+
+    def test_stats_callback_not_stored(self):
+        index = self._make_with_stats()
+        self.assertFalse('stats_callback' in index.__getstate__())
+
+    def test_stats_ranking_skipped(self):
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+
+        index = self._make_with_stats()
+        index.max_ranked = 1
+        index.applyContains('Waldo')
+        self.assertEqual(self.stats[-1][1]['ranking_skipped'], True)
+        query = DummyWeightedQuery('Waldo')
+        query.limit = 2
+        index.applyContains(query)
+        self.assertEqual(self.stats[-1][1]['ranking_skipped'], None)
+
+    def test_stats_cache(self):
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+            cache_enabled = True
+
+        index = self._make_with_stats()
+        query = DummyWeightedQuery('Waldo')
+        index.applyContains(query)
+        index.applyContains(query)
+        self.assertEqual(self.stats[0][1]['cache'], 'miss')
+        self.assertEqual(self.stats[1][1], {'cache': 'hit', 'rows': 2})
+
+    def test_stats_metrics(self):
+        from perfmetrics import set_statsd_client
+        from repoze.pgtextindex.tests.test_metrics import DummyStatsdClient
+        client = DummyStatsdClient()
+        set_statsd_client(client)
+        self.addCleanup(set_statsd_client, None)
+        index = self._make_one()
+        index.max_ranked = 1
+        index.applyContains('Waldo')
+        names = [name for (kind, name, value) in client.sent]
+        for name in ('convert', 'execute', 'fetch', 'btree', 'rows',
+                     'ranking_skipped'):
+            self.assertTrue('repoze.pgtextindex.query.' + name in names)
+        self.assertTrue(('timing', 'repoze.pgtextindex.query.rows', 2)
+                        in client.sent)
+
+    def _capture_warnings(self):
+        from repoze.pgtextindex import index as index_module
+        warnings = []
+
+        class DummyLog:
+            def warning(self, msg, *args):
+                warnings.append(msg % args)
+
+        original = index_module.log
+        index_module.log = DummyLog()
+        self.addCleanup(setattr, index_module, 'log', original)
+        return warnings
+
+    def test_slow_query_logged(self):
+        warnings = self._capture_warnings()
+        index = self._make_one(slow_query_threshold=0)
+        index.apply_intersect('Waldo', range(10))
+        self.assertEqual(len(warnings), 1)
+        self.assertTrue(warnings[0].startswith(
+            'Slow text query took '))
+        self.assertTrue("produced 2 rows: query 'Waldo', params "
+                        "('english', \"'Waldo'\"" in warnings[0])
+        self.assertTrue(warnings[0].endswith(
+            'docids 10 docids starting with [0, 1, 2, 3, 4]'))
+        self.assertEqual(len(self.executed), 1)
+
+    def test_fast_query_not_logged(self):
+        warnings = self._capture_warnings()
+        index = self._make_one(slow_query_threshold=60, explain_rate=1)
+        index.applyContains('Waldo')
+        self.assertEqual(warnings, [])
+        self.assertEqual(len(self.executed), 1)
+
+    def test_slow_query_explained(self):
+        warnings = self._capture_warnings()
+        index = self._make_one(
+            slow_query_threshold=0, explain_rate=1,
+            results=(('Seq Scan on pgtextindex',), ('Planning Time: 1 ms',)))
+        index.get_contextual_summaries(['Waldo is here'], 'Waldo')
+        self.assertEqual(len(self.executed), 2)
+        stmt, params = self.executed[1]
+        self.assertTrue(stmt.startswith('EXPLAIN (ANALYZE, BUFFERS)\n'))
+        self.assertEqual(params, self.executed[0][1])
+        self.assertEqual(len(warnings), 2)
+        self.assertTrue(warnings[0].startswith('Slow contextual summary'))
+        self.assertTrue(warnings[0].endswith(
+            "params ('english', 'english', \"'Waldo'\", ''), 1 texts"))
+        self.assertEqual(warnings[1], 'Plan of the slow contextual summary:\n'
+                         'Seq Scan on pgtextindex\nPlanning Time: 1 ms')
+
+    def test_slow_query_explain_error(self):
+        import psycopg2
+        warnings = self._capture_warnings()
+        index = self._make_one(
+            slow_query_threshold=0, explain_rate=1,
+            execute_errors=[None, psycopg2.ProgrammingError('nope')])
+        res = index.applyContains('Waldo')
+        self.assertEqual(list(res.keys()), [5, 6])
+        self.assertEqual(warnings[-1],
+                         'Unable to explain the slow text query: nope')
+
+    def test_approximate(self):
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+            approximate = True
+
+        index = self._make_one(approximate_limit=2000)
+        query = DummyWeightedQuery('Waldo')
+        res = index.applyContains(query)
+        self.assertEqual(list(res.keys()), [5, 6])
+        self.assertTrue(query.approximate_result)
+        stmt, params = self.executed[0]
+        self.assertTrue(stmt.startswith(
+            'SAVEPOINT pgtextindex_read;\n'
+            'SET LOCAL gin_fuzzy_search_limit = 2000;\n'))
+
+    def test_not_approximate(self):
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+
+        index = self._make_one()
+        query = DummyWeightedQuery('Waldo')
+        index.applyContains(query)
+        self.assertFalse(hasattr(query, 'approximate_result'))
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(lines[0], 'WITH _filtered AS (')
+
+    def test_apply_many_approximate(self):
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+            approximate = True
+
+        index = self._make_one(results=((5, 1.5),))
+        query = DummyWeightedQuery('Wally')
+        res = index.apply_many([query])
+        self.assertEqual([dict(r) for r in res], [{5: 1.5}])
+        self.assertTrue(query.approximate_result)
+        self.assertEqual(len(self.executed), 2)
+        stmt, params = self.executed[0]
+        self.assertTrue('gin_fuzzy_search_limit' in stmt)
+        self.assertFalse('query_num' in stmt)
+
+    def test_unranked_query_sql(self):
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+            marker = 'book'
+            limit = 10
+            offset = 20
+
+        index = self._make_one()
+        stmt, params = index._unranked_query_sql(
+            DummyWeightedQuery('Waldo'), invert=True, docids=[5, 6])
+        lines = [line.strip() for line in stmt.splitlines() if line.strip()]
+        self.assertEqual(lines, [
+            'SELECT docid, coefficient AS rank',
+            'FROM pgtextindex',
+            'WHERE NOT(text_vector @@ to_tsquery(%s, %s))  '
+            'AND marker && %s::character varying[] AND docid IN (5,6)',
+            'LIMIT %s',
+            'OFFSET %s',
+        ])
+        self.assertEqual(params, ('english', "'Waldo'", ['book'], 10, 20))
+
+    def test_get_marker_counts(self):
+        index = self._make_one(results=(('book', 3), ('film', 1)))
+        res = index.get_marker_counts('Waldo')
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(lines, [
+            'SELECT m, count(DISTINCT docid)',
+            'FROM pgtextindex, unnest(marker) AS m',
+            'WHERE text_vector @@ to_tsquery(%s, %s)',
+            'GROUP BY m',
+        ])
+        self.assertEqual(params, ('english', "'Waldo'"))
+        self.assertEqual(res, {'book': 3, 'film': 1})
+
+    def test_get_marker_counts_with_query_marker_and_markers(self):
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+            marker = 'community'
+
+        index = self._make_one(results=(('book', 3),))
+        res = index.get_marker_counts(DummyWeightedQuery('Waldo'), 'book')
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(lines, [
+            'SELECT m, count(DISTINCT docid)',
+            'FROM pgtextindex, unnest(marker) AS m',
+            'WHERE text_vector @@ to_tsquery(%s, %s) '
+            ' AND marker && %s::character varying[]'
+            ' AND m = ANY(%s::character varying[])',
+            'GROUP BY m',
+        ])
+        self.assertEqual(params, ('english', "'Waldo'", ['community'],
+                                  ['book']))
+        self.assertEqual(res, {'book': 3})
+
+    def test_get_marker_counts_with_no_markers(self):
+        index = self._make_one()
+        self.assertEqual(index.get_marker_counts('Waldo', []), {})
+        self.assertEqual(len(self.executed), 0)
+
     def test_docids(self):
         index = self._make_one(results=((5,), (6,)))
         res = index.docids()
@@ -918,6 +1881,14 @@ class TestPGTextIndex(unittest.TestCase):
             ('english', 'english', "'query'", 'foo=bar', 'raw text'))
         self.assertEqual(res, '<b>query</b>')
 
+    def test_get_contextual_summary_with_phrase(self):
+        index = self._make_one(results=[('<b>query</b>',)])
+        index.connection.server_version = 90600
+        index.get_contextual_summary('raw text', '"a query"')
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(params,
+            ('english', 'english', "'a' <-> 'query'", '', 'raw text'))
+
     def test_get_two_contextual_summaries(self):
         index = self._make_one(results=[('<b>query</b>',), ('<b>word</b>',)])
         raw_texts = ['raw 1', 'raw 2']
@@ -931,6 +1902,58 @@ class TestPGTextIndex(unittest.TestCase):
             ('english', 'english', "'query'", 'foo=bar', 'raw 1', 'raw 2'))
         self.assertEqual(res, ['<b>query</b>', '<b>word</b>'])
 
+    def test_get_contextual_summaries_using_local_summaries(self):
+        calls = []
+        reads = []
+
+        class DummySummarizer:
+            def get_summaries(self, read, ts_config, query, raw_texts,
+                              **kw):
+                calls.append((ts_config, query, raw_texts, kw))
+                reads.append(read)
+                return [u'<b>raw</b> 1']
+
+        index = self._make_one(local_summaries=True,
+                               fields={'title': 'A'})
+        index.summarizer_factory = DummySummarizer
+        res = index.get_contextual_summaries(['raw 1'], 'raw', MaxWords=5)
+        self.assertEqual(res, [u'<b>raw</b> 1'])
+        self.assertEqual(calls, [('english', 'raw', ['raw 1'], {
+            'encoding': 'UTF-8',
+            'fields': {'title': 'A'},
+            'MaxWords': 5})])
+        self.assertTrue(isinstance(index._v_summarizer, DummySummarizer))
+        self.assertFalse(self.executed)
+        self.assertEqual(reads, [index._read])
+
+    def test_get_contextual_summaries_with_cache(self):
+        from repoze.pgtextindex import index as index_module
+        index_module._summary_caches.clear()
+        index = self._make_one(results=[('<b>query</b> 1',)],
+                               summary_cache_entries=10)
+        res = index.get_contextual_summaries(['raw 1'], 'query', foo='bar')
+        self.assertEqual(res, [u'<b>query</b> 1'])
+        self.assertEqual(len(self.executed), 1)
+
+        del self.executed[:]
+        index = self._make_one(results=[('<b>query</b> 2',)],
+                               summary_cache_entries=10)
+        res = index.get_contextual_summaries(
+            ['raw 1', u'raw 2'], 'query', foo='bar')
+        self.assertEqual(res, [u'<b>query</b> 1', u'<b>query</b> 2'])
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(lines, [
+            'SELECT ts_headline(%s, doc.text, to_tsquery(%s, %s), %s)',
+            'FROM (VALUES (%s)) AS doc (text)',
+        ])
+        self.assertEqual(params,
+            ('english', 'english', "'query'", 'foo=bar', u'raw 2'))
+
+        del self.executed[:]
+        res = index.get_contextual_summaries(['raw 1'], 'query', foo='baz')
+        self.assertEqual(len(self.executed), 1)
+        index_module._summary_caches.clear()
+
     def test_get_zero_contextual_summaries(self):
         index = self._make_one()
         raw_texts = []
@@ -938,6 +1961,95 @@ class TestPGTextIndex(unittest.TestCase):
         self.assertFalse(self.executed)
         self.assertEqual(res, [])
 
+    def test_get_contextual_summaries_by_docid(self):
+        index = self._make_one(results=[(7, '<b>word</b>'),
+                                        (5, '<b>query</b>')],
+                               store_text=True)
+        res = index.get_contextual_summaries_by_docid(
+            [5, 6, 7], 'query', foo='bar')
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(lines, [
+            'SELECT docid, ts_headline(%s, source_text, '
+            'to_tsquery(%s, %s), %s)',
+            'FROM pgtextindex',
+            'WHERE docid IN (5,6,7) AND source_text IS NOT NULL',
+        ])
+        self.assertEqual(params, ('english', 'english', "'query'", 'foo=bar'))
+        self.assertEqual(res, [u'<b>query</b>', u'', u'<b>word</b>'])
+
+    def test_get_contextual_summaries_by_docid_empty(self):
+        index = self._make_one(store_text=True)
+        res = index.get_contextual_summaries_by_docid([], 'query')
+        self.assertEqual(res, [])
+        self.assertFalse(self.executed)
+
+    def test_get_contextual_summaries_by_docid_requires_store_text(self):
+        index = self._make_one()
+        self.assertRaises(ValueError,
+                          index.get_contextual_summaries_by_docid,
+                          [5], 'query')
+        self.assertFalse(self.executed)
+
+    def test_search_with_summaries(self):
+        index = self._make_one(results=[(5, 1.5, '<b>Waldo</b>'),
+                                        (6, 0.5, 'a <b>Waldo</b>')],
+                               store_text=True)
+        res = index.search_with_summaries('Waldo', limit=2, MaxWords=10)
+        lines, params = self._format_executed(self.executed)
+        self.assertEqual(lines, [
+            'WITH _page AS (',
+            'WITH _filtered AS (',
+            'SELECT docid, coefficient, text_vector',
+            'FROM pgtextindex',
+            'WHERE (text_vector @@ to_tsquery(%s, %s)) ),',
+            '_counter AS (SELECT count(1) AS n FROM _filtered),',
+            '_ranked AS (',
+            'SELECT docid, coefficient * (',
+            'CASE WHEN n <= 6000 THEN',
+            "ts_rank_cd(text_vector, to_tsquery(%s, %s))",
+            'ELSE 1 END) AS rank',
+            'FROM _filtered, _counter)',
+            'SELECT docid, rank',
+            'FROM _ranked',
+            'ORDER BY rank DESC',
+            'LIMIT %s',
+            ')',
+            'SELECT _page.docid, _page.rank, ts_headline(',
+            "%s, COALESCE(t.source_text, ''), to_tsquery(%s, %s), %s)",
+            'FROM _page',
+            'JOIN pgtextindex t ON (t.docid = _page.docid)',
+            'ORDER BY _page.rank DESC',
+        ])
+        self.assertEqual(params, (
+            'english', "'Waldo'", 'english', "'Waldo'", 2,
+            'english', 'english', "'Waldo'", 'MaxWords=10'))
+        self.assertEqual(res, [(5, 1.5, u'<b>Waldo</b>'),
+                               (6, 0.5, u'a <b>Waldo</b>')])
+
+    def test_search_with_summaries_uses_query_limit_and_offset(self):
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+            limit = 5
+            offset = 10
+
+        index = self._make_one(results=[], store_text=True)
+        res = index.search_with_summaries(DummyWeightedQuery('Waldo'),
+                                          offset=20)
+        stmt, params = self.executed[0]
+        self.assertTrue('LIMIT %s' in stmt)
+        self.assertTrue('OFFSET %s' in stmt)
+        self.assertEqual(params[-6:], (5, 20, 'english', 'english',
+                                       "'Waldo'", ''))
+        self.assertEqual(res, [])
+
+    def test_search_with_summaries_requires_store_text(self):
+        index = self._make_one()
+        self.assertRaises(ValueError, index.search_with_summaries, 'Waldo')
+        self.assertFalse(self.executed)
+
     def test_sort_nothing(self):
         index = self._make_one()
         self.assertEqual(index.sort({}), {})
@@ -1013,8 +2125,8 @@ class TestPGTextIndex(unittest.TestCase):
     def test_upgrade_nothing_to_do(self):
         index = self._make_one()
         index.upgrade()
-        self.assertEqual(len(self.executed), 1)
-        lines, params = self._format_executed(self.executed)
+        self.assertEqual(len(self.executed), 2)
+        lines, params = self._format_executed(self.executed[0:1])
         self.assertEqual(lines, [
             'SELECT data_type FROM information_schema.columns',
             'WHERE table_catalog=current_catalog AND',
@@ -1022,11 +2134,18 @@ class TestPGTextIndex(unittest.TestCase):
             'table_name=%s AND',
             "column_name='marker'"])
         self.assertEqual(params, ('pgtextindex',))
+        lines, params = self._format_executed(self.executed[1:2])
+        self.assertEqual(lines, [
+            'SELECT 1 FROM pg_indexes',
+            "WHERE schemaname='public' AND",
+            'tablename=%s AND',
+            'indexname=%s'])
+        self.assertEqual(params, ('pgtextindex', 'pgtextindex_marker_index'))
 
     def test_upgrade_markers_to_arrays(self):
         index = self._make_one(results=[('character varying',)])
         index.upgrade()
-        self.assertEqual(len(self.executed), 5)
+        self.assertEqual(len(self.executed), 6)
         lines, params = self._format_executed(self.executed[0:1])
         self.assertEqual(lines, [
             'SELECT data_type FROM information_schema.columns',
@@ -1051,3 +2170,44 @@ class TestPGTextIndex(unittest.TestCase):
         self.assertEqual(lines, [
             'ALTER TABLE pgtextindex DROP marker_old'])
         self.assertEqual(params, None)
+
+    def test_upgrade_add_rank_vector(self):
+        index = self._make_one(rank_maxlen=100,
+                               fetchone_results=[('character varying[]',),
+                                                 (1,), None])
+        index.upgrade()
+        self.assertEqual(len(self.executed), 4)
+        lines, params = self._format_executed(self.executed[2:3])
+        self.assertEqual(lines, [
+            'SELECT 1 FROM information_schema.columns',
+            'WHERE table_catalog=current_catalog AND',
+            "table_schema='public' AND",
+            'table_name=%s AND',
+            'column_name=%s'])
+        self.assertEqual(params, ('pgtextindex', 'rank_vector'))
+        lines, params = self._format_executed(self.executed[3:4])
+        self.assertEqual(lines, [
+            'ALTER TABLE pgtextindex ADD rank_vector tsvector'])
+
+    def test_upgrade_add_source_text(self):
+        index = self._make_one(store_text=True,
+                               fetchone_results=[('character varying[]',),
+                                                 (1,), None])
+        index.upgrade()
+        self.assertEqual(len(self.executed), 4)
+        lines, params = self._format_executed(self.executed[2:3])
+        self.assertEqual(params, ('pgtextindex', 'source_text'))
+        lines, params = self._format_executed(self.executed[3:4])
+        self.assertEqual(lines, [
+            'ALTER TABLE pgtextindex ADD source_text text'])
+
+    def test_upgrade_create_marker_index(self):
+        index = self._make_one(fetchone_results=[('character varying[]',),
+                                                 None])
+        index.upgrade()
+        self.assertEqual(len(self.executed), 3)
+        lines, params = self._format_executed(self.executed[2:3])
+        self.assertEqual(lines, [
+            'CREATE INDEX pgtextindex_marker_index '
+            'ON pgtextindex USING gin(marker)'])
+        self.assertEqual(params, None)
@@ -0,0 +1,84 @@
+
+import unittest
+
+
+class DummyStatsdClient:
+
+    def __init__(self):
+        self.sent = []
+
+    # perfmetrics decorators pass more arguments, such as a buffer.
+
+    def incr(self, name, count=1, *args, **kw):
+        self.sent.append(('incr', name, count))
+
+    def gauge(self, name, value, *args, **kw):
+        self.sent.append(('gauge', name, value))
+
+    def timing(self, name, value, *args, **kw):
+        self.sent.append(('timing', name, value))
+
+    def sendbuf(self, buf):
+        pass
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        from perfmetrics import set_statsd_client
+        self.client = DummyStatsdClient()
+        set_statsd_client(self.client)
+
+    def tearDown(self):
+        from perfmetrics import set_statsd_client
+        set_statsd_client(None)
+
+    def test_incr(self):
+        from repoze.pgtextindex.metrics import incr
+        incr('a.b', 3)
+        self.assertEqual(self.client.sent,
+                         [('incr', 'repoze.pgtextindex.a.b', 3)])
+
+    def test_gauge(self):
+        from repoze.pgtextindex.metrics import gauge
+        gauge('a', 4)
+        self.assertEqual(self.client.sent,
+                         [('gauge', 'repoze.pgtextindex.a', 4)])
+
+    def test_histogram(self):
+        from repoze.pgtextindex.metrics import histogram
+        histogram('a', 42)
+        self.assertEqual(self.client.sent,
+                         [('timing', 'repoze.pgtextindex.a', 42)])
+
+    def test_timing(self):
+        from repoze.pgtextindex.metrics import timing
+        timing('a', 0.25)
+        self.assertEqual(self.client.sent,
+                         [('timing', 'repoze.pgtextindex.a', 250)])
+
+    def test_no_client(self):
+        from perfmetrics import set_statsd_client
+        from repoze.pgtextindex.metrics import gauge
+        from repoze.pgtextindex.metrics import incr
+        from repoze.pgtextindex.metrics import timing
+        set_statsd_client(None)
+        incr('a')
+        gauge('a', 1)
+        timing('a', 1)
+        self.assertEqual(self.client.sent, [])
+
+    def test_stats_callback(self):
+        from repoze.pgtextindex.metrics import set_stats_callback
+        from repoze.pgtextindex.metrics import stats_callback
+        self.assertEqual(stats_callback(), None)
+        callback = lambda query, stats: None
+        set_stats_callback(callback)
+        self.addCleanup(set_stats_callback, None)
+        self.assertTrue(stats_callback() is callback)
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestMetrics),
+    ))
@@ -3,9 +3,9 @@ import unittest
 
 class TestConvertQuery(unittest.TestCase):
 
-    def _call(self, query):
+    def _call(self, query, **kw):
         from repoze.pgtextindex.queryconvert import convert_query
-        return convert_query(query)
+        return convert_query(query, **kw)
 
     def test_simple(self):
         self.assertEqual(self._call("stuff"), "'stuff'")
@@ -20,6 +20,18 @@ class TestConvertQuery(unittest.TestCase):
     def test_phrase(self):
         self.assertEqual(self._call('"stuff here"'), "'stuff here'")
 
+    def test_phrase_with_followed_by_operator(self):
+        self.assertEqual(self._call('"stuff here"', phrase=True),
+            "'stuff' <-> 'here'")
+
+    def test_phrase_with_followed_by_operator_and_apostrophe(self):
+        self.assertEqual(self._call('"O\'Malley said"', phrase=True),
+            "'O''Malley' <-> 'said'")
+
+    def test_phrase_with_followed_by_operator_in_and(self):
+        self.assertEqual(self._call('more "stuff here"', phrase=True),
+            "( 'more' ) & ( 'stuff' <-> 'here' )")
+
     def test_and(self):
         self.assertEqual(self._call('stuff and more'),
             "( 'stuff' ) & ( 'more' )")
@@ -45,6 +57,32 @@ class TestConvertQuery(unittest.TestCase):
     def test_word_with_apostrophe(self):
         self.assertEqual(self._call("O'Malley"), "'O''Malley'")
 
+    def test_field_atom(self):
+        self.assertEqual(self._call('title:stuff', fields={'title': 'A'}),
+            "'stuff':A")
+
+    def test_field_glob(self):
+        self.assertEqual(self._call('title:stuff*', fields={'title': 'AB'}),
+            "'stuff':*AB")
+
+    def test_field_phrase(self):
+        self.assertEqual(self._call('title:"stuff here"',
+                                    fields={'title': 'A'}),
+            "'stuff here':A")
+
+    def test_field_phrase_with_followed_by_operator(self):
+        self.assertEqual(self._call('title:"stuff here"',
+                                    fields={'title': 'A'}, phrase=True),
+            "'stuff':A <-> 'here':A")
+
+    def test_field_does_not_leak_to_other_terms(self):
+        self.assertEqual(self._call('title:stuff -more',
+                                    fields={'title': 'A'}),
+            "( 'stuff':A ) & ( ! ( 'more' ) )")
+
+    def test_unconfigured_field(self):
+        self.assertEqual(self._call('title:stuff'), "'title:stuff'")
+
 
 def test_suite():
     return unittest.TestSuite((
@@ -426,7 +426,71 @@ class TestQueryParser(TestQueryParserBase):
         self._failure(parser, '"" NOT ""')
 
 
+class TestQueryParserWithFields(TestQueryParserBase):
+
+    def _makeOne(self):
+        return self._getTargetClass()({'title': 'A', 'summary': 'AB'})
+
+    def _expectField(self, input, weights, output):
+        from repoze.pgtextindex.queryparser import FieldNode
+        tree = self._makeOne().parseQuery(input)
+        self.assertTrue(isinstance(tree, FieldNode), repr(tree))
+        self.assertEqual(tree.nodeType(), "FIELD")
+        self.assertEqual(tree.weights, weights)
+        self._compareParseTrees(tree.getValue(), output)
+
+    def test_field_atom(self):
+        from zope.index.text.parsetree import AtomNode
+        self._expectField("title:foo", 'A', AtomNode("foo"))
+
+    def test_field_phrase(self):
+        from zope.index.text.parsetree import PhraseNode
+        self._expectField('summary:"foo bar"', 'AB',
+                          PhraseNode(["foo", "bar"]))
+
+    def test_field_glob(self):
+        from zope.index.text.parsetree import GlobNode
+        self._expectField("title:foo*", 'A', GlobNode("foo*"))
+
+    def test_negated_field(self):
+        from repoze.pgtextindex.queryparser import FieldNode
+        from zope.index.text.parsetree import AndNode
+        from zope.index.text.parsetree import NotNode
+        tree = self._makeOne().parseQuery("foo -title:bar")
+        self.assertTrue(isinstance(tree, AndNode))
+        atom, notnode = tree.getValue()
+        self.assertTrue(isinstance(notnode, NotNode))
+        self.assertTrue(isinstance(notnode.getValue(), FieldNode))
+        self.assertEqual(tree.terms(), ["foo"])
+
+    def test_unknown_field_is_a_word(self):
+        from zope.index.text.parsetree import AtomNode
+        parser = self._makeOne()
+        self._expect(parser, "body:foo", AtomNode("body:foo"))
+
+    def test_unknown_field_before_quote(self):
+        from zope.index.text.parsetree import AndNode
+        from zope.index.text.parsetree import AtomNode
+        parser = self._makeOne()
+        self._expect(parser, 'body:"foo"',
+                     AndNode([AtomNode("body:"), AtomNode("foo")]))
+
+    def test_field_name_without_value(self):
+        from zope.index.text.parsetree import AtomNode
+        parser = self._makeOne()
+        self._expect(parser, "title:", AtomNode("title:"))
+
+    def test_field_terms(self):
+        tree = self._makeOne().parseQuery('title:"foo bar"')
+        self.assertEqual(tree.terms(), [["foo", "bar"]])
+
+    def test_field_repr(self):
+        tree = self._makeOne().parseQuery("title:foo")
+        self.assertEqual(repr(tree), "FieldNode(AtomNode('foo'), 'A')")
+
+
 def test_suite():
     return unittest.TestSuite((
         unittest.makeSuite(TestQueryParser),
+        unittest.makeSuite(TestQueryParserWithFields),
     ))
@@ -0,0 +1,350 @@
+
+import unittest
+
+
+class TestShardedPGTextIndex(unittest.TestCase):
+
+    @property
+    def _class(self):
+        from repoze.pgtextindex.sharded import ShardedPGTextIndex
+        return ShardedPGTextIndex
+
+    def _make_one(self, dsns=('dbname=a', 'dbname=b'), results=None,
+                  execute_errors=None, **kw):
+        """Make an index with dummy shards.
+
+        results maps each DSN to the rows its cursor produces, or to a
+        function that gets the rows from the last statement.
+        execute_errors maps each DSN to a list of errors (or None) to
+        raise from successive statements.
+        """
+        self.executed = executed = []  # [(dsn, stmt, params)]
+        results = results or {}
+        execute_errors = execute_errors or {}
+
+        def discriminator(obj, default):
+            return obj
+
+        class DummyConnectionManager:
+            def __init__(self, dsn):
+                self.dsn = dsn
+                self.connection = DummyConnection()
+                self.cursor = DummyCursor(dsn)
+
+            def close(self):
+                pass
+
+        class DummyConnection:
+            encoding = 'UTF-8'
+
+            def commit(self):
+                pass
+
+        class DummyCursor:
+            rowcount = 1
+
+            def __init__(self, dsn):
+                self.dsn = dsn
+
+            def execute(self, stmt, params=None):
+                executed.append((self.dsn, stmt, params))
+                self.stmt = stmt
+                errors = execute_errors.get(self.dsn)
+                if errors:
+                    error = errors.pop(0)
+                    if error is not None:
+                        raise error
+
+            def fetchall(self):
+                rows = results.get(self.dsn, ())
+                if callable(rows):
+                    rows = rows(self.stmt)
+                return list(rows)
+
+            def fetchone(self):
+                return self.fetchall()[0]
+
+        kw.setdefault('connection_manager_factory', DummyConnectionManager)
+        return self._class(discriminator, dsns, **kw)
+
+    def _collect_stats(self):
+        from repoze.pgtextindex.metrics import set_stats_callback
+        stats = []
+        set_stats_callback(lambda query, s: stats.append(s))
+        self.addCleanup(set_stats_callback, None)
+        return stats
+
+    def _make_query(self, **attrs):
+        from zope.interface import implements
+        from repoze.pgtextindex.interfaces import IWeightedQuery
+
+        class DummyWeightedQuery(unicode):
+            implements(IWeightedQuery)
+
+        query = DummyWeightedQuery('Waldo')
+        for name, value in attrs.items():
+            setattr(query, name, value)
+        return query
+
+    def test_dsns_required(self):
+        self.assertRaises(ValueError, self._make_one, dsns=())
+        self.assertRaises(ValueError, self._make_one, dsns='dbname=a')
+
+    def test_read_dsns_not_supported(self):
+        self.assertRaises(ValueError, self._make_one, read_dsns=['x'])
+
+    def test_exported(self):
+        from repoze.pgtextindex import ShardedPGTextIndex
+        self.assertTrue(ShardedPGTextIndex is self._class)
+
+    def test_index_doc_routed_by_docid(self):
+        index = self._make_one()
+        index.index_doc(5, 'Waldo')
+        index.index_doc(6, 'Carmen')
+        self.assertEqual([dsn for (dsn, stmt, params) in self.executed],
+                         ['dbname=b', 'dbname=a'])
+        self.assertEqual(self.executed[0][2][-1], 5)
+        self.assertEqual(index._v_shard, None)
+
+    def test_unindex_doc_routed_by_docid(self):
+        index = self._make_one()
+        index.unindex_doc(7)
+        self.assertEqual(self.executed, [
+            ('dbname=b', 'DELETE FROM pgtextindex WHERE docid = %s', (7,))])
+
+    def test_index_null_routed_by_docid(self):
+        index = self._make_one(results={'dbname=a': [(4,)]})
+        index._migrate_to_0_8_0(index.family.IF.Set([4, 5, 7]))
+        writes = [(dsn, params[-1]) for (dsn, stmt, params) in self.executed
+                  if stmt.strip().startswith('UPDATE')]
+        self.assertEqual(writes, [('dbname=b', 5), ('dbname=b', 7)])
+        self.assertEqual(index._v_shard, None)
+
+    def test_clear_all_shards(self):
+        index = self._make_one()
+        index.clear()
+        self.assertEqual(self.executed, [
+            ('dbname=a', 'DELETE FROM pgtextindex', None),
+            ('dbname=b', 'DELETE FROM pgtextindex', None),
+        ])
+
+    def test_drop_and_create_all_shards(self):
+        self._make_one(drop_and_create=True)
+        self.assertEqual([dsn for (dsn, stmt, params) in self.executed],
+                         ['dbname=a', 'dbname=b'])
+
+    def test_connection_managers_from_jar(self):
+        class DummyZODBConnection:
+            pass
+
+        index = self._make_one()
+        index._p_jar = jar = DummyZODBConnection()
+        index._p_oid = '1' * 8
+        cms = index._get_shard_connection_managers()
+        self.assertEqual([cm.dsn for cm in cms], ['dbname=a', 'dbname=b'])
+        self.assertTrue(
+            jar.foreign_connections[('1' * 8, 'shard', 'dbname=b')]
+            is cms[1])
+        self.assertTrue(index.connection_manager is cms[0])
+
+    def test_apply_merges_shards(self):
+        index = self._make_one(results={
+            'dbname=a': [(4, 1.5, 2), (6, 0.25, 2)],
+            'dbname=b': [(5, 0.75, 1)],
+        })
+        res = index.applyContains('Waldo')
+        self.assertEqual(dict(res), {4: 1.5, 5: 0.75, 6: 0.25})
+        self.assertEqual(len(self.executed), 2)
+        self.assertEqual(self.executed[0][1:], self.executed[1][1:])
+
+    def test_apply_uses_execute_read(self):
+        import threading
+        events = []  # [(dsn, event, thread)]
+
+        class DummyReadingConnectionManager:
+            connection = None
+
+            def __init__(self, dsn):
+                self.dsn = dsn
+
+            @property
+            def read_cursor(self):
+                events.append(
+                    (self.dsn, 'join', threading.current_thread()))
+
+            @property
+            def cursor(self):
+                raise AssertionError('reads must not use cursor')
+
+            def execute_read(self, stmt, params=None, settings=()):
+                events.append((self.dsn, 'read', settings))
+                return [(len(self.dsn), 1.0, 1)]
+
+        index = self._make_one(
+            connection_manager_factory=DummyReadingConnectionManager,
+            statement_timeout=500)
+        res = index.applyContains('Waldo')
+        self.assertEqual(dict(res), {8: 1.0})
+        current = threading.current_thread()
+        self.assertEqual(events[:2], [
+            ('dbname=a', 'join', current), ('dbname=b', 'join', current)])
+        self.assertEqual(sorted(events[2:]), [
+            ('dbname=a', 'read', [('statement_timeout', 500)]),
+            ('dbname=b', 'read', [('statement_timeout', 500)]),
+        ])
+
+    def test_apply_with_global_limit_and_offset(self):
+        index = self._make_one(results={
+            'dbname=a': [(4, 1.5, 2), (6, 0.25, 2)],
+            'dbname=b': [(5, 0.75, 2), (7, 0.5, 2)],
+        })
+        query = self._make_query(limit=2, offset=1)
+        res = index.applyContains(query)
+        self.assertEqual(dict(res), {5: 0.75, 7: 0.5})
+        # Each shard produces the rows up to the end of the page.
+        stmt, params = self.executed[0][1:]
+        self.assertTrue('LIMIT %s' in stmt)
+        self.assertFalse('OFFSET %s' in stmt)
+        self.assertEqual(params[-1], 3)
+
+    def test_apply_ranking_skipped_on_all_shards(self):
+        def shard_b(stmt):
+            if 'n <= 0' in stmt:
+                return [(5, 1.0)]
+            return [(5, 0.75, 1)]
+
+        stats = self._collect_stats()
+        index = self._make_one(results={
+            'dbname=a': [(4, 1.0, 4), (6, 1.0, 4), (8, 1.0, 4)],
+            'dbname=b': shard_b,
+        })
+        index.max_ranked = 3
+        res = index.applyContains('Waldo')
+        # Shard b ranked its match, but there are 5 matches in total, so
+        # its matches were read again without ranking.
+        self.assertEqual(dict(res), {4: 1.0, 5: 1.0, 6: 1.0, 8: 1.0})
+        self.assertEqual([dsn for (dsn, stmt, params) in self.executed],
+                         ['dbname=a', 'dbname=b', 'dbname=b'])
+        self.assertTrue(stats[0]['ranking_skipped'])
+
+    def test_apply_ranked_on_all_shards(self):
+        index = self._make_one(results={
+            'dbname=a': [(4, 1.5, 2), (6, 0.25, 2)],
+            'dbname=b': [(5, 0.75, 1)],
+        })
+        index.max_ranked = 3
+        res = index.applyContains('Waldo')
+        self.assertEqual(dict(res), {4: 1.5, 5: 0.75, 6: 0.25})
+        self.assertEqual(len(self.executed), 2)
+        stmt = self.executed[0][1]
+        self.assertTrue('CASE WHEN n <= 3 THEN' in stmt)
+        self.assertTrue('SELECT docid, rank, n' in stmt)
+
+    def test_apply_with_offset_only(self):
+        index = self._make_one(results={
+            'dbname=a': [(4, 1.5, 2), (6, 0.25, 2)],
+            'dbname=b': [(5, 0.75, 1)],
+        })
+        res = index.applyContains(self._make_query(offset=1))
+        self.assertEqual(dict(res), {5: 0.75, 6: 0.25})
+
+    def test_apply_statement_timeout(self):
+        from psycopg2.extensions import QueryCanceledError
+        index = self._make_one(
+            results={
+                'dbname=a': [(4, 1.0), (6, 1.0)],
+                'dbname=b': [(5, 1.0)],
+            },
+            execute_errors={'dbname=b': [QueryCanceledError('canceled')]},
+            statement_timeout=500, degraded_limit=2)
+        query = self._make_query(limit=10)
+        res = index.applyContains(query)
+        self.assertEqual(list(res.keys()), [4, 5])
+        self.assertTrue(query.degraded)
+        stmt, params = self.executed[-1][1:]
+        self.assertTrue(stmt.startswith('ROLLBACK TO'))
+        stmt, params = self.executed[-2][1:]
+        self.assertFalse('ts_rank_cd' in stmt)
+        self.assertEqual(params, ('english', "'Waldo'", 2))
+
+    def test_apply_stats(self):
+        stats = self._collect_stats()
+        index = self._make_one(
+            results={'dbname=a': [(4, 1.5, 1)], 'dbname=b': [(5, 0.75, 1)]})
+        index.applyContains('Waldo')
+        [s] = stats
+        self.assertEqual(sorted(s), [
+            'btree', 'convert', 'execute', 'ranking_skipped', 'rows'])
+        self.assertEqual(s['rows'], 2)
+
+    def test_apply_many(self):
+        index = self._make_one(results={'dbname=a': [(4, 1.5, 1)]})
+        res = index.apply_many(['Waldo', 'Carmen'])
+        self.assertEqual([dict(r) for r in res], [{4: 1.5}, {4: 1.5}])
+        self.assertEqual(len(self.executed), 4)
+
+    def test_docids(self):
+        index = self._make_one(results={
+            'dbname=a': [(4,)],
+            'dbname=b': [(5,)],
+        })
+        self.assertEqual(list(index.docids()), [4, 5])
+
+    def test_get_marker_counts_adds_shards(self):
+        index = self._make_one(results={
+            'dbname=a': [('book', 2), ('video', 1)],
+            'dbname=b': [('book', 3)],
+        })
+        self.assertEqual(index.get_marker_counts('Waldo'),
+                         {'book': 5, 'video': 1})
+
+    def test_get_contextual_summaries_by_docid(self):
+        index = self._make_one(results={
+            'dbname=a': [(4, '<b>Waldo</b> 4')],
+            'dbname=b': [(5, '<b>Waldo</b> 5')],
+        }, store_text=True)
+        res = index.get_contextual_summaries_by_docid([5, 4, 7], 'Waldo')
+        self.assertEqual(res, [u'<b>Waldo</b> 5', u'<b>Waldo</b> 4', u''])
+
+    def test_get_contextual_summaries_uses_one_shard(self):
+        index = self._make_one(results={'dbname=a': [('<b>Waldo</b>',)]})
+        res = index.get_contextual_summaries(['Waldo'], 'Waldo')
+        self.assertEqual(res, [u'<b>Waldo</b>'])
+        self.assertEqual(len(self.executed), 1)
+
+    def test_search_with_summaries(self):
+        index = self._make_one(results={
+            'dbname=a': [(4, 1.5, 2, 'four'), (6, 0.25, 2, 'six')],
+            'dbname=b': [(5, 0.75, 1, 'five')],
+        }, store_text=True)
+        res = index.search_with_summaries('Waldo', limit=2)
+        self.assertEqual(res, [(4, 1.5, u'four'), (5, 0.75, u'five')])
+        stmt = self.executed[0][1]
+        self.assertTrue('SELECT _page.docid, _page.rank, _page.n,' in stmt)
+        res = index.search_with_summaries('Waldo')
+        self.assertEqual([docid for (docid, rank, s) in res], [4, 5, 6])
+
+    def test_search_with_summaries_ranking_skipped_on_all_shards(self):
+        def shard_b(stmt):
+            if 'n <= 0' in stmt:
+                return [(5, 1.0, 1, 'five')]
+            return [(5, 0.75, 1, 'five')]
+
+        index = self._make_one(results={
+            'dbname=a': [(4, 1.0, 4, 'four'), (6, 1.0, 4, 'six'),
+                         (8, 1.0, 4, 'eight')],
+            'dbname=b': shard_b,
+        }, store_text=True)
+        index.max_ranked = 3
+        res = index.search_with_summaries('Waldo', limit=2, offset=1)
+        # Shard b's match was read again without ranking, so it does
+        # not rank below the unranked matches of shard a.
+        self.assertEqual(res, [(5, 1.0, u'five'), (6, 1.0, u'six')])
+        self.assertEqual([dsn for (dsn, stmt, params) in self.executed],
+                         ['dbname=a', 'dbname=b', 'dbname=b'])
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestShardedPGTextIndex),
+    ))
@@ -0,0 +1,162 @@
+
+import unittest
+
+
+class DummyReader:
+    """Emulates ts_debug with a stemmer that removes a trailing 's'."""
+
+    stopwords = ('the', 'a')
+
+    def __init__(self):
+        self.executed = []
+
+    def __call__(self, stmt, params):
+        self.executed.append((stmt, params))
+        words, ts_config = params
+        rows = []
+        for word in words:
+            if word in self.stopwords:
+                rows.append((word.encode('utf-8'), word, []))
+            else:
+                lexeme = word.rstrip('s').encode('utf-8')
+                rows.append((word.encode('utf-8'), word, [lexeme]))
+        return rows
+
+
+class TestSummarizer(unittest.TestCase):
+
+    def _make_one(self, **kw):
+        from repoze.pgtextindex.summarizer import Summarizer
+        return Summarizer(**kw)
+
+    def _call(self, summarizer, query, raw_texts, **options):
+        self.read = DummyReader()
+        return summarizer.get_summaries(
+            self.read, 'english', query, raw_texts, **options)
+
+    def test_highlight_word(self):
+        s = self._make_one()
+        res = self._call(s, 'cat', ['The cat sat.'])
+        self.assertEqual(res, [u'The <b>cat</b> sat'])
+
+    def test_highlight_stemmed_words(self):
+        s = self._make_one()
+        res = self._call(s, 'cats', ['Cats and a cat, not catalogs'])
+        self.assertEqual(
+            res, [u'<b>Cats</b> and a <b>cat</b>, not catalogs'])
+
+    def test_only_candidate_words_are_lexized(self):
+        s = self._make_one()
+        self._call(s, 'cats', ['Cats and a cat, not catalogs'])
+        self.assertEqual(len(self.read.executed), 2)
+        self.assertEqual(self.read.executed[0][1], ([u'cats'], 'english'))
+        self.assertEqual(self.read.executed[1][1],
+                         ([u'cat', u'catalogs'], 'english'))
+
+    def test_lexemes_are_cached(self):
+        s = self._make_one()
+        self._call(s, 'cats', ['Cats and a cat'])
+        self._call(s, 'cats', ['Cats and a cat'])
+        self.assertEqual(self.read.executed, [])
+
+    def test_cache_is_bounded(self):
+        s = self._make_one(cache_size=2)
+        self._call(s, 'cats', ['Cats and a cat'])
+        self._call(s, 'dogs', ['dogs'])
+        self.assertEqual(len(s._lexemes), 1)
+
+    def test_glob(self):
+        s = self._make_one()
+        res = self._call(s, 'cata*', ['Cats and catalogs'])
+        self.assertEqual(res, [u'Cats and <b>catalogs</b>'])
+
+    def test_phrase_and_field(self):
+        s = self._make_one()
+        res = self._call(s, 'title:"black cat"', ['A black cat'],
+                         fields={'title': 'A'})
+        self.assertEqual(res, [u'A <b>black</b> <b>cat</b>'])
+
+    def test_excluded_words_not_highlighted(self):
+        s = self._make_one()
+        res = self._call(s, 'cat -dog', ['cat and dog'])
+        self.assertEqual(res, [u'<b>cat</b> and dog'])
+
+    def test_dict_query(self):
+        s = self._make_one()
+        res = self._call(s, {'query': 'cat'}, ['cat'])
+        self.assertEqual(res, [u'<b>cat</b>'])
+
+    def test_custom_selectors(self):
+        s = self._make_one()
+        res = self._call(s, 'cat', ['the cat'], StartSel='[', StopSel=']')
+        self.assertEqual(res, [u'the [cat]'])
+
+    def test_bytes_text(self):
+        s = self._make_one()
+        res = self._call(s, 'cat', ['caf\xc3\xa9 cat'])
+        self.assertEqual(res, [u'caf\xe9 <b>cat</b>'])
+
+    def test_no_match_uses_min_words(self):
+        s = self._make_one()
+        text = ' '.join(['word%d' % i for i in range(20)])
+        res = self._call(s, 'cat', [text], MinWords=3)
+        self.assertEqual(res, [u'word0 word1 word2'])
+
+    def test_empty_text(self):
+        s = self._make_one()
+        self.assertEqual(self._call(s, 'cat', [u'']), [u''])
+
+    def test_window(self):
+        s = self._make_one(window=4)
+        text = ' '.join(['word%d' % i for i in range(20)]) + ' cat end'
+        res = self._call(s, 'cat', [text])
+        self.assertEqual(res, [u'word18 word19 <b>cat</b> end'])
+
+    def test_window_with_most_matches(self):
+        s = self._make_one()
+        text = 'cat a b c d e cat cat f'
+        res = self._call(s, 'cat', [text], MaxWords=3)
+        self.assertEqual(res, [u'<b>cat</b> <b>cat</b> f'])
+
+    def test_max_fragments(self):
+        s = self._make_one()
+        text = 'cat a b c d e f g cat h i j k cat'
+        res = self._call(s, 'cat', [text], MaxWords=2, MaxFragments=2,
+                         FragmentDelimiter='|')
+        self.assertEqual(res, [u'<b>cat</b> a|<b>cat</b> h'])
+
+    def test_max_fragments_overlap(self):
+        s = self._make_one()
+        text = 'x cat y z cat'
+        res = self._call(s, 'cat', [text], MaxWords=3, MaxFragments=3)
+        self.assertEqual(res, [u'<b>cat</b> y z ... <b>cat</b>'])
+
+    def test_highlight_all(self):
+        s = self._make_one()
+        text = '(cat a b c d e f g cat.)'
+        res = self._call(s, 'cat', [text], MaxWords=2, HighlightAll=True)
+        self.assertEqual(res, [u'(<b>cat</b> a b c d e f g <b>cat</b>.)'])
+
+
+class TestGetQueryTerms(unittest.TestCase):
+
+    def _call(self, query, fields=None):
+        from repoze.pgtextindex.summarizer import get_query_terms
+        return get_query_terms(query, fields)
+
+    def test_words(self):
+        self.assertEqual(self._call('Cat OR (dog AND "big fish")'),
+                         (['cat', 'dog', 'big', 'fish'], []))
+
+    def test_globs(self):
+        self.assertEqual(self._call('cat* dog'), (['dog'], ['cat']))
+
+    def test_not(self):
+        self.assertEqual(self._call('cat -dog'), (['cat'], []))
+
+
+def test_suite():
+    return unittest.TestSuite((
+        unittest.makeSuite(TestSummarizer),
+        unittest.makeSuite(TestGetQueryTerms),
+    ))
@@ -45,5 +45,8 @@ setup(
     tests_require=requires + ['nose'],
     test_suite="nose.collector",
     entry_points = """
+    [console_scripts]
+    pgtextindex-benchmark = repoze.pgtextindex.benchmark.run:main
+    pgtextindex-load = repoze.pgtextindex.benchmark.load:main
     """,
 )